@@ -348,6 +348,17 @@ def getPolygonsFromCSV():
 #                   pan_off          - True to switch pansharpening off for Landsat 7,
 #                                      8, and 9 imagery.
 #
+#                   reference_sl     - If True, a reference shoreline is set for each
+#                                      polygon (see setReferenceShoreline), otherwise
+#                                      the shorelines are mapped on the whole polygon.
+#
+#                   max_dist_ref     - The maximum distance (in metres) from the
+#                                      reference shoreline where the shoreline is
+#                                      mapped (see setReferenceShoreline).
+#
+#                   classify_buffer  - If True, only the pixels around the reference
+#                                      shoreline are classified.
+#
 #               The settings are stored in the global 'settings' variable.
 #
 # Parameters:   None. 
@@ -378,6 +389,9 @@ def setCoastSatConfig():
         'cloud_mask_issue': False, 
         'sand_color': 'default',
         'pan_off': False,    
+        'reference_sl': True,
+        'max_dist_ref': 100,
+        'classify_buffer': True,
 
         # Add the global inputs
         'inputs': inputs,
@@ -525,6 +539,39 @@ def retrieveImages():
 
     print("Images downloaded!\n")
 
+#=======================================================================================
+# Function:     SET REFERENCE SHORELINE
+#
+# Description:  This function sets the reference shoreline of the current polygon
+#               without any user input. The reference shoreline is loaded if it was
+#               already saved for this polygon, otherwise it is taken from the
+#               GeoJSON file of a previous run or mapped on the least cloudy image.
+#               Only the shorelines within max_dist_ref of the reference shoreline
+#               are then mapped, which excludes the inland lakes. If no reference
+#               shoreline is found, or if settings['reference_sl'] is False, the whole
+#               polygon is used.
+#
+# Parameters:   None.
+#
+# Returns:      None.
+
+def setReferenceShoreline():
+    if not settings['reference_sl']:
+        settings.pop('reference_shoreline', None)
+        print("No reference shoreline, the whole polygon is used.\n")
+        return
+
+    prevGeoJson = os.path.join(inputs['geofilepath'],'%s_output_lines.geojson'%inputs['sitename'])
+    referenceShoreline = SDS_shoreline.get_reference_sl_auto(metadata, settings, prevGeoJson)
+
+    if referenceShoreline is None:
+        settings.pop('reference_shoreline', None)
+        print("No reference shoreline, the whole polygon is used.\n")
+
+    else:
+        settings['reference_shoreline'] = referenceShoreline
+        print("Reference shoreline set!\n")
+
 #=======================================================================================
 # Function:     MAP SHORELINES
 #
@@ -635,6 +682,7 @@ def processPolygon(shapeId, coords):
     print(">>>>>>>>>>>>>>>>>>>>>> PROCESSING POLYGON: [{}] >>>>>>>>>>>>>>>>>>>>>>\n".format(shapeId))
     setCurrPolyInputs(shapeId, coords)
     retrieveImages()
+    setReferenceShoreline()
     mapShorelines()
     saveAsJPGs()
     exportGeoJson()
@@ -0,0 +1,200 @@
+"""
+This module contains the functions used to cache intermediate results (e.g., the
+preprocessed images) on disk, so that they can be shared between the different
+stages of a run instead of being recomputed for each stage.
+
+The arrays are stored as .npy files that are memory-mapped when they are read
+back, while the boolean masks are bit-packed and compressed.
+"""
+
+# load modules
+import os
+import numpy as np
+import hashlib
+import shutil
+import uuid
+
+# version of the cached results, to be increased when the functions producing them
+# change (e.g., the pansharpening), so that the entries of older versions are not used
+CACHE_VERSION = 1
+
+###################################################################################################
+# CACHE KEYS
+###################################################################################################
+
+def get_cache_key(fn, params):
+    """
+    Creates the key of a cache entry from the filename of an image and a set of
+    parameters (e.g., settings) that affect the cached result. The size and the
+    modification time of the image files and CACHE_VERSION are hashed with the
+    parameters, so that the entry is not used once the image has been downloaded
+    again or the processing has changed.
+
+    Arguments:
+    -----------
+    fn: str or list of str
+        filename of the .TIF file(s) containing the image, the entry is named
+        after the first file
+    params: tuple
+        parameters that the cached result depends on, they are hashed into the key
+
+    Returns:
+    -----------
+    key: str
+        name of the cache entry
+
+    """
+
+    if not isinstance(fn, list):
+        fn = [fn]
+    # state of the image files
+    files = []
+    for fname in fn:
+        stat = os.stat(fname)
+        files.append((os.path.basename(fname), stat.st_size, stat.st_mtime_ns))
+    # use the filename without extension and a short hash of the parameters
+    fn_base = os.path.splitext(os.path.basename(fn[0]))[0]
+    params_hash = hashlib.md5(repr((CACHE_VERSION, files, params)).encode('utf-8')).hexdigest()[:12]
+
+    return '%s_%s'%(fn_base, params_hash)
+
+###################################################################################################
+# READ/WRITE CACHE ENTRIES
+###################################################################################################
+
+def load_entry(cache_dir, key, names):
+    """
+    Loads a cache entry. The arrays are memory-mapped (copy-on-write) and the
+    masks are unpacked into boolean arrays. The modification time of the entry is
+    updated so that it is the last to be evicted.
+    An entry that cannot be read or that does not contain all the arrays (e.g., it
+    was only partly deleted) is treated as missing and removed.
+
+    Arguments:
+    -----------
+    cache_dir: str
+        directory where the cache entries are stored
+    key: str
+        name of the cache entry
+    names: list of str
+        names of the arrays and masks that the entry must contain
+
+    Returns:
+    -----------
+    entry: dict or None
+        contains the cached arrays and masks, None if the entry is not in the cache
+
+    """
+
+    fp_entry = os.path.join(cache_dir, key)
+    if not os.path.exists(fp_entry):
+        return None
+    try:
+        entry = dict([])
+        for fname in os.listdir(fp_entry):
+            if fname.endswith('.npy'):
+                entry[fname[:-4]] = np.load(os.path.join(fp_entry, fname), mmap_mode='c')
+        # unpack the boolean masks
+        fn_masks = os.path.join(fp_entry, 'masks.npz')
+        if os.path.exists(fn_masks):
+            with np.load(fn_masks) as masks:
+                for name in masks.files:
+                    if name.endswith('_shape'):
+                        continue
+                    shape = tuple(masks[name + '_shape'])
+                    mask = np.unpackbits(masks[name], count=int(np.prod(shape)))
+                    entry[name] = mask.reshape(shape).astype(bool)
+        # mark as recently used
+        os.utime(fp_entry)
+    except (OSError, ValueError, KeyError):
+        # the entry may have been evicted or be incomplete
+        entry = None
+    if entry is None or not all([_ in entry for _ in names]):
+        shutil.rmtree(fp_entry, ignore_errors=True)
+        return None
+
+    return entry
+
+def save_entry(cache_dir, key, arrays, masks, max_size):
+    """
+    Saves a cache entry and evicts the least recently used entries if the cache
+    becomes larger than max_size.
+
+    Arguments:
+    -----------
+    cache_dir: str
+        directory where the cache entries are stored
+    key: str
+        name of the cache entry
+    arrays: dict
+        arrays to be stored as .npy files (memory-mapped when loaded)
+    masks: dict
+        boolean arrays to be stored bit-packed and compressed
+    max_size: float
+        maximum size of the cache in MB
+
+    Returns:
+    -----------
+    Stores the entry in cache_dir/key
+
+    """
+
+    fp_entry = os.path.join(cache_dir, key)
+    if os.path.exists(fp_entry):
+        return
+    # write into a temporary folder first and rename it once it is complete,
+    # so that other processes never read a partially written entry
+    fp_tmp = os.path.join(cache_dir, '.tmp_%s_%s'%(key, uuid.uuid4().hex))
+    os.makedirs(fp_tmp)
+    for name in arrays.keys():
+        np.save(os.path.join(fp_tmp, name + '.npy'), np.asarray(arrays[name]))
+    if len(masks) > 0:
+        masks_packed = dict([])
+        for name in masks.keys():
+            masks_packed[name] = np.packbits(np.asarray(masks[name], dtype=bool), axis=None)
+            masks_packed[name + '_shape'] = np.array(masks[name].shape)
+        np.savez_compressed(os.path.join(fp_tmp, 'masks.npz'), **masks_packed)
+    try:
+        os.rename(fp_tmp, fp_entry)
+    except OSError:
+        # another process stored the same entry in the meantime
+        shutil.rmtree(fp_tmp, ignore_errors=True)
+        return
+
+    evict_entries(cache_dir, max_size)
+
+def evict_entries(cache_dir, max_size):
+    """
+    Removes the least recently used entries until the cache is smaller than max_size.
+
+    Arguments:
+    -----------
+    cache_dir: str
+        directory where the cache entries are stored
+    max_size: float
+        maximum size of the cache in MB
+
+    Returns:
+    -----------
+    Deletes the evicted entries from cache_dir
+
+    """
+
+    entries = []
+    total_size = 0
+    for key in os.listdir(cache_dir):
+        fp_entry = os.path.join(cache_dir, key)
+        if key.startswith('.tmp_') or not os.path.isdir(fp_entry):
+            continue
+        try:
+            size = sum([os.path.getsize(os.path.join(fp_entry, _)) for _ in os.listdir(fp_entry)])
+            entries.append((os.path.getmtime(fp_entry), size, fp_entry))
+        except OSError:
+            continue
+        total_size += size
+    # remove the oldest entries first
+    for mtime, size, fp_entry in sorted(entries):
+        if total_size <= max_size*1e6:
+            break
+        shutil.rmtree(fp_entry, ignore_errors=True)
+        total_size -= size
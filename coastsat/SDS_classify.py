@@ -25,7 +25,7 @@ from sklearn.metrics import confusion_matrix
 np.set_printoptions(precision=2)
 
 # CoastSat modules
-from coastsat import SDS_preprocess, SDS_shoreline, SDS_tools
+from coastsat import SDS_preprocess, SDS_shoreline, SDS_tools, SDS_models
 
 class SelectFromImage(object):
     """
@@ -119,6 +119,12 @@ def label_images(metadata,settings):
         for i in range(len(filenames)):
             # image filename
             fn = SDS_tools.get_filenames(filenames[i],filepath, satname)
+            # check the cloud cover on the QA band before loading the multispectral bands
+            cloud_cover_combined, cloud_cover = SDS_preprocess.check_cloud_cover(fn, satname,
+                                                                                 settings['cloud_mask_issue'],
+                                                                                 collection)
+            if cloud_cover_combined > 0.99 or cloud_cover > settings['cloud_thresh']:
+                continue
             # read and preprocess image
             im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = SDS_preprocess.preprocess_single(fn, satname, 
                                                                                                      settings['cloud_mask_issue'],
@@ -505,8 +511,10 @@ def evaluate_classifier(classifier, metadata, settings):
 
     Arguments:
     -----------
-    classifier: joblib object
-        classifier model to be used for image classification
+    classifier: dict, joblib object or None
+        classifier model to be used for image classification, if None the
+        classifier of each satellite is taken from the model registry (shared
+        with SDS_shoreline.extract_shorelines)
     metadata: dict
         contains all the information about the satellite images that were downloaded
     settings: dict with the following keys
@@ -557,8 +565,12 @@ def evaluate_classifier(classifier, metadata, settings):
         filepath = SDS_tools.get_filepath(settings['inputs'],satname)
         filenames = metadata[satname]['filenames']
         
-        # load classifiers and
-        if satname in ['L5','L7','L8']:
+        # load classifiers (only read once per process) and
+        if classifier is None:
+            clf = SDS_models.get_classifier(satname, settings.get('sand_color', 'default'))
+        else:
+            clf = classifier
+        if satname in ['L5','L7','L8','L9']:
             pixel_size = 15
         elif satname == 'S2':
             pixel_size = 10
@@ -570,11 +582,15 @@ def evaluate_classifier(classifier, metadata, settings):
         for i in range(len(filenames)):   
             # image filename
             fn = SDS_tools.get_filenames(filenames[i],filepath, satname)
+            # check the cloud cover on the QA band before loading the multispectral bands
+            cloud_cover_combined, cloud_cover = SDS_preprocess.check_cloud_cover(fn, satname,
+                                                                                 settings['cloud_mask_issue'],
+                                                                                 collection)
+            if cloud_cover_combined > 0.99 or cloud_cover > settings['cloud_thresh']:
+                continue
             # read and preprocess image
-            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = SDS_preprocess.preprocess_single(fn, satname, 
-                                                                                                     settings['cloud_mask_issue'],
-                                                                                                     settings['pan_off'],
-                                                                                                     collection)
+            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = SDS_preprocess.preprocess_single_cached(fn, satname,
+                                                                                                            settings)
             image_epsg = metadata[satname]['epsg'][i]
 
             # compute cloud_cover percentage (with no data pixels)
@@ -595,8 +611,8 @@ def evaluate_classifier(classifier, metadata, settings):
             im_ref_buffer = SDS_shoreline.create_shoreline_buffer(cloud_mask.shape, georef, image_epsg,
                                                     pixel_size, settings)
             # classify image in 4 classes (sand, whitewater, water, other) with NN classifier
-            im_classif, im_labels = SDS_shoreline.classify_image_NN(im_ms, im_extra, cloud_mask,
-                                    min_beach_area_pixels, classifier)
+            im_classif, im_labels = SDS_shoreline.classify_image_NN(im_ms, cloud_mask,
+                                    min_beach_area_pixels, clf)
             # there are two options to map the contours:
             # if there are pixels in the 'sand' class --> use find_wl_contours2 (enhanced)
             # otherwise use find_wl_contours2 (traditional)
@@ -609,12 +625,13 @@ def evaluate_classifier(classifier, metadata, settings):
                 else:
                     # use classification to refine threshold and extract the sand/water interface
                     contours_mwi, t_mndwi = SDS_shoreline.find_wl_contours2(im_ms, im_labels,
-                                                cloud_mask, buffer_size_pixels, im_ref_buffer)
+                                                cloud_mask, im_ref_buffer)
             except:
                 print('Could not map shoreline for this image: ' + filenames[i])
                 continue
             # process the water contours into a shoreline
-            shoreline = SDS_shoreline.process_shoreline(contours_mwi, cloud_mask, georef, image_epsg, settings)
+            shoreline = SDS_shoreline.process_shoreline(contours_mwi, cloud_mask, im_nodata,
+                                                        georef, image_epsg, settings)
             try:
                 sl_pix = SDS_tools.convert_world2pix(SDS_tools.convert_epsg(shoreline,
                                                                             settings['output_epsg'],
@@ -0,0 +1,395 @@
+"""
+This module contains the functions used to store the pre-trained pixel classifiers
+(sklearn MLPClassifier) as plain NumPy arrays and to run them without sklearn.
+
+The weights, biases and activations of a pickled classifier are extracted once
+into a compact .npz file (sklearn is only needed for this conversion) and the
+classification is done with a chunked float32 forward pass, which gives the
+same labels as MLPClassifier.predict.
+
+The classifiers are loaded through a process-wide registry (get_classifier), so
+that each model file is only read once per process, however many times
+extract_shorelines is called (e.g., once per polygon of a fishnet).
+"""
+
+# load modules
+import os
+import time
+import hashlib
+import pickle
+import numpy as np
+
+# filenames of the classifiers for each satellite family and sand colour
+MODEL_NAMES = {'Landsat':{'default':'NN_4classes_Landsat',
+                          'dark':'NN_4classes_Landsat_dark',
+                          'bright':'NN_4classes_Landsat_bright',
+                          'latest':'NN_4classes_Landsat_latest'},
+               'S2':{'default':'NN_4classes_S2'}}
+
+# classifiers already loaded in this process and their load-time metrics
+_registry = dict([])
+_metrics = dict([])
+
+###################################################################################################
+# CONVERSION AND LOADING
+###################################################################################################
+
+def convert_model(fn_model, fn_npz):
+    """
+    Extracts the weights, biases and activations of a pickled classifier
+    (MLPClassifier or Pipeline with a StandardScaler and a MLPClassifier) and saves
+    them into a .npz file. This is the only function that needs sklearn.
+
+    Arguments:
+    -----------
+    fn_model: str
+        filename of the pickled classifier (.pkl)
+    fn_npz: str
+        filename of the .npz file to create
+
+    Returns:
+    -----------
+    model: dict
+        the converted model (as returned by load_model)
+
+    """
+
+    import joblib
+    clf = joblib.load(fn_model)
+
+    model = dict([])
+    # if the classifier is a pipeline, extract the scaler and the final estimator
+    if hasattr(clf, 'steps'):
+        for name, step in clf.steps[:-1]:
+            if hasattr(step, 'mean_') and hasattr(step, 'scale_'):
+                model['scaler_mean'] = np.asarray(step.mean_, dtype=np.float64)
+                model['scaler_scale'] = np.asarray(step.scale_, dtype=np.float64)
+            else:
+                raise Exception('step %s of the pipeline cannot be converted'%name)
+        clf = clf.steps[-1][1]
+    model['n_layers'] = np.array(len(clf.coefs_))
+    for k in range(len(clf.coefs_)):
+        model['coef_%d'%k] = np.asarray(clf.coefs_[k], dtype=np.float64)
+        model['intercept_%d'%k] = np.asarray(clf.intercepts_[k], dtype=np.float64)
+    model['activation'] = np.array(clf.activation)
+    model['out_activation'] = np.array(clf.out_activation_)
+    model['classes'] = np.asarray(clf.classes_)
+
+    np.savez_compressed(fn_npz, **model)
+
+    return load_model(fn_npz)
+
+def load_model(fn_npz):
+    """
+    Loads a classifier stored as a .npz file. If the .npz file does not exist,
+    it is created from the pickled classifier with the same name (or the same
+    name ending with _new, for the files trained with recent sklearn versions).
+
+    Arguments:
+    -----------
+    fn_npz: str
+        filename of the .npz file
+
+    Returns:
+    -----------
+    model: dict
+        contains the weights ('coefs') and biases ('intercepts') of each layer,
+        the hidden and output activations, the classes and, if any, the mean and
+        scale of the features
+
+    """
+
+    if not os.path.exists(fn_npz):
+        fn_base = os.path.splitext(fn_npz)[0]
+        for fn_model in [fn_base + '_new.pkl', fn_base + '.pkl']:
+            if os.path.exists(fn_model):
+                return convert_model(fn_model, fn_npz)
+        raise Exception('could not find the classifier %s'%fn_npz)
+
+    with np.load(fn_npz) as data:
+        n_layers = int(data['n_layers'])
+        model = {'coefs':[data['coef_%d'%k] for k in range(n_layers)],
+                 'intercepts':[data['intercept_%d'%k] for k in range(n_layers)],
+                 'activation':str(data['activation']),
+                 'out_activation':str(data['out_activation']),
+                 'classes':data['classes']}
+        if 'scaler_mean' in data.files:
+            model['scaler_mean'] = data['scaler_mean']
+            model['scaler_scale'] = data['scaler_scale']
+    # float32 copies of the weights for the forward pass, the weights of the dead neurons
+    # (smaller than 1e-20, negligible in float32) are set to 0 as they are either denormal
+    # numbers or give denormal products with the features, which make the matrix
+    # products much slower
+    tiny = 1e-20
+    model['coefs32'] = [np.where(np.abs(_) < tiny, 0, _).astype(np.float32) for _ in model['coefs']]
+    model['intercepts32'] = [np.where(np.abs(_) < tiny, 0, _).astype(np.float32) for _ in model['intercepts']]
+
+    return model
+
+###################################################################################################
+# INFERENCE
+###################################################################################################
+
+def forward(model, features, dtype=np.float32):
+    """
+    Forward pass of the neural network, returns the values of the output layer
+    before the output activation (the classes are given by the largest value).
+
+    Arguments:
+    -----------
+    model: dict
+        classifier loaded with load_model
+    features: np.array
+        2D array with the features of each pixel (rows)
+    dtype: data-type
+        np.float32 (fast) or np.float64 (same precision as sklearn)
+
+    Returns:
+    -----------
+    out: np.array
+        2D array with the values of the output layer
+
+    """
+
+    if dtype == np.float32:
+        coefs, intercepts = model['coefs32'], model['intercepts32']
+    else:
+        coefs, intercepts = model['coefs'], model['intercepts']
+    out = features.astype(dtype)
+    if 'scaler_mean' in model:
+        out = (out - model['scaler_mean'].astype(dtype))/model['scaler_scale'].astype(dtype)
+    for k in range(len(coefs)):
+        out = np.dot(out, coefs[k])
+        out += intercepts[k]
+        # hidden layers activation
+        if k < len(coefs) - 1:
+            if model['activation'] == 'relu':
+                np.maximum(out, 0, out=out)
+            elif model['activation'] == 'tanh':
+                np.tanh(out, out=out)
+            elif model['activation'] == 'logistic':
+                out = 1/(1 + np.exp(-out))
+            elif not model['activation'] == 'identity':
+                raise Exception('activation %s is not supported'%model['activation'])
+
+    return out
+
+def predict(model, features, chunk_size=5000, tol=1e-3):
+    """
+    Predicts the class of each pixel with a float32 forward pass, streamed over
+    chunks of pixels to cap the memory usage. The pixels for which the two largest
+    outputs are closer than tol are recomputed in float64, so that the labels are
+    identical to the ones predicted by sklearn.
+    Classifiers that were not converted (e.g., sklearn objects) are also accepted,
+    in which case their predict method is used.
+
+    Arguments:
+    -----------
+    model: dict
+        classifier loaded with load_model
+    features: np.array
+        2D array with the features of each pixel (rows)
+    chunk_size: int
+        number of pixels classified at once
+    tol: float
+        minimum difference between the two largest outputs for a float32 result
+        to be accepted
+
+    Returns:
+    -----------
+    labels: np.array
+        class of each pixel
+
+    """
+
+    # sklearn classifier
+    if not isinstance(model, dict):
+        return model.predict(features)
+
+    classes = model['classes']
+    labels = np.empty(features.shape[0], dtype=classes.dtype)
+    for i in range(0, features.shape[0], chunk_size):
+        chunk = features[i:i+chunk_size,:]
+        out = forward(model, chunk, np.float32)
+        # binary classifier with a single (logistic) output
+        if out.shape[1] == 1:
+            margin = np.abs(out[:,0])
+            idx = (out[:,0] > 0).astype(int)
+        else:
+            idx = np.argmax(out, axis=1)
+            out_sorted = np.partition(out, out.shape[1]-2, axis=1)
+            margin = out_sorted[:,-1] - out_sorted[:,-2]
+        # recompute the uncertain pixels in float64
+        idx_check = np.where(margin < tol*(1 + np.max(np.abs(out), axis=1)))[0]
+        if len(idx_check) > 0:
+            out = forward(model, chunk[idx_check,:], np.float64)
+            if out.shape[1] == 1:
+                idx[idx_check] = (out[:,0] > 0).astype(int)
+            else:
+                idx[idx_check] = np.argmax(out, axis=1)
+        labels[i:i+chunk_size] = classes[idx]
+
+    return labels
+
+###################################################################################################
+# MODEL REGISTRY
+###################################################################################################
+
+def get_model_key(satname, sand_color='default', suffix=None, filepath_models=None):
+    """
+    Returns the key of a classifier in the registry. Landsat 5, 7, 8 and 9 share
+    the same classifiers, which depend on the sand colour, while Sentinel-2 has a
+    single classifier. The folder of the classifiers is part of the key, so that
+    classifiers with the same name in different folders are not mixed up.
+
+    Arguments:
+    -----------
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    sand_color: str
+        'default', 'dark', 'bright' or 'latest' (only used for Landsat)
+    suffix: str or None
+        None to use the converted .npz classifier, otherwise the suffix of the
+        pickled sklearn classifier to load ('' or '_new', depending on the version
+        of sklearn it was trained with)
+    filepath_models: str
+        folder containing the classifiers, by default ./classification/models
+
+    Returns:
+    -----------
+    key: tuple
+        (satellite family, sand colour, suffix, absolute path of the folder)
+
+    """
+
+    if satname in ['L5','L7','L8','L9']:
+        family = 'Landsat'
+    elif satname == 'S2':
+        family = 'S2'
+        sand_color = 'default'
+    else:
+        raise Exception('there is no classifier for the satellite %s'%satname)
+    if not sand_color in MODEL_NAMES[family]:
+        raise Exception('sand_color should be one of %s, not %s'%(list(MODEL_NAMES[family].keys()), sand_color))
+    if filepath_models is None:
+        filepath_models = os.path.join(os.getcwd(), 'classification', 'models')
+
+    return (family, sand_color, suffix, os.path.abspath(filepath_models))
+
+def get_classifier(satname, sand_color='default', filepath_models=None, suffix=None, mmap=False):
+    """
+    Returns the classifier for a satellite and sand colour. The classifier is loaded
+    from disk the first time it is requested and then kept in memory, so that all
+    the calls in the same process share the same model.
+
+    Arguments:
+    -----------
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    sand_color: str
+        'default', 'dark', 'bright' or 'latest' (only used for Landsat)
+    filepath_models: str
+        folder containing the classifiers, by default ./classification/models
+    suffix: str or None
+        None to use the converted .npz classifier (recommended), otherwise the
+        suffix of the pickled sklearn classifier to load ('' or '_new')
+    mmap: bool
+        if True, the arrays of a pickled classifier are memory-mapped instead of
+        being read into memory (the .npz classifiers are small and always read)
+
+    Returns:
+    -----------
+    clf: dict or joblib object
+        the classifier
+
+    """
+
+    key = get_model_key(satname, sand_color, suffix, filepath_models)
+    if key in _registry:
+        _metrics[key]['hits'] += 1
+        return _registry[key]
+
+    fn_base = os.path.join(key[3], MODEL_NAMES[key[0]][key[1]])
+    t0 = time.perf_counter()
+    if suffix is None:
+        fn = fn_base + '.npz'
+        clf = load_model(fn)
+    else:
+        import joblib
+        fn = fn_base + suffix + '.pkl'
+        clf = joblib.load(fn, mmap_mode='r' if mmap else None)
+    _metrics[key] = {'filename':fn,
+                     'load_time':time.perf_counter() - t0,
+                     'hits':0}
+    _registry[key] = clf
+
+    return clf
+
+def get_model_hash(clf):
+    """
+    Returns a hash of the parameters of a classifier, used to identify the results
+    that were obtained with it (e.g., cached classifications).
+
+    Arguments:
+    -----------
+    clf: dict or joblib object
+        the classifier
+
+    Returns:
+    -----------
+    model_hash: str
+        md5 hash of the weights, biases, activations and classes (or of the pickled
+        classifier if it was not converted)
+
+    """
+
+    md5 = hashlib.md5()
+    if isinstance(clf, dict):
+        for k in range(len(clf['coefs'])):
+            md5.update(np.ascontiguousarray(clf['coefs'][k]).tobytes())
+            md5.update(np.ascontiguousarray(clf['intercepts'][k]).tobytes())
+        for key in ['scaler_mean', 'scaler_scale', 'classes']:
+            if key in clf:
+                md5.update(np.ascontiguousarray(clf[key]).tobytes())
+        md5.update((clf['activation'] + clf['out_activation']).encode('utf-8'))
+    else:
+        md5.update(pickle.dumps(clf))
+
+    return md5.hexdigest()
+
+def get_metrics():
+    """
+    Returns the load-time metrics of the classifiers loaded in this process.
+
+    Arguments:
+    -----------
+    None
+
+    Returns:
+    -----------
+    metrics: dict
+        for each key of the registry (satellite family, sand colour, suffix, folder),
+        the filename of the classifier, the time it took to load (in seconds) and the
+        number of times it was reused from memory ('hits')
+
+    """
+
+    return dict([(key, dict(_metrics[key])) for key in _metrics.keys()])
+
+def clear_registry():
+    """
+    Removes all the classifiers from the registry (e.g., after the model files
+    have been updated), they are loaded again at the next request.
+
+    Arguments:
+    -----------
+    None
+
+    Returns:
+    -----------
+    Empties the registry and the metrics
+
+    """
+
+    _registry.clear()
+    _metrics.clear()
@@ -0,0 +1,162 @@
+"""
+This module contains a columnar container for the output of extract_shorelines,
+which stores the attributes of the shorelines as NumPy arrays instead of lists.
+
+The coordinates of all the shorelines are stored in a single (n_points x 2) array
+with the offsets of the first and last+1 point of each shoreline (shoreline i is
+coords[starts[i]:ends[i]]), so that a time-series of thousands of shorelines is a
+handful of arrays that can be filtered with a boolean mask and sliced without
+copying the coordinates.
+"""
+
+# load modules
+import numpy as np
+import pytz
+from datetime import datetime
+
+class ShorelineOutput(object):
+    """
+    Columnar container for the mapped shorelines, with the methods:
+        - from_dict / to_dict: conversion from/to the output dictionnary
+        - shoreline: coordinates of one shoreline (view of the coordinates buffer)
+        - filter: keeps the shorelines selected by a boolean mask
+        - take: keeps the shorelines at the given indices
+        - slicing with [start:stop:step]: subset of the shorelines
+        - compact: copies the coordinates that are used into a new buffer
+    Filtering and slicing never copy the coordinates, the new container shares the
+    buffer of the original one.
+    The scalar attributes are accessed as columns (e.g., out['cloud_cover']) and the
+    dates are stored as datetime64[us] in UTC.
+    """
+    # initialize the container from its arrays
+    def __init__(self, columns, coords, starts, ends, tz_aware=True):
+        self.columns = columns
+        self.coords = coords
+        self.starts = starts
+        self.ends = ends
+        self.tz_aware = tz_aware
+
+    @classmethod
+    def from_dict(cls, output):
+        """
+        Creates the container from the output dictionnary of extract_shorelines
+        (after merge_output), the coordinates of the shorelines are concatenated.
+        """
+        dates = output['dates']
+        tz_aware = len(dates) > 0 and dates[0].tzinfo is not None
+        # convert the dates to UTC and store them as datetime64
+        if tz_aware:
+            dates = [_.astimezone(pytz.utc).replace(tzinfo=None) for _ in dates]
+        columns = {'dates':np.array(dates, dtype='datetime64[us]')}
+        for key in output.keys():
+            if key in ['dates', 'shorelines']:
+                continue
+            columns[key] = np.asarray(output[key])
+            # keep mixed numbers and strings as objects (NumPy would convert all to strings)
+            if columns[key].dtype.kind == 'U' and not all([isinstance(_, str) for _ in output[key]]):
+                columns[key] = np.array(output[key], dtype=object)
+        # concatenate the shorelines (empty shorelines have 0 points)
+        shorelines = [np.asarray(_, dtype=float).reshape(-1,2) for _ in output['shorelines']]
+        lengths = np.array([len(_) for _ in shorelines], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        if len(shorelines) > 0:
+            coords = np.concatenate(shorelines, axis=0)
+        else:
+            coords = np.zeros((0,2))
+
+        return cls(columns, coords, ends - lengths, ends, tz_aware)
+
+    def to_dict(self):
+        """
+        Converts the container back into an output dictionnary (lists of datetimes,
+        arrays and Python scalars), the shorelines are copied out of the buffer.
+        """
+        output = dict([])
+        dates = self.columns['dates'].astype(datetime)
+        if self.tz_aware:
+            dates = [pytz.utc.localize(_) for _ in dates]
+        output['dates'] = list(dates)
+        output['shorelines'] = [np.array(self.shoreline(i)) for i in range(len(self))]
+        for key in self.columns.keys():
+            if key == 'dates':
+                continue
+            output[key] = self.columns[key].tolist()
+
+        return output
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, key):
+        # column of scalar attributes
+        if isinstance(key, str):
+            return self.columns[key]
+        # subset of the shorelines: the columns and offsets are views, the coordinates are shared
+        if isinstance(key, slice):
+            columns = dict([(k, self.columns[k][key]) for k in self.columns.keys()])
+            return ShorelineOutput(columns, self.coords, self.starts[key], self.ends[key],
+                                   self.tz_aware)
+        raise Exception('a ShorelineOutput can only be indexed by a column name or a slice')
+
+    def shoreline(self, i):
+        """
+        Returns the coordinates of shoreline i (view of the coordinates buffer).
+        """
+        return self.coords[self.starts[i]:self.ends[i]]
+
+    def lengths(self):
+        """
+        Returns the number of points of each shoreline.
+        """
+        return self.ends - self.starts
+
+    def filter(self, mask):
+        """
+        Returns a new container with the shorelines for which mask is True, only the
+        columns and offsets are selected (linear in the number of shorelines).
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if not len(mask) == len(self):
+            raise Exception('the mask has %d elements for %d shorelines'%(len(mask), len(self)))
+        columns = dict([(k, self.columns[k][mask]) for k in self.columns.keys()])
+
+        return ShorelineOutput(columns, self.coords, self.starts[mask], self.ends[mask],
+                               self.tz_aware)
+
+    def take(self, idx):
+        """
+        Returns a new container with the shorelines at the indices idx (in this order).
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        columns = dict([(k, self.columns[k][idx]) for k in self.columns.keys()])
+
+        return ShorelineOutput(columns, self.coords, self.starts[idx], self.ends[idx],
+                               self.tz_aware)
+
+    def compact(self):
+        """
+        Returns a copy of the container with only the coordinates of its shorelines,
+        stored in order (e.g., to release the buffer of a larger container).
+        """
+        lengths = self.lengths()
+        ends = np.cumsum(lengths)
+        # index of each point in the coordinates buffer
+        idx_points = np.repeat(self.starts - (ends - lengths), lengths) + np.arange(np.sum(lengths))
+        columns = dict([(k, self.columns[k].copy()) for k in self.columns.keys()])
+
+        return ShorelineOutput(columns, self.coords[idx_points], ends - lengths, ends,
+                               self.tz_aware)
+
+    def nbytes(self):
+        """
+        Returns the memory used by the arrays of the container (in bytes), including
+        the whole coordinates buffer.
+        """
+        nbytes = self.coords.nbytes + self.starts.nbytes + self.ends.nbytes
+        for key in self.columns.keys():
+            nbytes += self.columns[key].nbytes
+            # strings stored as Python objects
+            if self.columns[key].dtype == object:
+                nbytes += sum([len(str(_)) for _ in self.columns[key]])
+
+        return nbytes
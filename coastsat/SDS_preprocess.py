@@ -15,7 +15,6 @@ import pdb
 # image processing modules
 import skimage.transform as transform
 import skimage.morphology as morphology
-import sklearn.decomposition as decomposition
 import skimage.exposure as exposure
 from skimage.io import imsave
 from skimage import img_as_ubyte
@@ -28,12 +27,27 @@ import pickle
 import geopandas as gpd
 from shapely import geometry
 import re
+import concurrent.futures
 
 # CoastSat modules
-from coastsat import SDS_tools
+from coastsat import SDS_tools, SDS_cache
 
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
+# multispectral bands that are pansharpened for each Landsat mission
+PANSHARPEN_BANDS = {'L7':[1,2,3], 'L8':[0,1,2], 'L9':[0,1,2]}
+# approximate memory used per pixel to preprocess and classify a window (in bytes)
+WINDOW_BYTES_PER_PIXEL = 1000
+# smallest window (in rows) used to preprocess and classify an image
+MIN_WINDOW_ROWS = 32
+# number of cloud-free pixels sampled to fit the pansharpening model (default of pansharpen)
+PANSHARPEN_SAMPLES = 1000000
+# approximate memory used per sampled pixel to fit the pansharpening model (in bytes)
+PANSHARPEN_BYTES_PER_SAMPLE = 100
+# approximate memory used per pixel of the image to map the contours on the stitched
+# image (bands, classification, masks, spectral indices and temporary arrays, in bytes)
+CONTOUR_BYTES_PER_PIXEL = 120
+
 # Main function to preprocess a satellite image (L5, L7, L8, L9 or S2)
 def preprocess_single(fn, satname, cloud_mask_issue, pan_off, collection):
     """
@@ -79,17 +93,8 @@ def preprocess_single(fn, satname, cloud_mask_issue, pan_off, collection):
 
     """
     
-    if isinstance(fn, list):
-        fn_to_split=fn[0]
-    elif isinstance(fn, str):
-        fn_to_split=fn
-    # split by os.sep and only get the filename at the end then split again to remove file extension
-    fn_to_split=fn_to_split.split(os.sep)[-1].split('.')[0]
-    # search for the year the tif was taken with regex and convert to int
-    year = int(re.search('[0-9]+',fn_to_split).group(0))
     # after 2022 everything is automatically from Collection 2
-    if collection == 'C01' and year >= 2022:
-        collection = 'C02'
+    collection = get_collection(fn, collection)
         
     #=============================================================================================#
     # L5 images
@@ -99,29 +104,13 @@ def preprocess_single(fn, satname, cloud_mask_issue, pan_off, collection):
         fn_ms = fn[0]
         fn_mask = fn[1]
         # read ms bands
-        data = gdal.Open(fn_ms, gdal.GA_ReadOnly)
-        georef = np.array(data.GetGeoTransform())
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_ms = np.stack(bands, 2)
+        im_ms, georef = read_bands(fn_ms)
         # read cloud mask
-        data = gdal.Open(fn_mask, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_QA = bands[0]
+        im_QA = read_bands(fn_mask)[0][:,:,0]
         cloud_mask = create_cloud_mask(im_QA, satname, cloud_mask_issue, collection)
 
         # check if -inf or nan values on any band and eventually add those pixels to cloud mask
-        im_nodata = np.zeros(cloud_mask.shape).astype(bool)
-        for k in range(im_ms.shape[2]):
-            im_inf = np.isin(im_ms[:,:,k], -np.inf)
-            im_nan = np.isnan(im_ms[:,:,k])
-            im_nodata = np.logical_or(np.logical_or(im_nodata, im_inf), im_nan)
-        # check if there are pixels with 0 intensity in the Green, NIR and SWIR bands and add those
-        # to the cloud mask as otherwise they will cause errors when calculating the NDWI and MNDWI
-        im_zeros = np.ones(cloud_mask.shape).astype(bool)
-        for k in [1,3,4]: # loop through the Green, NIR and SWIR bands
-            im_zeros = np.logical_and(np.isin(im_ms[:,:,k],0), im_zeros)
-        # add zeros to im nodata
-        im_nodata = np.logical_or(im_zeros, im_nodata)
+        im_nodata = get_nodata_mask(im_ms)
         # update cloud mask with all the nodata pixels
         cloud_mask = np.logical_or(cloud_mask, im_nodata)
 
@@ -137,28 +126,12 @@ def preprocess_single(fn, satname, cloud_mask_issue, pan_off, collection):
         fn_pan = fn[1]  
         fn_mask = fn[2]  
         # read ms bands
-        data = gdal.Open(fn_ms, gdal.GA_ReadOnly)
-        georef = np.array(data.GetGeoTransform())
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_ms = np.stack(bands, 2)
+        im_ms, georef = read_bands(fn_ms)
         # read cloud mask
-        data = gdal.Open(fn_mask, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_QA = bands[0]
+        im_QA = read_bands(fn_mask)[0][:,:,0]
         cloud_mask = create_cloud_mask(im_QA, satname, cloud_mask_issue, collection)
         # check if -inf or nan values on any band and eventually add those pixels to cloud mask
-        im_nodata = np.zeros(cloud_mask.shape).astype(bool)
-        for k in range(im_ms.shape[2]):
-            im_inf = np.isin(im_ms[:,:,k], -np.inf)
-            im_nan = np.isnan(im_ms[:,:,k])
-            im_nodata = np.logical_or(np.logical_or(im_nodata, im_inf), im_nan)
-        # check if there are pixels with 0 intensity in the Green, NIR and SWIR bands and add those
-        # to the cloud mask as otherwise they will cause errors when calculating the NDWI and MNDWI
-        im_zeros = np.ones(cloud_mask.shape).astype(bool)
-        for k in [1,3,4]: # loop through the Green, NIR and SWIR bands
-            im_zeros = np.logical_and(np.isin(im_ms[:,:,k],0), im_zeros)
-        # add zeros to im nodata
-        im_nodata = np.logical_or(im_zeros, im_nodata)
+        im_nodata = get_nodata_mask(im_ms)
         # update cloud mask with all the nodata pixels
         cloud_mask = np.logical_or(cloud_mask, im_nodata) 
         
@@ -170,37 +143,21 @@ def preprocess_single(fn, satname, cloud_mask_issue, pan_off, collection):
         # otherwise perform panchromatic sharpening
         else:
             # read panchromatic band
-            data = gdal.Open(fn_pan, gdal.GA_ReadOnly)
-            georef = np.array(data.GetGeoTransform())
-            bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-            im_pan = bands[0]
-           
-            # pansharpen Green, Blue, NIR for Landsat 7
-            if satname == 'L7':
-                try:
-                    im_ms_ps = pansharpen(im_ms[:,:,[1,2,3]], im_pan, cloud_mask)
-                except: # if pansharpening fails, keep downsampled bands (for long runs)
-                    print('\npansharpening of image %s failed.'%fn[0])
-                    im_ms_ps = im_ms[:,:,[1,2,3]]
-                # add downsampled Blue and SWIR1 bands
-                im_ms_ps = np.append(im_ms[:,:,[0]], im_ms_ps, axis=2)
-                im_ms_ps = np.append(im_ms_ps, im_ms[:,:,[4]], axis=2)
-                im_ms = im_ms_ps.copy()
-                # the extra image is the 15m panchromatic band
-                im_extra = im_pan
-                
-            # pansharpen Blue, Green, Red for Landsat 8 and 9           
-            elif satname in ['L8','L9']:
-                try:
-                    im_ms_ps = pansharpen(im_ms[:,:,[0,1,2]], im_pan, cloud_mask)
-                except: # if pansharpening fails, keep downsampled bands (for long runs)
-                    print('\npansharpening of image %s failed.'%fn[0])
-                    im_ms_ps = im_ms[:,:,[0,1,2]]
-                # add downsampled NIR and SWIR1 bands
-                im_ms_ps = np.append(im_ms_ps, im_ms[:,:,[3,4]], axis=2)
-                im_ms = im_ms_ps.copy()
-                # the extra image is the 15m panchromatic band
-                im_extra = im_pan
+            im_pan, georef = read_bands(fn_pan)
+            im_pan = im_pan[:,:,0]
+            # make sure the bands can hold the pansharpened (float) values
+            if not np.issubdtype(im_ms.dtype, np.floating):
+                im_ms = im_ms.astype(np.float32)
+
+            # pansharpen Green, Blue, NIR for Landsat 7 (Blue and SWIR1 stay downsampled)
+            # and Blue, Green, Red for Landsat 8 and 9 (NIR and SWIR1 stay downsampled)
+            idx_ps = PANSHARPEN_BANDS[satname]
+            try:
+                im_ms[:,:,idx_ps] = pansharpen(im_ms[:,:,idx_ps], im_pan, cloud_mask)
+            except: # if pansharpening fails, keep downsampled bands (for long runs)
+                print('\npansharpening of image %s failed.'%fn[0])
+            # the extra image is the 15m panchromatic band
+            im_extra = im_pan
                 
     #=============================================================================================#
     # S2 images
@@ -208,10 +165,7 @@ def preprocess_single(fn, satname, cloud_mask_issue, pan_off, collection):
     if satname == 'S2':
         # read 10m bands (R,G,B,NIR)
         fn_ms = fn[0]
-        data = gdal.Open(fn_ms, gdal.GA_ReadOnly)
-        georef = np.array(data.GetGeoTransform())
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_ms = np.stack(bands, 2)
+        im_ms, georef = read_bands(fn_ms)
         im_ms = im_ms/10000 # TOA scaled to 10000
 
         # image size
@@ -227,35 +181,18 @@ def preprocess_single(fn, satname, cloud_mask_issue, pan_off, collection):
 
         # read 20m band (SWIR1)
         fn_swir = fn[1]
-        data = gdal.Open(fn_swir, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_swir = bands[0]
+        im_swir = read_bands(fn_swir)[0][:,:,[0]]
         im_swir = im_swir/10000 # TOA scaled to 10000
-        im_swir = np.expand_dims(im_swir, axis=2)
 
         # append down-sampled SWIR1 band to the other 10m bands
         im_ms = np.append(im_ms, im_swir, axis=2)
 
         # create cloud mask using 60m QA band (not as good as Landsat cloud cover)
         fn_mask = fn[2]
-        data = gdal.Open(fn_mask, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_QA = bands[0]
+        im_QA = read_bands(fn_mask)[0][:,:,0]
         cloud_mask = create_cloud_mask(im_QA, satname, cloud_mask_issue, collection)
         # check if -inf or nan values on any band and create nodata image
-        im_nodata = np.zeros(cloud_mask.shape).astype(bool)
-        for k in range(im_ms.shape[2]):
-            im_inf = np.isin(im_ms[:,:,k], -np.inf)
-            im_nan = np.isnan(im_ms[:,:,k])
-            im_nodata = np.logical_or(np.logical_or(im_nodata, im_inf), im_nan)
-        # check if there are pixels with 0 intensity in the Green, NIR and SWIR bands and add those
-        # to the cloud mask as otherwise they will cause errors when calculating the NDWI and MNDWI
-        im_zeros = np.ones(im_nodata.shape).astype(bool)
-        im_zeros = np.logical_and(np.isin(im_ms[:,:,1],0), im_zeros) # Green
-        im_zeros = np.logical_and(np.isin(im_ms[:,:,3],0), im_zeros) # NIR
-        im_zeros = np.logical_and(np.isin(im_ms[:,:,4],0), im_zeros) # SWIR
-        # add to im_nodata
-        im_nodata = np.logical_or(im_zeros, im_nodata)
+        im_nodata = get_nodata_mask(im_ms)
         # dilate if image was merged as there could be issues at the edges
         if 'merged' in fn_ms:
             im_nodata = morphology.dilation(im_nodata,morphology.square(5))
@@ -268,10 +205,456 @@ def preprocess_single(fn, satname, cloud_mask_issue, pan_off, collection):
 
     return im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata
 
+def preprocess_single_cached(fn, satname, settings):
+    """
+    Same as preprocess_single but the preprocessed image is stored in an on-disk
+    cache, so that the next functions reading the same image (e.g., extract_shorelines
+    and then save_jpg) do not have to preprocess it again.
+    The cache is only used if settings['preprocess_cache'] is True, otherwise this
+    function simply calls preprocess_single.
+
+    Arguments:
+    -----------
+    fn: str or list of str
+        filename of the .TIF file containing the image, as for preprocess_single
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    settings: dict with the following keys
+        'inputs': dict
+            input parameters (sitename, filepath, polygon, dates, sat_list, landsat_collection)
+        'cloud_mask_issue': boolean
+            True if there is an issue with the cloud mask and sand pixels
+            are erroneously being masked on the images
+        'pan_off': boolean
+            if True, disable panchromatic sharpening and ignore pan band
+        'preprocess_cache': boolean (optional)
+            if True, the preprocessed images are cached
+        'cache_dir': str (optional)
+            directory of the cache, by default a folder named cache in the data folder
+        'cache_size': float (optional)
+            maximum size of the cache in MB, the least recently used images are
+            evicted first (default 2000 MB)
+
+    Returns:
+    -----------
+    Same outputs as preprocess_single. When the image is read from the cache,
+    im_ms is memory-mapped and im_extra and im_QA are empty (they are not cached).
+
+    """
+
+    collection = settings['inputs']['landsat_collection']
+    if not settings.get('preprocess_cache', False):
+        return preprocess_single(fn, satname, settings['cloud_mask_issue'], settings['pan_off'],
+                                 collection)
+
+    cache_dir = settings.get('cache_dir', os.path.join(settings['inputs']['filepath'], 'cache'))
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    # the key depends on the filename and on the settings used to preprocess the image
+    key = SDS_cache.get_cache_key(fn, ('preprocess', satname, settings['cloud_mask_issue'],
+                                       settings['pan_off'], collection))
+    entry = SDS_cache.load_entry(cache_dir, key, ['im_ms', 'georef', 'cloud_mask', 'im_nodata'])
+    if entry is not None:
+        return entry['im_ms'], entry['georef'], entry['cloud_mask'], [], [], entry['im_nodata']
+
+    # if not in the cache, preprocess the image and store it
+    im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = preprocess_single(fn, satname,
+                                                                              settings['cloud_mask_issue'],
+                                                                              settings['pan_off'],
+                                                                              collection)
+    # empty images (S2 images full of zeros) are not cached
+    if len(im_ms) > 0:
+        SDS_cache.save_entry(cache_dir, key, {'im_ms':im_ms, 'georef':georef},
+                             {'cloud_mask':cloud_mask, 'im_nodata':im_nodata},
+                             settings.get('cache_size', 2000))
+
+    return im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata
+
+def check_cloud_cover(fn, satname, cloud_mask_issue, collection):
+    """
+    Computes a lower bound of the cloud cover of an image by reading only the QA
+    band and the Green band (used to find the no data pixels). This is much cheaper
+    than preprocess_single and allows to reject the cloudy images before loading all
+    the multispectral bands (and pansharpening the Landsat images).
+    The no data pixels of the multispectral bands are assumed to be no data (-inf,
+    nan) or 0 in the Green band. The pixels that are 0 in the Green band may be valid,
+    so they are counted as no data when measuring the cloud cover of the valid pixels
+    but not when measuring the combined cover. Both values are therefore never larger
+    than the ones after preprocess_single: an image above the thresholds is certainly
+    too cloudy, the others are checked again once they have been preprocessed.
+
+    Arguments:
+    -----------
+    fn: str or list of str
+        filename of the .TIF file containing the image, as for preprocess_single
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    cloud_mask_issue: boolean
+        True if there is an issue with the cloud mask and sand pixels are being masked on the images
+    collection: str
+        Landsat collection ,'C01' or 'C02'
+
+    Returns:
+    -----------
+    cloud_cover_combined: float
+        lower bound of the fraction of the image covered by clouds or no data pixels
+    cloud_cover: float
+        lower bound of the fraction of the valid (not no data) pixels that are
+        covered by clouds
+
+    """
+
+    collection = get_collection(fn, collection)
+    # the QA band is the last file for all the satellite missions
+    fn_ms = fn[0]
+    fn_mask = fn[-1]
+
+    # read cloud mask
+    data = gdal.Open(fn_mask, gdal.GA_ReadOnly)
+    im_QA = data.GetRasterBand(1).ReadAsArray()
+    cloud_mask = create_cloud_mask(im_QA, satname, cloud_mask_issue, collection)
+
+    # no data pixels of the Green band: -inf or nan are certainly no data, while
+    # 0 is only no data if the NIR and SWIR bands are also 0
+    data = gdal.Open(fn_ms, gdal.GA_ReadOnly)
+    im_green = data.GetRasterBand(2).ReadAsArray()
+    im_nodata = np.logical_or(np.isin(im_green, -np.inf), np.isnan(im_green))
+    im_nodata_max = np.logical_or(im_nodata, np.isin(im_green, 0))
+    # dilate if image was merged as there could be issues at the edges
+    if satname == 'S2' and 'merged' in fn_ms:
+        im_nodata = morphology.dilation(im_nodata,morphology.square(5))
+        im_nodata_max = morphology.dilation(im_nodata_max,morphology.square(5))
+
+    # compute cloud_cover percentage (with the certain no data pixels)
+    cloud_cover_combined = np.divide(np.sum(np.logical_or(cloud_mask, im_nodata)), cloud_mask.size)
+    # compute cloud cover percentage of the valid pixels, only counting the clouds
+    # that are certainly on valid pixels
+    cloud_mask_adv = np.logical_and(cloud_mask, ~im_nodata_max)
+    cloud_cover = np.divide(np.sum(cloud_mask_adv), np.sum(~im_nodata))
+
+    return cloud_cover_combined, cloud_cover
+
+def preprocess_windowed(fn, satname, settings):
+    """
+    Memory-bounded version of preprocess_single, for large images. The
+    multispectral bands are read by windows (strips of rows) to compute the
+    no data mask and, for Landsat 7, 8 and 9, to fit the pansharpening model on
+    the whole image. The pansharpened bands themselves are only computed later,
+    window by window, with preprocess_window (see SDS_shoreline.classify_image_windowed).
+    The outputs are identical to the ones of preprocess_single.
+    Only the preprocessing and the classification are done by windows: the windows
+    are stitched into full-size bands and classified image, on which the spectral
+    indices and the contours are then computed. An exception is raised if these
+    full-size arrays do not fit in settings['max_memory'].
+
+    Arguments:
+    -----------
+    fn: str or list of str
+        filename of the .TIF file containing the image, as for preprocess_single
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    settings: dict with the following keys
+        'inputs': dict
+            input parameters (sitename, filepath, polygon, dates, sat_list, landsat_collection)
+        'cloud_mask_issue': boolean
+            True if there is an issue with the cloud mask and sand pixels
+            are erroneously being masked on the images
+        'pan_off': boolean
+            if True, disable panchromatic sharpening and ignore pan band
+        'max_memory': float
+            approximate memory ceiling in MB, used to set the size of the windows
+            (an exception is raised if the image cannot be processed within it)
+
+    Returns:
+    -----------
+    image: dict
+        contains the filenames, the satellite name, the georef vector, the cloud mask,
+        the no data mask, the pansharpening model (None if the bands are not
+        pansharpened) and the number of rows of the windows ('window_rows')
+
+    """
+
+    collection = get_collection(fn, settings['inputs']['landsat_collection'])
+    fn_ms = fn[0]
+    # the QA band is the last file for all the satellite missions
+    im_QA = read_bands(fn[-1])[0][:,:,0]
+    nrows, ncols = im_QA.shape
+    georef = read_bands(fn_ms, slice(0,1))[1]
+    n_bands = 5
+    # the full-size outputs (the 5 bands in float64, the classified image and the masks)
+    # are kept in memory, the rest of the memory ceiling is shared by the windows
+    mem_full = nrows*ncols*(n_bands*8 + 8 + 5)
+    mem_windows = settings['max_memory']*1e6 - mem_full
+    window_rows = int(mem_windows/(WINDOW_BYTES_PER_PIXEL*ncols))
+    # the contours are mapped on the stitched image, which needs more memory than the
+    # classification, and the pansharpening model is fitted on a sample of pixels
+    mem_min = max(mem_full + MIN_WINDOW_ROWS*ncols*WINDOW_BYTES_PER_PIXEL,
+                  nrows*ncols*CONTOUR_BYTES_PER_PIXEL)
+    if satname in PANSHARPEN_BANDS and not settings['pan_off']:
+        mem_min = max(mem_min, mem_full + min(nrows*ncols, PANSHARPEN_SAMPLES)*PANSHARPEN_BYTES_PER_SAMPLE)
+    if settings['max_memory']*1e6 < mem_min:
+        raise Exception('max_memory (%.0f MB) is too small for image %s (%d x %d pixels), '
+                        'at least %.0f MB are needed'%(settings['max_memory'], os.path.basename(fn_ms),
+                                                       nrows, ncols, np.ceil(mem_min/1e6)))
+
+    # 1st pass: no data mask (dilated by 2 pixels for merged S2 images)
+    halo = 2 if (satname == 'S2' and 'merged' in fn_ms) else 0
+    im_nodata = np.zeros((nrows,ncols)).astype(bool)
+    sum_ms = 0
+    for rows_read, rows_win, rows_im in get_windows(nrows, window_rows, halo):
+        im_ms = read_ms_window(fn, satname, rows_read)
+        im_nodata_win = get_nodata_mask(im_ms)
+        if halo > 0:
+            im_nodata_win = morphology.dilation(im_nodata_win,morphology.square(5))
+        im_nodata[rows_im,:] = im_nodata_win[rows_win,:]
+        if satname == 'S2':
+            sum_ms += np.sum(im_ms[rows_win,:,:4])
+    # if S2 image contains only zeros, skip the image by giving it a full cloud_mask
+    if satname == 'S2' and sum_ms < 1:
+        image = {'fn':fn, 'satname':satname, 'georef':[], 'cloud_mask':np.ones((nrows,ncols)).astype('bool'),
+                 'im_nodata':[], 'ps_model':None, 'window_rows':window_rows}
+        return image
+    cloud_mask = create_cloud_mask(im_QA, satname, settings['cloud_mask_issue'], collection)
+    cloud_mask = np.logical_or(cloud_mask, im_nodata)
+
+    # 2nd pass: fit the pansharpening model on the same pixels as pansharpen
+    ps_model = None
+    if satname in PANSHARPEN_BANDS and not settings['pan_off']:
+        georef = read_bands(fn[1], slice(0,1))[1]
+        idx_ps = PANSHARPEN_BANDS[satname]
+        # check that cloud cover is not too high otherwise pansharpening fails
+        if np.sum(cloud_mask) <= 0.95*cloud_mask.shape[0]*cloud_mask.shape[1]:
+            try:
+                idx_sample = subsample(np.flatnonzero(~cloud_mask.reshape(nrows*ncols)), PANSHARPEN_SAMPLES)
+                # the sampled pixels are copied into arrays allocated once (with the
+                # dtype of the bands)
+                vec_ms = None
+                vec_pan = None
+                for rows_read, rows_win, rows_im in get_windows(nrows, window_rows, 0):
+                    # indices of the sampled pixels in this window
+                    i0, i1 = np.searchsorted(idx_sample, [rows_read.start*ncols, rows_read.stop*ncols])
+                    if i1 == i0:
+                        continue
+                    idx_win = idx_sample[i0:i1] - rows_read.start*ncols
+                    im_ms = read_ms_window(fn, satname, rows_read)
+                    im_pan = read_bands(fn[1], rows_read)[0][:,:,0]
+                    if vec_ms is None:
+                        vec_ms = np.empty((len(idx_sample), len(idx_ps)), dtype=im_ms.dtype)
+                        vec_pan = np.empty(len(idx_sample), dtype=im_pan.dtype)
+                    vec_ms[i0:i1,:] = im_ms[:,:,idx_ps].reshape(len(im_pan.flat), len(idx_ps))[idx_win,:]
+                    vec_pan[i0:i1] = im_pan.reshape(len(im_pan.flat))[idx_win]
+                    del im_ms, im_pan
+                ps_model = fit_pansharpen(vec_ms, vec_pan)
+            except: # if pansharpening fails, keep downsampled bands (for long runs)
+                print('\npansharpening of image %s failed.'%fn[0])
+
+    image = {'fn':fn, 'satname':satname, 'georef':georef, 'cloud_mask':cloud_mask,
+             'im_nodata':im_nodata, 'ps_model':ps_model, 'pan_off':settings['pan_off'],
+             'window_rows':window_rows}
+
+    return image
+
+def preprocess_window(image, rows):
+    """
+    Reads and preprocesses a window of an image prepared with preprocess_windowed.
+
+    Arguments:
+    -----------
+    image: dict
+        output of preprocess_windowed
+    rows: slice
+        rows of the window
+
+    Returns:
+    -----------
+    im_ms: np.array
+        3D array containing the pansharpened/down-sampled bands (B,G,R,NIR,SWIR1)
+        of the window
+    cloud_mask: np.array
+        2D cloud mask of the window with True where cloud pixels are
+
+    """
+
+    fn = image['fn']
+    satname = image['satname']
+    im_ms = read_ms_window(fn, satname, rows)
+    cloud_mask = image['cloud_mask'][rows,:]
+    if satname in PANSHARPEN_BANDS and not image['pan_off']:
+        # make sure the bands can hold the pansharpened (float) values
+        if not np.issubdtype(im_ms.dtype, np.floating):
+            im_ms = im_ms.astype(np.float32)
+        # pansharpen with the model fitted on the whole image
+        if image['ps_model'] is not None:
+            im_pan = read_bands(fn[1], rows)[0][:,:,0]
+            idx_ps = PANSHARPEN_BANDS[satname]
+            im_ms[:,:,idx_ps] = pansharpen(im_ms[:,:,idx_ps], im_pan, cloud_mask,
+                                           model=image['ps_model'])
+
+    return im_ms, cloud_mask
+
 ###################################################################################################
 # AUXILIARY FUNCTIONS
 ###################################################################################################
 
+def read_bands(fn, rows=None):
+    """
+    Reads all the bands of a .TIF file, or only a window (strip of rows).
+
+    Arguments:
+    -----------
+    fn: str
+        filename of the .TIF file
+    rows: slice (optional)
+        rows to read, by default the whole image is read
+
+    Returns:
+    -----------
+    im: np.array
+        3D array containing the bands
+    georef: np.array
+        vector of 6 elements [Xtr, Xscale, Xshear, Ytr, Yshear, Yscale] defining the
+        coordinates of the top-left pixel of the image (not of the window)
+
+    """
+
+    data = gdal.Open(fn, gdal.GA_ReadOnly)
+    georef = np.array(data.GetGeoTransform())
+    if rows is None:
+        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
+    else:
+        bands = [data.GetRasterBand(k + 1).ReadAsArray(0, rows.start, data.RasterXSize,
+                                                       rows.stop - rows.start)
+                 for k in range(data.RasterCount)]
+    im = np.stack(bands, 2)
+
+    return im, georef
+
+def read_ms_window(fn, satname, rows):
+    """
+    Reads a window of the multispectral bands (B,G,R,NIR,SWIR1) of an image, before
+    pansharpening. For Sentinel-2 the 10m bands and the 20m SWIR1 band are
+    scaled and stacked.
+
+    Arguments:
+    -----------
+    fn: list of str
+        filenames of the .TIF files containing the image
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    rows: slice
+        rows of the window
+
+    Returns:
+    -----------
+    im_ms: np.array
+        3D array containing the multispectral bands of the window
+
+    """
+
+    im_ms = read_bands(fn[0], rows)[0]
+    if satname == 'S2':
+        im_ms = im_ms/10000 # TOA scaled to 10000
+        im_swir = read_bands(fn[1], rows)[0][:,:,[0]]/10000
+        im_ms = np.append(im_ms, im_swir, axis=2)
+
+    return im_ms
+
+def get_windows(nrows, window_rows, halo):
+    """
+    Splits an image into windows (strips of rows) that overlap by halo rows.
+
+    Arguments:
+    -----------
+    nrows: int
+        number of rows of the image
+    window_rows: int
+        number of rows of each window (without the halo)
+    halo: int
+        number of rows added on each side of the windows
+
+    Returns:
+    -----------
+    windows: list of tuples of 3 slices
+        rows to read in the image, rows of the window that are kept (without
+        the halo) and rows of the image where they go
+
+    """
+
+    windows = []
+    for i0 in range(0, nrows, window_rows):
+        i1 = min(i0 + window_rows, nrows)
+        j0 = max(i0 - halo, 0)
+        j1 = min(i1 + halo, nrows)
+        windows.append((slice(j0, j1), slice(i0 - j0, i1 - j0), slice(i0, i1)))
+
+    return windows
+
+def get_nodata_mask(im_ms):
+    """
+    Finds the no data pixels of a multispectral image (B,G,R,NIR,SWIR1).
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        3D array containing the multispectral bands
+
+    Returns:
+    -----------
+    im_nodata: np.array
+        2D array with True where no data values (-inf, nan, or 0 in the Green, NIR
+        and SWIR bands) are located
+
+    """
+
+    # check if -inf or nan values on any band
+    im_nodata = np.zeros(im_ms.shape[:2]).astype(bool)
+    for k in range(im_ms.shape[2]):
+        im_inf = np.isin(im_ms[:,:,k], -np.inf)
+        im_nan = np.isnan(im_ms[:,:,k])
+        im_nodata = np.logical_or(np.logical_or(im_nodata, im_inf), im_nan)
+    # check if there are pixels with 0 intensity in the Green, NIR and SWIR bands and add those
+    # to the cloud mask as otherwise they will cause errors when calculating the NDWI and MNDWI
+    im_zeros = np.ones(im_nodata.shape).astype(bool)
+    for k in [1,3,4]: # loop through the Green, NIR and SWIR bands
+        im_zeros = np.logical_and(np.isin(im_ms[:,:,k],0), im_zeros)
+    # add zeros to im nodata
+    im_nodata = np.logical_or(im_zeros, im_nodata)
+
+    return im_nodata
+
+def get_collection(fn, collection):
+    """
+    Returns the Landsat collection of an image, images acquired after 2022 are
+    automatically from Collection 2.
+
+    Arguments:
+    -----------
+    fn: str or list of str
+        filename of the .TIF file containing the image
+    collection: str
+        Landsat collection ,'C01' or 'C02'
+
+    Returns:
+    -----------
+    collection: str
+        Landsat collection of this image, 'C01' or 'C02'
+
+    """
+
+    if isinstance(fn, list):
+        fn_to_split=fn[0]
+    elif isinstance(fn, str):
+        fn_to_split=fn
+    # split by os.sep and only get the filename at the end then split again to remove file extension
+    fn_to_split=fn_to_split.split(os.sep)[-1].split('.')[0]
+    # search for the year the tif was taken with regex and convert to int
+    year = int(re.search('[0-9]+',fn_to_split).group(0))
+    # after 2022 everything is automatically from Collection 2
+    if collection == 'C01' and year >= 2022:
+        collection = 'C02'
+
+    return collection
+
 def create_cloud_mask(im_QA, satname, cloud_mask_issue, collection):
     """
     Creates a cloud mask using the information contained in the QA band.
@@ -338,10 +721,139 @@ def create_cloud_mask(im_QA, satname, cloud_mask_issue, collection):
 
     return cloud_mask
 
-def hist_match(source, template):
+def subsample(vec, n_samples):
+    """
+    Returns a regular subsample of a vector, taking every k-th element so that
+    at most n_samples elements are kept. The subsample is deterministic, so the
+    results do not change from one run to the next.
+
+    Arguments:
+    -----------
+    vec: np.array
+        1D or 2D array (samples along the first dimension)
+    n_samples: int
+        maximum number of samples to keep
+
+    Returns:
+    -----------
+    vec_sub: np.array
+        subsampled array (a view of vec)
+
+    """
+
+    step = max(1, int(np.ceil(vec.shape[0]/n_samples)))
+
+    return vec[::step]
+
+def interp_regular(x, x_min, x_max, table):
+    """
+    One-dimensional linear interpolation of a function tabulated at regularly
+    spaced values between x_min and x_max. Same as np.interp (values outside the
+    range are clipped) but the position in the table is computed directly instead
+    of being searched, which is much faster for large arrays.
+
+    Arguments:
+    -----------
+    x: np.array
+        values at which to evaluate the function
+    x_min, x_max: float
+        range of the tabulated values
+    table: np.array
+        values of the function at np.linspace(x_min, x_max, len(table))
+
+    Returns:
+    -----------
+    y: np.array
+        interpolated values
+
+    """
+
+    if x_max <= x_min:
+        return np.ones(x.shape)*table[-1]
+    # fractional position of each value in the table
+    pos = (np.asarray(x, dtype=np.float64) - x_min)*((len(table)-1)/(x_max - x_min))
+    np.clip(pos, 0, len(table)-1, out=pos)
+    # (NaN values stay NaN)
+    idx = np.clip(pos.astype(np.int64), 0, len(table)-2)
+    pos -= idx
+
+    return table[idx] + pos*(table[idx+1] - table[idx])
+
+def get_hist_tables(source, template, n_bins=65536):
+    """
+    Tabulates the functions used to match the histogram of the source values with
+    the one of the template values: the empirical cumulative distribution function
+    of the source (maps value --> quantile) at n_bins+1 regularly spaced values and
+    the inverse cumulative distribution function of the template (maps quantile
+    --> value) at n_bins+1 regularly spaced quantiles.
+
+    Arguments:
+    -----------
+    source: np.array
+        1D array with the (sampled) source values
+    template: np.array
+        1D array with the (sampled) template values
+    n_bins: int
+        number of bins of the tables
+
+    Returns:
+    -----------
+    tables: dict
+        contains the range of the source values ('source_range'), the quantiles
+        of the source ('source_quantiles') and the values of the template at
+        regularly spaced quantiles ('template_values')
+
+    """
+
+    # get the set of unique values and their counts and take the cumsum of the
+    # counts normalized by the number of values to get the empirical cumulative
+    # distribution functions of the source and template values
+    s_values, s_counts = np.unique(source, return_counts=True)
+    t_values, t_counts = np.unique(template, return_counts=True)
+    s_quantiles = np.cumsum(s_counts).astype(np.float64)
+    s_quantiles /= s_quantiles[-1]
+    t_quantiles = np.cumsum(t_counts).astype(np.float64)
+    t_quantiles /= t_quantiles[-1]
+
+    # tabulate them on regular grids
+    source_range = (s_values[0], s_values[-1])
+    tables = {'source_range':source_range,
+              'source_quantiles':np.interp(np.linspace(source_range[0], source_range[1], n_bins+1),
+                                           s_values, s_quantiles),
+              'template_values':np.interp(np.linspace(0, 1, n_bins+1), t_quantiles, t_values)}
+
+    return tables
+
+def apply_hist_tables(source, tables):
+    """
+    Matches the histogram of the source values using the tables computed by
+    get_hist_tables.
+
+    Arguments:
+    -----------
+    source: np.array
+        source values
+    tables: dict
+        output of get_hist_tables
+
+    Returns:
+    -----------
+    matched: np.array
+        values of the template at the same quantiles as the source values
+
+    """
+
+    quantiles = interp_regular(source, tables['source_range'][0], tables['source_range'][1],
+                               tables['source_quantiles'])
+
+    return interp_regular(quantiles, 0, 1, tables['template_values'])
+
+def hist_match(source, template, n_samples=1000000):
     """
     Adjust the pixel values of a grayscale image such that its histogram matches
     that of a target image.
+    The histograms are computed on a regular subsample of at most n_samples pixels
+    of each image and the quantiles are interpolated in tabulated functions.
 
     Arguments:
     -----------
@@ -350,6 +862,8 @@ def hist_match(source, template):
         array
     template: np.array
         Template image; can have different dimensions to source
+    n_samples: int
+        maximum number of pixels used to compute the histograms
 
     Returns:
     -----------
@@ -362,33 +876,115 @@ def hist_match(source, template):
     source = source.ravel()
     template = template.ravel()
 
-    # get the set of unique pixel values and their corresponding indices and
-    # counts
-    s_values, bin_idx, s_counts = np.unique(source, return_inverse=True,
-                                            return_counts=True)
-    t_values, t_counts = np.unique(template, return_counts=True)
+    tables = get_hist_tables(subsample(source, n_samples), subsample(template, n_samples))
 
-    # take the cumsum of the counts and normalize by the number of pixels to
-    # get the empirical cumulative distribution functions for the source and
-    # template images (maps pixel value --> quantile)
-    s_quantiles = np.cumsum(s_counts).astype(np.float64)
-    s_quantiles /= s_quantiles[-1]
-    t_quantiles = np.cumsum(t_counts).astype(np.float64)
-    t_quantiles /= t_quantiles[-1]
+    return apply_hist_tables(source, tables).reshape(oldshape)
+
+def fit_pansharpen(vec_ms, vec_pan, chunk_size=100000):
+    """
+    Fits the pansharpening model on a sample of cloud-free pixels: the PCA of the
+    multispectral bands (eigendecomposition of their covariance matrix) and the
+    tables used to match the histogram of the panchromatic band with the one of
+    the 1st PC. The 1st PC is oriented so that it is positively correlated with
+    the panchromatic band.
+
+    Arguments:
+    -----------
+    vec_ms: np.array
+        2D array (n_pixels x n_bands) with the multispectral bands of the sampled pixels
+    vec_pan: np.array
+        1D array with the panchromatic band of the sampled pixels
+    chunk_size: int
+        number of pixels for which the principal components are computed at once
+
+    Returns:
+    -----------
+    model: dict
+        contains the mean and the principal components (one per row, sorted by
+        decreasing variance) of the multispectral bands, and the histogram matching
+        tables (see get_hist_tables)
+
+    """
+
+    vec_ms = vec_ms.astype(np.float64, copy=False)
+    mean = np.mean(vec_ms, axis=0)
+    # the principal components are the eigenvectors of the covariance matrix
+    eigenvalues, eigenvectors = np.linalg.eigh(np.cov(vec_ms, rowvar=False))
+    components = eigenvectors[:,np.argsort(eigenvalues)[::-1]].T
+    # flip the signs so that the score of largest magnitude of each component is
+    # positive, as sklearn.decomposition.PCA does (svd_flip based on the scores), the
+    # scores are computed by chunks of pixels
+    n_components = components.shape[0]
+    score_max = np.zeros(n_components)
+    cov_pan = 0
+    mean_pan = np.mean(vec_pan)
+    for i in range(0, vec_ms.shape[0], chunk_size):
+        vec_pcs = np.dot(vec_ms[i:i+chunk_size,:] - mean, components.T)
+        score = vec_pcs[np.argmax(np.abs(vec_pcs), axis=0), np.arange(n_components)]
+        # keep the first maximum, as np.argmax on all the scores
+        idx_larger = np.abs(score) > np.abs(score_max)
+        score_max[idx_larger] = score[idx_larger]
+        cov_pan += np.dot(vec_pcs[:,0], vec_pan[i:i+chunk_size] - mean_pan)
+    signs = np.sign(score_max)
+    components *= signs[:,np.newaxis]
+    # the 1st PC is then oriented so that it increases with the panchromatic band,
+    # otherwise the histogram matching inverts the panchromatic band
+    if cov_pan*signs[0] < 0:
+        components[0,:] *= -1
+
+    model = {'mean':mean, 'components':components,
+             'hist_tables':get_hist_tables(vec_pan, np.dot(vec_ms - mean, components[0,:]))}
+
+    return model
+
+def apply_pansharpen(vec_ms, vec_pan, model):
+    """
+    Pansharpens a set of pixels with a model fitted by fit_pansharpen: the 1st PC
+    is replaced by the panchromatic band (after histogram matching) and the PCA
+    is inverted.
+
+    Arguments:
+    -----------
+    vec_ms: np.array
+        2D array (n_pixels x n_bands) with the multispectral bands
+    vec_pan: np.array
+        1D array with the panchromatic band
+    model: dict
+        output of fit_pansharpen
+
+    Returns:
+    -----------
+    vec_ms_ps: np.array
+        2D array with the pansharpened multispectral bands
+
+    """
 
-    # interpolate linearly to find the pixel values in the template image
-    # that correspond most closely to the quantiles in the source image
-    interp_t_values = np.interp(s_quantiles, t_quantiles, t_values)
+    pc1_axis = model['components'][0,:]
+    # 1st PC of the pixels
+    vec_ms_ps = vec_ms.astype(np.float64)
+    vec_pc1 = np.dot(vec_ms_ps - model['mean'], pc1_axis)
+    # match the histogram of the pan band with the one of the 1st PC
+    vec_pan_matched = apply_hist_tables(vec_pan, model['hist_tables'])
+    # as the components are orthonormal, replacing the 1st PC and inverting the PCA
+    # is the same as shifting the pixels along the 1st component
+    vec_ms_ps += np.outer(vec_pan_matched - vec_pc1, pc1_axis)
 
-    return interp_t_values[bin_idx].reshape(oldshape)
+    return vec_ms_ps
 
-def pansharpen(im_ms, im_pan, cloud_mask):
+def pansharpen(im_ms, im_pan, cloud_mask, n_samples=PANSHARPEN_SAMPLES, chunk_size=1000000, model=None):
     """
     Pansharpens a multispectral image, using the panchromatic band and a cloud mask.
     A PCA is applied to the image, then the 1st PC is replaced, after histogram
     matching with the panchromatic band. Note that it is essential to match the
     histrograms of the 1st PC and the panchromatic band before replacing and
     inverting the PCA.
+    The PCA and the histograms are computed on a regular subsample of at most
+    n_samples cloud-free pixels and the pixels are pansharpened by chunks.
+    Note: the sign of the 1st PC is chosen so that it increases with the
+    panchromatic band. Previously it followed the sign convention of the PCA
+    (sklearn), and when the 1st PC was anti-correlated with the panchromatic band
+    the pansharpened bands were inverted (bright pixels became dark), the output
+    of these Landsat 7, 8 and 9 images is different.
 
     KV WRL 2018
 
@@ -400,35 +996,41 @@ def pansharpen(im_ms, im_pan, cloud_mask):
         Panchromatic band (2D)
     cloud_mask: np.array
         2D cloud mask with True where cloud pixels are
+    n_samples: int
+        maximum number of pixels used to fit the PCA and the histograms
+    chunk_size: int
+        number of pixels pansharpened at once
+    model: dict (optional)
+        pansharpening model already fitted with fit_pansharpen (e.g., on the whole
+        image when it is pansharpened by windows)
 
     Returns:
     -----------
     im_ms_ps: np.ndarray
-        Pansharpened multispectral image (3D)
+        Pansharpened multispectral image (3D, float32), NaN where cloud pixels are
 
     """
-    # check that cloud cover is not too high otherwise pansharpening fails
-    if sum(sum(cloud_mask)) > 0.95*cloud_mask.shape[0]*cloud_mask.shape[1]:
-        return im_ms
-    
-    # reshape image into vector and apply cloud mask
-    vec = im_ms.reshape(im_ms.shape[0] * im_ms.shape[1], im_ms.shape[2])
-    vec_mask = cloud_mask.reshape(im_ms.shape[0] * im_ms.shape[1])
-    vec = vec[~vec_mask, :]
-    # apply PCA to multispectral bands
-    pca = decomposition.PCA()
-    vec_pcs = pca.fit_transform(vec)
-
-    # replace 1st PC with pan band (after matching histograms)
+    # reshape image into vector
+    vec_ms = im_ms.reshape(im_ms.shape[0] * im_ms.shape[1], im_ms.shape[2])
     vec_pan = im_pan.reshape(im_pan.shape[0] * im_pan.shape[1])
-    vec_pan = vec_pan[~vec_mask]
-    vec_pcs[:,0] = hist_match(vec_pan, vec_pcs[:,0])
-    vec_ms_ps = pca.inverse_transform(vec_pcs)
-
-    # reshape vector into image
-    vec_ms_ps_full = np.ones((len(vec_mask), im_ms.shape[2])) * np.nan
-    vec_ms_ps_full[~vec_mask,:] = vec_ms_ps
-    im_ms_ps = vec_ms_ps_full.reshape(im_ms.shape[0], im_ms.shape[1], im_ms.shape[2])
+    vec_mask = cloud_mask.reshape(cloud_mask.shape[0] * cloud_mask.shape[1])
+
+    if model is None:
+        # check that cloud cover is not too high otherwise pansharpening fails
+        if np.sum(cloud_mask) > 0.95*cloud_mask.shape[0]*cloud_mask.shape[1]:
+            return im_ms
+        # fit the PCA and the histograms on a subsample of the cloud-free pixels
+        idx_sample = subsample(np.flatnonzero(~vec_mask), n_samples)
+        model = fit_pansharpen(vec_ms[idx_sample,:], vec_pan[idx_sample])
+
+    # pansharpen the pixels by chunks, directly into the output image
+    im_ms_ps = np.empty(im_ms.shape, dtype=np.float32)
+    vec_ms_ps = im_ms_ps.reshape(vec_ms.shape)
+    for i in range(0, vec_ms.shape[0], chunk_size):
+        vec_ms_ps[i:i+chunk_size,:] = apply_pansharpen(vec_ms[i:i+chunk_size,:],
+                                                       vec_pan[i:i+chunk_size], model)
+    # cloud pixels are set to NaN
+    vec_ms_ps[vec_mask,:] = np.nan
 
     return im_ms_ps
 
@@ -460,35 +1062,52 @@ def rescale_image_intensity(im, cloud_mask, prob_high):
 
     # reshape the 2D cloud mask into a 1D vector
     vec_mask = cloud_mask.reshape(im.shape[0] * im.shape[1])
-
-    # if image contains several bands, stretch the contrast for each band
-    if len(im.shape) > 2:
-        # reshape into a vector
-        vec =  im.reshape(im.shape[0] * im.shape[1], im.shape[2])
-        # initiliase with NaN values
-        vec_adj = np.ones((len(vec_mask), im.shape[2])) * np.nan
-        # loop through the bands
-        for i in range(im.shape[2]):
-            # find the higher percentile (based on prob)
-            prc_high = np.percentile(vec[~vec_mask, i], prob_high)
-            # clip the image around the 2 percentiles and rescale the contrast
-            vec_rescaled = exposure.rescale_intensity(vec[~vec_mask, i],
-                                                      in_range=(prc_low, prc_high))
-            vec_adj[~vec_mask,i] = vec_rescaled
-        # reshape into image
-        im_adj = vec_adj.reshape(im.shape[0], im.shape[1], im.shape[2])
-
-    # if image only has 1 bands (grayscale image)
-    else:
-        vec =  im.reshape(im.shape[0] * im.shape[1])
-        vec_adj = np.ones(len(vec_mask)) * np.nan
-        prc_high = np.percentile(vec[~vec_mask], prob_high)
-        vec_rescaled = exposure.rescale_intensity(vec[~vec_mask], in_range=(prc_low, prc_high))
-        vec_adj[~vec_mask] = vec_rescaled
-        im_adj = vec_adj.reshape(im.shape[0], im.shape[1])
+    # reshape into a vector (one column per band) and extract the cloud-free pixels once
+    n_bands = im.shape[2] if len(im.shape) > 2 else 1
+    vec = im.reshape(im.shape[0] * im.shape[1], n_bands)[~vec_mask,:]
+
+    # find the higher percentile (based on prob) of all the bands at once
+    prc_high = get_percentiles(vec, prob_high)
+    # initiliase with NaN values
+    vec_adj = np.ones((len(vec_mask), n_bands)) * np.nan
+    # clip each band around the 2 percentiles and rescale the contrast
+    for i in range(n_bands):
+        vec_adj[~vec_mask,i] = exposure.rescale_intensity(vec[:,i], in_range=(prc_low, prc_high[i]))
+    # reshape into image
+    im_adj = vec_adj.reshape(im.shape)
 
     return im_adj
 
+def get_percentiles(vec, prob):
+    """
+    Computes a percentile of each column of a 2D array, with the same (linear)
+    interpolation as np.percentile but using a partial sort (np.partition) of
+    all the columns at once.
+
+    Arguments:
+    -----------
+    vec: np.array
+        2D array (samples x bands)
+    prob: float
+        percentile to compute (between 0 and 100)
+
+    Returns:
+    -----------
+    prc: np.array
+        percentile of each column
+
+    """
+
+    # position of the percentile in the sorted columns
+    idx = prob/100*(vec.shape[0] - 1)
+    idx_low = int(np.floor(idx))
+    idx_high = min(idx_low + 1, vec.shape[0] - 1)
+    # partial sort so that the values at these 2 positions are in place
+    vec_part = np.partition(vec, [idx_low, idx_high], axis=0)
+    prc = vec_part[idx_low,:] + (idx - idx_low)*(vec_part[idx_high,:] - vec_part[idx_low,:])
+
+    return prc
+
 def create_jpg(im_ms, cloud_mask, date, satname, filepath):
     """
     Saves a .jpg file with the RGB image as well as the NIR and SWIR1 grayscale images.
@@ -513,21 +1132,18 @@ def create_jpg(im_ms, cloud_mask, date, satname, filepath):
         Saves a .jpg image corresponding to the preprocessed satellite image
 
     """
-    # rescale image intensity for display purposes
-    im_RGB = rescale_image_intensity(im_ms[:,:,[2,1,0]], cloud_mask, 99.9)
-    im_NIR = rescale_image_intensity(im_ms[:,:,3], cloud_mask, 99.9)
-    im_SWIR = rescale_image_intensity(im_ms[:,:,4], cloud_mask, 99.9)
+    # rescale image intensity for display purposes (R,G,B,NIR,SWIR1 bands at once)
+    im_adj = rescale_image_intensity(im_ms[:,:,[2,1,0,3,4]], cloud_mask, 99.9)
     # convert images to bytes so they can be saved
-    im_RGB = img_as_ubyte(im_RGB)
-    im_NIR = img_as_ubyte(im_NIR)
-    im_SWIR = img_as_ubyte(im_SWIR)
+    im_RGB = img_as_ubyte(im_adj[:,:,:3])
+    im_NIR = img_as_ubyte(im_adj[:,:,3])
+    im_SWIR = img_as_ubyte(im_adj[:,:,4])
     # Save each kind of image with skimage.io
     file_types=["RGB","SWIR","NIR"]
     # create folders RGB, SWIR, and NIR to hold each type of image
     for ext in file_types:
         ext_filepath=filepath+os.sep+ext
-        if not os.path.exists(ext_filepath):
-            os.mkdir(ext_filepath)
+        os.makedirs(ext_filepath, exist_ok=True)
         # location to save image ex. rgb image would be in sitename/RGB/sitename.jpg
         fname=os.path.join(ext_filepath, date + '_'+ext+'_' + satname + '.jpg')
         if ext == "RGB":
@@ -556,6 +1172,8 @@ def save_jpg(metadata, settings, **kwargs):
         'cloud_mask_issue': boolean
             True if there is an issue with the cloud mask and sand pixels
             are erroneously being masked on the images
+        'n_jobs': int (optional)
+            number of processes used to save the images in parallel (default 1)
 
     Returns:
     -----------
@@ -564,54 +1182,109 @@ def save_jpg(metadata, settings, **kwargs):
     """
 
     sitename = settings['inputs']['sitename']
-    cloud_thresh = settings['cloud_thresh']
     filepath_data = settings['inputs']['filepath']
-    collection = settings['inputs']['landsat_collection']
+    n_jobs = settings.get('n_jobs', 1)
 
-    # create subfolder to store the jpg files
+    # create subfolder to store the jpg files (and the RGB, SWIR and NIR folders
+    # before the images are saved by several processes)
     filepath_jpg = os.path.join(filepath_data, sitename, 'jpg_files', 'preprocessed')
-    if not os.path.exists(filepath_jpg):
-            os.makedirs(filepath_jpg)
+    for ext in ["RGB","SWIR","NIR"]:
+        os.makedirs(os.path.join(filepath_jpg, ext), exist_ok=True)
+
+    # same pool of processes as extract_shorelines, with the BLAS/OpenMP threads
+    # limited in each process
+    executor = None
+    if n_jobs > 1:
+        executor, threads_env = SDS_tools.start_pool(n_jobs)
 
     # loop through satellite list
     print('Saving images as jpg:')
-    for satname in metadata.keys():
-        
-        filepath = SDS_tools.get_filepath(settings['inputs'],satname)
-        filenames = metadata[satname]['filenames']
-        print('%s: %d images'%(satname,len(filenames)))
-        # loop through images
-        for i in range(len(filenames)):
-            print('\r%d%%' %int((i+1)/len(filenames)*100), end='')
-            # image filename
-            fn = SDS_tools.get_filenames(filenames[i],filepath, satname)
-            # read and preprocess image
-            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = preprocess_single(fn, satname, settings['cloud_mask_issue'],
-                                                                                      settings['pan_off'], collection)
-
-            # compute cloud_cover percentage (with no data pixels)
-            cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
-                                    (cloud_mask.shape[0]*cloud_mask.shape[1]))
-            if cloud_cover_combined > 0.99: # if 99% of cloudy pixels in image skip
-                continue
-
-            # remove no data pixels from the cloud mask (for example L7 bands of no data should not be accounted for)
-            cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata)
-            # compute updated cloud cover percentage (without no data pixels)
-            cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
-                                    (sum(sum((~im_nodata).astype(int)))))
-            # skip image if cloud cover is above threshold
-            if cloud_cover > cloud_thresh or cloud_cover == 1:
-                continue
-            # save .jpg with date and satellite in the title
-            date = filenames[i][:19]
-            plt.ioff()  # turning interactive plotting off
-            create_jpg(im_ms, cloud_mask, date, satname, filepath_jpg)
-        print('')
+    try:
+        for satname in metadata.keys():
+
+            filepath = SDS_tools.get_filepath(settings['inputs'],satname)
+            filenames = metadata[satname]['filenames']
+            print('%s: %d images'%(satname,len(filenames)))
+            # loop through images
+            if executor is None:
+                for i in range(len(filenames)):
+                    print('\r%d%%' %int((i+1)/len(filenames)*100), end='')
+                    save_jpg_single(filenames[i], filepath, satname, settings, filepath_jpg)
+            # or send them to the pool of processes
+            else:
+                futures = [executor.submit(save_jpg_single, filenames[i], filepath, satname,
+                                           settings, filepath_jpg)
+                           for i in range(len(filenames))]
+                for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                    print('\r%d%%' %int((i+1)/len(filenames)*100), end='')
+                    # raise the errors of the processes
+                    future.result()
+            print('')
+    finally:
+        if executor is not None:
+            SDS_tools.stop_pool(executor, threads_env)
     # print the location where the images have been saved
     print('Satellite images saved as .jpg in ' + os.path.join(filepath_data, sitename,
                                                     'jpg_files', 'preprocessed'))
 
+def save_jpg_single(filename, filepath, satname, settings, filepath_jpg):
+    """
+    Saves the .jpg images of a single satellite image, if it is not too cloudy.
+    Called by save_jpg, possibly in a separate process.
+
+    Arguments:
+    -----------
+    filename: str
+        filename of the image (as in metadata)
+    filepath: str
+        directory of the images of this satellite mission
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    settings: dict
+        same settings as save_jpg
+    filepath_jpg: str
+        directory where to save the .jpg files
+
+    Returns:
+    -----------
+    saved: bool
+        True if the .jpg files were saved, False if the image was skipped
+
+    """
+
+    cloud_thresh = settings['cloud_thresh']
+    collection = settings['inputs']['landsat_collection']
+    # image filename
+    fn = SDS_tools.get_filenames(filename, filepath, satname)
+    # check the cloud cover on the QA band before loading the multispectral bands
+    cloud_cover_combined, cloud_cover = check_cloud_cover(fn, satname, settings['cloud_mask_issue'],
+                                                          collection)
+    if cloud_cover_combined > 0.99 or cloud_cover > cloud_thresh or cloud_cover == 1:
+        return False
+    # read and preprocess image
+    im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = preprocess_single_cached(fn, satname, settings)
+
+    # compute cloud_cover percentage (with no data pixels)
+    cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
+                            (cloud_mask.shape[0]*cloud_mask.shape[1]))
+    if cloud_cover_combined > 0.99: # if 99% of cloudy pixels in image skip
+        return False
+
+    # remove no data pixels from the cloud mask (for example L7 bands of no data should not be accounted for)
+    cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata)
+    # compute updated cloud cover percentage (without no data pixels)
+    cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
+                            (sum(sum((~im_nodata).astype(int)))))
+    # skip image if cloud cover is above threshold
+    if cloud_cover > cloud_thresh or cloud_cover == 1:
+        return False
+    # save .jpg with date and satellite in the title
+    date = filename[:19]
+    plt.ioff()  # turning interactive plotting off
+    create_jpg(im_ms, cloud_mask, date, satname, filepath_jpg)
+
+    return True
+
 def get_reference_sl(metadata, settings):
     """
     Allows the user to manually digitize a reference shoreline that is used seed
@@ -681,8 +1354,12 @@ def get_reference_sl(metadata, settings):
 
         # read image
         fn = SDS_tools.get_filenames(filenames[i],filepath, satname)
-        im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = preprocess_single(fn, satname, settings['cloud_mask_issue'],
-                                                                                  settings['pan_off'], collection)
+        # check the cloud cover on the QA band before loading the multispectral bands
+        cloud_cover_combined, cloud_cover = check_cloud_cover(fn, satname, settings['cloud_mask_issue'],
+                                                              collection)
+        if cloud_cover_combined > 0.99 or cloud_cover > settings['cloud_thresh']:
+            continue
+        im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = preprocess_single_cached(fn, satname, settings)
 
         # compute cloud_cover percentage (with no data pixels)
         cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
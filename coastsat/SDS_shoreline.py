@@ -15,14 +15,11 @@ import pdb
 import skimage.filters as filters
 import skimage.measure as measure
 import skimage.morphology as morphology
+from scipy import ndimage, spatial
 
-# machine learning modules
-import sklearn
-if sklearn.__version__[:4] == '0.20':
-    from sklearn.externals import joblib
-else:
-    import joblib
 from shapely.geometry import LineString
+import geopandas as gpd
+from pyproj import CRS
 
 # other modules
 import matplotlib.patches as mpatches
@@ -30,14 +27,27 @@ import matplotlib.lines as mlines
 import matplotlib.cm as cm
 from matplotlib import gridspec
 import pickle
+import hashlib
+from collections import deque
 from datetime import datetime, timedelta
 from pylab import ginput
 
 # CoastSat modules
-from coastsat import SDS_tools, SDS_preprocess
+from coastsat import SDS_tools, SDS_preprocess, SDS_models, SDS_cache
 
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
+# normalized-difference indices used as features and to map the contours (bands of im_ms)
+ND_INDICES = {'NDWI':(3,1),      # NIR-G
+              'MNDWI':(4,1),     # SWIR-G
+              'NIR-R':(3,2),
+              'SWIR-NIR':(4,3),
+              'B-R':(0,2)}
+
+# buffers around the reference shoreline already computed (images on the same grid share them)
+BUFFER_CACHE_SIZE = 16
+_buffer_cache = dict([])
+
 # Main function for batch shoreline detection
 def extract_shorelines(metadata, settings):
     """
@@ -75,303 +85,1498 @@ def extract_shorelines(metadata, settings):
             if True, allows user to manually adjust the detected shoreline
         'pan_off': bool
             if True, no pan-sharpening is performed on Landsat 7,8 and 9 imagery
+        'max_memory': float (optional)
+            if given, the images are preprocessed and classified by windows to keep
+            the memory usage around this value (in MB), the contours are then mapped
+            on the full-size image (an exception is raised if it does not fit)
+        'classify_buffer': bool (optional)
+            if True, only the pixels within 5 pixels of the reference shoreline buffer
+            (the ones used to map the contours) are classified
+        'n_jobs': int (optional)
+            number of processes used to map the shorelines in parallel, only when
+            check_detection, adjust_detection and save_figure are False (default 1)
+        'batch_images': int (optional)
+            number of images preprocessed together and classified with a single call to
+            the classifier, faster for small images but uses more memory (default 1)
+        'checkpoint': bool (optional)
+            if True, each image is appended to sitename_output_log.pkl as soon as it
+            is processed, and the output is then built from this log. The images that
+            fail (e.g., read errors) do not stop the run, they are listed in
+            sitename_output_failed.pkl instead and processed again with resume
+        'classif_cache': bool (optional)
+            if True, the classification of each image is cached on disk (in
+            settings['cache_dir']), so that running again with other settings that do not
+            affect the classification (e.g., min_length_sl) skips the classification
+        'resume': bool (optional)
+            if True, the images already in sitename_output_log.pkl (e.g., from a run that
+            was interrupted) are not processed again, and the new ones are appended to it
+            (as with checkpoint)
+        'coarse_factor': int (optional)
+            if given (2 to 4), the shoreline is first located on the image downsampled by
+            this factor, then the image is only classified and contoured at full
+            resolution in a band around this coarse shoreline (not with max_memory)
+        'coarse_band': float (optional)
+            half-width (in metres) of the band around the coarse shoreline (default
+            3 x coarse_factor pixels)
             
     Returns:
     -----------
-    output: dict
-        contains the extracted shorelines and corresponding dates + metadata
+    output: dict
+        contains the extracted shorelines and corresponding dates + metadata
+
+    """
+
+    sitename = settings['inputs']['sitename']
+    filepath_data = settings['inputs']['filepath']
+    # create a subfolder to store the .jpg images showing the detection
+    filepath_jpg = os.path.join(filepath_data, sitename, 'jpg_files', 'detection')
+    if not os.path.exists(filepath_jpg):
+            os.makedirs(filepath_jpg)
+    # close all open figures
+    plt.close('all')
+
+    # checkpoint log, where the images are recorded as soon as they are processed,
+    # and log of the images that failed (processed again when resuming)
+    fn_log = os.path.join(filepath_data, sitename, sitename + '_output_log.pkl')
+    fn_failed = os.path.join(filepath_data, sitename, sitename + '_output_failed.pkl')
+    checkpoint = settings.get('checkpoint', False) or settings.get('resume', False)
+    resume = settings.get('resume', False) and os.path.exists(fn_log)
+    skip_filenames = set([])
+    if resume:
+        # read the images processed by a previous run and drop any incomplete last record
+        offset = 0
+        for record, offset in iter_checkpoint(fn_log):
+            skip_filenames.add(record['filename'])
+        with open(fn_log, 'ab') as f:
+            f.truncate(offset)
+        print('Resuming from %s: %d images already processed'%(os.path.basename(fn_log), len(skip_filenames)))
+
+    print('Mapping shorelines:')
+
+    # map the shorelines, writing each image to the log if requested and reading
+    # the records back from it, so that they are not all kept in memory
+    if checkpoint:
+        n_failed = 0
+        with open(fn_log, 'ab' if resume else 'wb') as f, open(fn_failed, 'wb') as f_failed:
+            for record in iter_shorelines(metadata, settings, skip_filenames, catch_errors=True):
+                if record['error'] is None:
+                    append_checkpoint(f, record)
+                else:
+                    append_checkpoint(f_failed, record)
+                    n_failed += 1
+        if n_failed > 0:
+            print('%d images failed (listed in %s), they are processed again with resume'%(
+                  n_failed, os.path.basename(fn_failed)))
+        records = (record for record, offset in iter_checkpoint(fn_log))
+    else:
+        records = iter_shorelines(metadata, settings, skip_filenames)
+
+    # keep the records with a shoreline, the index in metadata is recomputed in case
+    # new images were added since the log was written
+    idx_filenames = dict([(satname, dict([(fn, i) for i, fn in enumerate(metadata[satname]['filenames'])]))
+                          for satname in metadata.keys()])
+    records_sat = dict([(satname, []) for satname in metadata.keys()])
+    for record in records:
+        if (record['shorelines'] is None or not record['satname'] in idx_filenames
+            or not record['filename'] in idx_filenames[record['satname']]):
+            continue
+        record['idx'] = idx_filenames[record['satname']][record['filename']]
+        records_sat[record['satname']].append(record)
+
+    # close figure window if still open
+    if plt.get_fignums():
+        plt.close()
+
+    # create dictionnary of output, with the images in the same order as in metadata
+    output = dict([])
+    for satname in metadata.keys():
+        records_sat[satname] = sorted(records_sat[satname], key=lambda record: record['idx'])
+        output[satname] = dict([(key, [record[key] for record in records_sat[satname]])
+                                for key in ['dates', 'shorelines', 'filename', 'cloud_cover',
+                                            'geoaccuracy', 'idx', 'MNDWI_threshold']])
+
+    # change the format to have one list sorted by date with all the shorelines (easier to use)
+    output = SDS_tools.merge_output(output)
+
+    # save outputput structure as output.pkl
+    filepath = os.path.join(filepath_data, sitename)
+    with open(os.path.join(filepath, sitename + '_output.pkl'), 'wb') as f:
+        pickle.dump(output, f)
+
+    return output
+
+def extract_shorelines_sweep(metadata, settings, sweep):
+    """
+    Maps the shorelines with several sets of post-classification settings (e.g., to
+    tune min_length_sl, dist_clouds or max_dist_ref), while preprocessing and
+    classifying each image only once. One output is created and saved for each
+    set of settings, as sitename_output_<settings>.pkl.
+    With settings['classif_cache'] the classifications are also kept on disk, so
+    that another sweep does not classify the images again.
+
+    Arguments:
+    -----------
+    metadata: dict
+        contains all the information about the satellite images that were downloaded
+    settings: dict
+        same settings as extract_shorelines (check_detection, adjust_detection and
+        save_figure are not used)
+    sweep: list of dict
+        settings to replace for each run, with the keys 'min_length_sl', 'dist_clouds'
+        and/or 'max_dist_ref' (e.g., [{'min_length_sl':300}, {'min_length_sl':500}]).
+        If classify_buffer is True, the images are classified in the buffer of the
+        largest max_dist_ref.
+
+    Returns:
+    -----------
+    outputs: list of dict
+        the output of each run (same format as the output of extract_shorelines)
+
+    """
+
+    # only the settings used after the classification can be changed
+    for settings_sweep in sweep:
+        for key in settings_sweep.keys():
+            if not key in ['min_length_sl', 'dist_clouds', 'max_dist_ref']:
+                raise Exception('%s cannot be changed in a sweep, only min_length_sl, dist_clouds and max_dist_ref'%key)
+
+    sitename = settings['inputs']['sitename']
+    filepath_data = settings['inputs']['filepath']
+    filepath_models = os.path.join(os.getcwd(), 'classification', 'models')
+    # no interaction with the user or figures
+    settings = dict(settings)
+    settings['check_detection'] = False
+    settings['adjust_detection'] = False
+    settings['save_figure'] = False
+
+    # same pool of processes as iter_shorelines
+    n_jobs = settings.get('n_jobs', 1)
+    executor = None
+    if n_jobs > 1:
+        executor, threads_env = SDS_tools.start_pool(n_jobs)
+
+    print('Mapping shorelines (%d sets of settings):'%len(sweep))
+    outputs_sat = [dict([]) for _ in sweep]
+    try:
+        for satname in metadata.keys():
+            filepath = SDS_tools.get_filepath(settings['inputs'],satname)
+            filenames = metadata[satname]['filenames']
+            # reduce min shoreline length for L7 because of the diagonal bands
+            # (as in extract_shorelines, also for the sets of settings that change it)
+            settings_sat = dict(settings)
+            sweep_sat = sweep
+            if satname == 'L7':
+                settings_sat['min_length_sl'] = 200
+                sweep_sat = [dict(_, min_length_sl=200) if 'min_length_sl' in _ else _ for _ in sweep]
+
+            results = map_images(executor, n_jobs, list(range(len(filenames))), filenames, filepath,
+                                 satname, metadata[satname]['epsg'], settings_sat, filepath_models,
+                                 sweep_sat)
+
+            keys = ['dates', 'shorelines', 'filename', 'cloud_cover', 'geoaccuracy', 'idx', 'MNDWI_threshold']
+            for k in range(len(sweep)):
+                outputs_sat[k][satname] = dict([(key, []) for key in keys])
+            for i, result in enumerate(results):
+                print('\r%s:   %d%%' % (satname,int(((i+1)/len(filenames))*100)), end='')
+                # skipped before the classification
+                if result is None:
+                    continue
+                for k in range(len(sweep)):
+                    if result[k] is None:
+                        continue
+                    output = outputs_sat[k][satname]
+                    output['dates'].append(metadata[satname]['dates'][i])
+                    output['shorelines'].append(result[k][0])
+                    output['filename'].append(filenames[i])
+                    output['cloud_cover'].append(result[k][1])
+                    output['geoaccuracy'].append(metadata[satname]['acc_georef'][i])
+                    output['idx'].append(i)
+                    output['MNDWI_threshold'].append(result[k][2])
+            print('')
+    finally:
+        if executor is not None:
+            SDS_tools.stop_pool(executor, threads_env)
+
+    # merge the satellites and save one output for each set of settings
+    outputs = []
+    for k in range(len(sweep)):
+        output = SDS_tools.merge_output(outputs_sat[k])
+        suffix = '_'.join(['%s=%s'%(key, sweep[k][key]) for key in sorted(sweep[k].keys())])
+        if len(suffix) == 0:
+            suffix = 'default'
+        with open(os.path.join(filepath_data, sitename, sitename + '_output_' + suffix + '.pkl'), 'wb') as f:
+            pickle.dump(output, f)
+        outputs.append(output)
+
+    return outputs
+
+def iter_shorelines(metadata, settings, skip_filenames=None, catch_errors=False):
+    """
+    Generator that maps the shorelines image by image and yields a record for each
+    image as soon as it is processed, so that long time series can be processed
+    without keeping all the shorelines in memory (e.g., writing each record to a
+    checkpoint log with append_checkpoint).
+    The images are processed in the same order as in metadata, or in a pool of
+    processes if settings['n_jobs'] > 1 (see extract_shorelines).
+
+    Arguments:
+    -----------
+    metadata: dict
+        contains all the information about the satellite images that were downloaded
+    settings: dict
+        same settings as extract_shorelines
+    skip_filenames: set of str (optional)
+        filenames of the images that should not be processed (e.g., already in a log)
+    catch_errors: bool (optional)
+        if True, an error while processing an image does not stop the generator, the
+        image is yielded with the error message instead (all the images of the batch
+        if settings['batch_images'] > 1)
+
+    Returns:
+    -----------
+    record: dict
+        for each image, contains 'dates', 'shorelines', 'filename', 'cloud_cover',
+        'geoaccuracy', 'idx' (index of the image in metadata), 'MNDWI_threshold',
+        'satname' and 'error'. The images that were skipped (too cloudy, no shoreline
+        found or rejected by the user) have 'shorelines' set to None, so that they are
+        also recorded. The images that failed also have 'error' set to the error
+        message (None otherwise)
+
+    """
+
+    if skip_filenames is None:
+        skip_filenames = set([])
+    filepath_models = os.path.join(os.getcwd(), 'classification', 'models')
+
+    # if nothing needs to be displayed, the images can be distributed across a pool of
+    # processes, each loading the classifiers once and using its share of the cores for BLAS
+    n_jobs = settings.get('n_jobs', 1)
+    if n_jobs > 1 and not (settings['check_detection'] or settings['adjust_detection']
+                           or settings['save_figure']):
+        executor, threads_env = SDS_tools.start_pool(n_jobs)
+    else:
+        executor = None
+
+    try:
+        default_min_length_sl = settings['min_length_sl']
+        # loop through satellite list
+        for satname in metadata.keys():
+
+            # get images
+            filepath = SDS_tools.get_filepath(settings['inputs'],satname)
+            filenames = metadata[satname]['filenames']
+            idx_todo = [i for i in range(len(filenames)) if not filenames[i] in skip_filenames]
+
+            # reduce min shoreline length for L7 because of the diagonal bands
+            if satname == 'L7': settings['min_length_sl'] = 200
+            else: settings['min_length_sl'] = default_min_length_sl
+
+            # map the shorelines image by image, or send the images to the pool of processes
+            # (the settings are copied as settings['min_length_sl'] changes between satellites)
+            settings_sat = dict(settings)
+            results = map_images(executor, n_jobs, idx_todo, filenames, filepath, satname,
+                                 metadata[satname]['epsg'], settings_sat, filepath_models,
+                                 catch_errors=catch_errors)
+
+            # loop through the images (in the same order as in metadata)
+            for i, result in zip(idx_todo, results):
+
+                print('\r%s:   %d%%' % (satname,int(((i+1)/len(filenames))*100)), end='')
+                record = {'dates': metadata[satname]['dates'][i],
+                          'shorelines': None,
+                          'filename': filenames[i],
+                          'cloud_cover': None,
+                          'geoaccuracy': metadata[satname]['acc_georef'][i],
+                          'idx': i,
+                          'MNDWI_threshold': None,
+                          'satname': satname,
+                          'error': None}
+                # the error message if the image failed
+                if isinstance(result, str):
+                    print('\nCould not process image %s: %s'%(filenames[i], result))
+                    record['error'] = result
+                elif result is not None:
+                    record['shorelines'], record['cloud_cover'], record['MNDWI_threshold'] = result
+                yield record
+
+            if len(idx_todo) > 0:
+                print('')
+
+    # shut down the pool of processes (also if the generator is closed before the end)
+    finally:
+        if executor is not None:
+            SDS_tools.stop_pool(executor, threads_env)
+
+def map_images(executor, n_jobs, idx, filenames, filepath, satname, image_epsgs, settings,
+               filepath_models, sweep=None, catch_errors=False):
+    """
+    Generator that maps the shorelines on the images idx of a satellite mission and
+    yields the result of each image in order. The images are processed by batches of
+    settings['batch_images'] images (classified together, see extract_shoreline_batch),
+    in the pool of processes if there is one.
+
+    Arguments:
+    -----------
+    executor: concurrent.futures.Executor or None
+        pool of processes (None to process the images in this process)
+    n_jobs: int
+        number of processes of the pool
+    idx: list of int
+        indices of the images to process
+    filenames: list of str
+        filenames of all the images of this satellite mission (as in metadata)
+    filepath: str
+        directory of the images of this satellite mission
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    image_epsgs: list of int
+        spatial reference system of all the images (from metadata)
+    settings: dict
+        same settings as extract_shorelines
+    filepath_models: str
+        folder containing the classifiers
+    sweep: list of dict (optional)
+        same as extract_shoreline_single
+    catch_errors: bool (optional)
+        if True, the error message is yielded for the images of a batch that failed,
+        instead of raising the error
+
+    Returns:
+    -----------
+    result:
+        result of each image, as returned by extract_shoreline_single (or the error
+        message with catch_errors)
+
+    """
+
+    func = extract_shoreline_batch_safe if catch_errors else extract_shoreline_batch
+    n_batch = max(1, settings.get('batch_images', 1))
+    args = [([filenames[i] for i in idx[k:k+n_batch]], filepath, satname,
+             [image_epsgs[i] for i in idx[k:k+n_batch]], settings, filepath_models, sweep)
+            for k in range(0, len(idx), n_batch)]
+    if executor is None:
+        results = (func(*_) for _ in args)
+    else:
+        results = map_in_order(executor, func, args, 2*n_jobs)
+    for results_batch in results:
+        for result in results_batch:
+            yield result
+
+def map_in_order(executor, func, args, n_pending):
+    """
+    Submits func(*args[k]) to a pool of processes and yields the results in the same
+    order as args, with at most n_pending tasks submitted ahead of the result being
+    yielded (so that the finished results do not accumulate in memory).
+
+    Arguments:
+    -----------
+    executor: concurrent.futures.Executor
+        pool of processes
+    func: function
+        function to call
+    args: list of tuples
+        arguments of each call
+    n_pending: int
+        maximum number of tasks submitted at the same time
+
+    Returns:
+    -----------
+    result:
+        the result of each call, in order
+
+    """
+
+    pending = deque()
+    for arg in args:
+        pending.append(executor.submit(func, *arg))
+        if len(pending) >= n_pending:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+def append_checkpoint(f, record):
+    """
+    Appends a record (as yielded by iter_shorelines) to a checkpoint log and flushes
+    it to disk, so that the record is kept if the run is interrupted.
+
+    Arguments:
+    -----------
+    f: file object
+        checkpoint log opened in binary append mode
+    record: dict
+        record of one image
+
+    Returns:
+    -----------
+    Writes the record at the end of the log
+
+    """
+
+    pickle.dump(record, f)
+    f.flush()
+    os.fsync(f.fileno())
+
+def load_checkpoint(fn_log):
+    """
+    Reads the records of a checkpoint log written with append_checkpoint. If the run
+    was interrupted while a record was written, the log is read up to the last
+    complete record.
+
+    Arguments:
+    -----------
+    fn_log: str
+        filename of the checkpoint log
+
+    Returns:
+    -----------
+    records: list of dict
+        records of the images already processed
+    offset: int
+        size in bytes of the complete records (where the next record should be written)
+
+    """
+
+    records = []
+    offset = 0
+    for record, offset in iter_checkpoint(fn_log):
+        records.append(record)
+
+    return records, offset
+
+def iter_checkpoint(fn_log):
+    """
+    Generator that reads the records of a checkpoint log one at a time, up to the
+    last complete record.
+
+    Arguments:
+    -----------
+    fn_log: str
+        filename of the checkpoint log
+
+    Returns:
+    -----------
+    record: dict
+        record of an image
+    offset: int
+        size in bytes of the log up to the end of this record
+
+    """
+
+    with open(fn_log, 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except Exception: # end of the log or incomplete record
+                break
+            yield record, f.tell()
+
+def extract_shoreline_single(filename, filepath, satname, image_epsg, settings, filepath_models,
+                             sweep=None):
+    """
+    Maps the shoreline on a single image: preprocessing, classification, contouring
+    and processing of the contours. Called by extract_shorelines, possibly in a
+    separate process.
+
+    Arguments:
+    -----------
+    filename: str
+        filename of the image (as in metadata)
+    filepath: str
+        directory of the images of this satellite mission
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    image_epsg: int
+        spatial reference system of the image (from metadata)
+    settings: dict
+        same settings as extract_shorelines
+    filepath_models: str
+        folder containing the classifiers
+    sweep: list of dict (optional)
+        if given, the shoreline is mapped once for each dict of settings (replacing
+        the ones in settings) from the same classification (see extract_shorelines_sweep)
+
+    Returns:
+    -----------
+    result: tuple or None
+        (shoreline, cloud_cover, t_mndwi), None if the image was skipped. If sweep is
+        given, a list with one result for each dict of settings (None if the image
+        was skipped before the classification)
+
+    """
+
+    return extract_shoreline_batch([filename], filepath, satname, [image_epsg], settings,
+                                   filepath_models, sweep)[0]
+
+def extract_shoreline_batch_safe(filenames, filepath, satname, image_epsgs, settings, filepath_models,
+                                 sweep=None):
+    """
+    Same as extract_shoreline_batch, but if an error occurs the error message is
+    returned for each image of the batch instead of raising it (e.g., so that a
+    read error does not stop a long run).
+
+    Arguments:
+    -----------
+    Same arguments as extract_shoreline_batch
+
+    Returns:
+    -----------
+    results: list
+        result of each image, as returned by extract_shoreline_single, or the error
+        message (str) for all the images if the batch failed
+
+    """
+
+    try:
+        return extract_shoreline_batch(filenames, filepath, satname, image_epsgs, settings,
+                                       filepath_models, sweep)
+    except Exception as e:
+        return ['%s: %s'%(type(e).__name__, e)]*len(filenames)
+
+def extract_shoreline_batch(filenames, filepath, satname, image_epsgs, settings, filepath_models,
+                            sweep=None):
+    """
+    Maps the shorelines on a batch of images of the same satellite mission. The images
+    are preprocessed one by one, then the pixels of all the images are classified
+    together in a single call to the classifier (see predict_classes_batch) and the
+    shorelines are mapped on each image.
+
+    Arguments:
+    -----------
+    filenames: list of str
+        filenames of the images (as in metadata)
+    filepath: str
+        directory of the images of this satellite mission
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    image_epsgs: list of int
+        spatial reference system of each image (from metadata)
+    settings: dict
+        same settings as extract_shorelines
+    filepath_models: str
+        folder containing the classifiers
+    sweep: list of dict (optional)
+        same as extract_shoreline_single
+
+    Returns:
+    -----------
+    results: list
+        result of each image, as returned by extract_shoreline_single
+
+    """
+
+    # load the classifier (only read once per process)
+    clf = SDS_models.get_classifier(satname, settings['sand_color'], filepath_models)
+    pixel_size = 10 if satname == 'S2' else 15
+    # convert settings['min_beach_area'] from metres to pixels
+    min_beach_area_pixels = np.ceil(settings['min_beach_area']/pixel_size**2)
+    # for a sweep the largest buffer is used for the classification
+    settings_buffer = settings
+    if sweep is not None and any(['max_dist_ref' in _ for _ in sweep]):
+        settings_buffer = dict(settings)
+        settings_buffer['max_dist_ref'] = max([_.get('max_dist_ref', settings['max_dist_ref'])
+                                               for _ in sweep])
+
+    # preprocess the images
+    images = [prepare_image(filenames[i], filepath, satname, image_epsgs[i], pixel_size,
+                            settings_buffer, clf) for i in range(len(filenames))]
+
+    # classify image in 4 classes (sand, whitewater, water, other) with NN classifier,
+    # the images that are not in the cache (if any) and not processed by windows are
+    # classified together
+    idx_batch = []
+    for i, image in enumerate(images):
+        if image is None:
+            continue
+        if settings.get('max_memory', None) is not None:
+            image['im_ms'], image['im_classif'], image['im_labels'] = classify_image_windowed(image['image'],
+                                                                                               min_beach_area_pixels,
+                                                                                               clf, image['im_bool'])
+            continue
+        if settings.get('classif_cache', False):
+            image['cache'] = get_classif_cache_key(image['fn'], satname, min_beach_area_pixels, clf,
+                                                   settings, image['im_bool'])
+            result = load_classif(*image['cache'])
+            if result is not None:
+                image['im_classif'], image['im_labels'] = result
+                continue
+        idx_batch.append(i)
+    if len(idx_batch) > 0:
+        classifs = predict_classes_batch([(images[i]['im_ms'], images[i]['cloud_mask'],
+                                           images[i]['im_bool'], images[i]['indices'])
+                                          for i in idx_batch], clf)
+        for i, im_classif in zip(idx_batch, classifs):
+            images[i]['im_classif'] = im_classif
+            images[i]['im_labels'] = get_class_labels(im_classif, min_beach_area_pixels)
+            if 'cache' in images[i]:
+                save_classif(*images[i]['cache'], im_classif, images[i]['im_labels'],
+                             settings.get('cache_size', 2000))
+
+    # map the shoreline from the classification of each image
+    results = []
+    for i, image in enumerate(images):
+        if image is None:
+            results.append(None)
+            continue
+        args = (image['im_ms'], image['cloud_mask'], image['cloud_mask_adv'], image['im_nodata'],
+                image['im_labels'])
+        # once with the settings, or once for each dict of settings of the sweep
+        # (the buffers are cached)
+        results_image = []
+        for settings_sweep in ([dict([])] if sweep is None else sweep):
+            settings_k = dict(settings)
+            settings_k.update(settings_sweep)
+            if sweep is None:
+                im_ref_buffer = image['im_ref_buffer']
+            else:
+                im_ref_buffer = create_shoreline_buffer(image['cloud_mask'].shape, image['georef'],
+                                                        image_epsgs[i], pixel_size, settings_k)
+                if image['coarse_band'] is not None:
+                    im_ref_buffer = np.logical_and(im_ref_buffer, image['coarse_band'])
+            result = map_shoreline(*args, im_ref_buffer, image['georef'], image_epsgs[i],
+                                   settings_k, filenames[i], satname, image['indices'])
+            if result is None:
+                results_image.append(None)
+            else:
+                results_image.append((result[0], image['cloud_cover'], result[1]))
+        results.append(results_image[0] if sweep is None else results_image)
+        # release the image before mapping the next one
+        images[i] = None
+
+    return results
+
+def prepare_image(filename, filepath, satname, image_epsg, pixel_size, settings, clf=None):
+    """
+    Preprocesses an image before its classification: cloud cover checks, cloud mask,
+    pansharpening/downsampling and buffer around the reference shoreline (restricted
+    to a band around the coarse shoreline if settings['coarse_factor'] is given).
+
+    Arguments:
+    -----------
+    filename: str
+        filename of the image (as in metadata)
+    filepath: str
+        directory of the images of this satellite mission
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    image_epsg: int
+        spatial reference system of the image (from metadata)
+    pixel_size: int
+        size of the pixels in metres
+    settings: dict
+        same settings as extract_shorelines
+    clf: dict or joblib object (optional)
+        pre-trained classifier, only used to classify the downsampled image if
+        settings['coarse_factor'] is given
+
+    Returns:
+    -----------
+    image: dict or None
+        contains the filename ('fn'), the bands ('im_ms', or 'image' if the image is
+        processed by windows), 'georef', 'cloud_mask', 'cloud_mask_adv', 'im_nodata',
+        'cloud_cover', 'im_ref_buffer', the pixels to classify ('im_bool'), the
+        band around the coarse shoreline ('coarse_band', if any) and the spectral
+        indices ('indices'). None if the image is too cloudy
+
+    """
+
+    collection = settings['inputs']['landsat_collection']
+    # get image filename
+    fn = SDS_tools.get_filenames(filename,filepath, satname)
+    # check the cloud cover on the QA band before loading the multispectral bands
+    cloud_cover_combined, cloud_cover = SDS_preprocess.check_cloud_cover(fn, satname,
+                                                                         settings['cloud_mask_issue'],
+                                                                         collection)
+    if cloud_cover_combined > 0.99 or cloud_cover > settings['cloud_thresh']:
+        return None
+    image = {'fn':fn, 'im_ms':None, 'image':None}
+    # preprocess image (cloud mask + pansharpening/downsampling)
+    if settings.get('max_memory', None) is None:
+        image['im_ms'], georef, cloud_mask, im_extra, im_QA, im_nodata = SDS_preprocess.preprocess_single_cached(fn, satname,
+                                                                                                                 settings)
+    # or only the masks if the image is processed by windows (the bands are read when classifying)
+    else:
+        image['image'] = SDS_preprocess.preprocess_windowed(fn, satname, settings)
+        georef, cloud_mask, im_nodata = [image['image'][_] for _ in ['georef', 'cloud_mask', 'im_nodata']]
+
+    # compute cloud_cover percentage (with no data pixels)
+    cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
+                            (cloud_mask.shape[0]*cloud_mask.shape[1]))
+    if cloud_cover_combined > 0.99: # if 99% of cloudy pixels in image skip
+        return None
+    # remove no data pixels from the cloud mask 
+    # (for example L7 bands of no data should not be accounted for)
+    cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata) 
+    # compute updated cloud cover percentage (without no data pixels)
+    cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
+                            (sum(sum((~im_nodata).astype(int)))))
+    # skip image if cloud cover is above user-defined threshold
+    if cloud_cover > settings['cloud_thresh']:
+        return None
+
+    # calculate a buffer around the reference shoreline (if any has been digitised)
+    im_ref_buffer = create_shoreline_buffer(cloud_mask.shape, georef, image_epsg,
+                                            pixel_size, settings)
+
+    # coarse-to-fine: only classify and contour the pixels in a band around the shoreline
+    # mapped on the downsampled image (the whole buffer if it could not be mapped)
+    im_band, im_bool = None, None
+    coarse_factor = settings.get('coarse_factor', None)
+    if coarse_factor is not None and image['im_ms'] is not None:
+        if not int(coarse_factor) == coarse_factor or coarse_factor < 2:
+            raise Exception('coarse_factor must be an integer of at least 2')
+        band_pixels = settings.get('coarse_band', 3*coarse_factor*pixel_size)/pixel_size
+        min_beach_area_pixels = np.ceil(settings['min_beach_area']/pixel_size**2)
+        im_band, im_bool = get_coarse_band(image['im_ms'], cloud_mask, im_ref_buffer, clf,
+                                           int(coarse_factor), min_beach_area_pixels, band_pixels)
+        if im_band is not None:
+            im_ref_buffer = np.logical_and(im_ref_buffer, im_band)
+
+    # only classify the pixels that are used to map the contours (buffer dilated by 5 pixels)
+    if im_band is None and settings.get('classify_buffer', False) and not np.all(im_ref_buffer):
+        im_bool = morphology.binary_dilation(im_ref_buffer, morphology.disk(5))
+
+    image.update({'georef':georef, 'cloud_mask':cloud_mask, 'cloud_mask_adv':cloud_mask_adv,
+                  'im_nodata':im_nodata, 'cloud_cover':cloud_cover, 'im_ref_buffer':im_ref_buffer,
+                  'im_bool':im_bool, 'coarse_band':im_band,
+                  # spectral indices of this image, computed when first needed and shared
+                  # between the classification and the contours
+                  'indices':dict([])})
+
+    return image
+
+def map_shoreline(im_ms, cloud_mask, cloud_mask_adv, im_nodata, im_labels, im_ref_buffer, georef,
+                  image_epsg, settings, filename, satname, indices=None):
+    """
+    Maps the shoreline on a classified image: finds the sand/water contours in the
+    buffer around the reference shoreline and processes them into a shoreline
+    (or lets the user adjust/check the detection).
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        Pansharpened RGB + downsampled NIR and SWIR
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+    cloud_mask_adv: np.array
+        2D cloud mask without the no data pixels
+    im_nodata: np.array
+        2D mask with True where noData pixels are
+    im_labels: np.array
+        3D image containing a boolean image for each class
+    im_ref_buffer: np.array
+        binary image containing a buffer around the reference shoreline
+    georef: np.array
+        vector of 6 elements [Xtr, Xscale, Xshear, Ytr, Yshear, Yscale]
+    image_epsg: int
+        spatial reference system of the image
+    settings: dict
+        same settings as extract_shorelines
+    filename: str
+        filename of the image (as in metadata)
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    indices: dict (optional)
+        spectral indices of the image (see get_nd_index)
+
+    Returns:
+    -----------
+    result: tuple or None
+        (shoreline, t_mndwi), None if the shoreline could not be mapped or was
+        rejected by the user
+
+    """
+
+    # if adjust_detection is True, let the user adjust the detected shoreline
+    if settings['adjust_detection']:
+        date = filename[:19]
+        skip_image, shoreline, t_mndwi = adjust_detection(im_ms, cloud_mask, im_nodata, im_labels,
+                                                          im_ref_buffer, image_epsg, georef,
+                                                          settings, date, satname)
+        # if the user decides to skip the image, do not save the mapped shoreline
+        if skip_image:
+            return None
+
+    # otherwise map the contours automatically with one of the two following functions:
+    # if there are pixels in the 'sand' class --> use find_wl_contours2 (enhanced)
+    # otherwise use find_wl_contours1 (traditional)
+    else:
+        try: # use try/except structure for long runs
+            if sum(im_labels[im_ref_buffer,0]) < 50: # minimum number of sand pixels
+                # compute MNDWI image (SWIR-G)
+                im_mndwi = get_nd_index(im_ms, cloud_mask, 'MNDWI', indices)
+                # find water contours on MNDWI grayscale image
+                contours_mwi, t_mndwi = find_wl_contours1(im_mndwi, cloud_mask, im_ref_buffer)
+            else:
+                # use classification to refine threshold and extract the sand/water interface
+                contours_mwi, t_mndwi = find_wl_contours2(im_ms, im_labels, cloud_mask, im_ref_buffer,
+                                                          indices)
+        except:
+            print('Could not map shoreline for this image: ' + filename)
+            return None
+
+        # process the water contours into a shoreline
+        shoreline = process_shoreline(contours_mwi, cloud_mask_adv, im_nodata,
+                                      georef, image_epsg, settings)
+
+        # visualise the mapped shorelines, there are two options:
+        # if settings['check_detection'] = True, shows the detection to the user for accept/reject
+        # if settings['save_figure'] = True, saves a figure for each mapped shoreline
+        if settings['check_detection'] or settings['save_figure']:
+            date = filename[:19]
+            if not settings['check_detection']:
+                plt.ioff() # turning interactive plotting off
+            skip_image = show_detection(im_ms, cloud_mask, im_labels, shoreline,
+                                        image_epsg, georef, settings, date, satname)
+            # if the user decides to skip the image, do not save the mapped shoreline
+            if skip_image:
+                return None
+
+    return shoreline, t_mndwi
+
+def get_coarse_band(im_ms, cloud_mask, im_ref_buffer, clf, factor, min_beach_area, band_pixels):
+    """
+    Locates the land/water interface on the image downsampled by block-averaging the
+    reflectances (factor x factor pixels) and returns a band around it at full
+    resolution, in which the image is then classified and contoured.
+    The downsampled image is classified in the buffer around the reference shoreline
+    and contoured with the same functions as the full resolution image.
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        Pansharpened RGB + downsampled NIR and SWIR
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+    im_ref_buffer: np.array
+        binary image containing a buffer around the reference shoreline
+    clf: dict or joblib object
+        pre-trained classifier
+    factor: int
+        downsampling factor (e.g., 2 to 4)
+    min_beach_area: int
+        minimum number of connected sand pixels at full resolution
+    band_pixels: float
+        half-width of the band around the coarse contours (in pixels)
+
+    Returns:
+    -----------
+    im_band: np.array or None
+        binary image with True in the band around the coarse contours, None if no
+        contour was found on the downsampled image
+    im_bool: np.array or None
+        pixels to classify at full resolution (band widened by 5 pixels, as the pixels
+        used to compute the threshold in find_wl_contours2)
+
+    """
+
+    nrows, ncols = cloud_mask.shape
+    # pad the image to a multiple of the factor (repeating the last row/column)
+    pad = ((0, -nrows % factor), (0, -ncols % factor))
+    nr, nc = (nrows + pad[0][1])//factor, (ncols + pad[1][1])//factor
+    # average the reflectances in each block, a block is cloudy (or in the buffer) if any
+    # of its pixels is
+    im_coarse = np.pad(im_ms, pad + ((0,0),), mode='edge')
+    im_coarse = im_coarse.reshape(nr, factor, nc, factor, im_ms.shape[2]).mean(axis=(1,3))
+    cloud_coarse = np.pad(cloud_mask, pad, mode='edge').reshape(nr, factor, nc, factor).any(axis=(1,3))
+    buffer_coarse = np.pad(im_ref_buffer, pad, mode='edge').reshape(nr, factor, nc, factor).any(axis=(1,3))
+
+    # classify the downsampled image (only the pixels used to map the contours)
+    indices = dict([])
+    im_bool = morphology.binary_dilation(buffer_coarse, morphology.disk(int(np.ceil(5/factor))))
+    im_classif = predict_classes(im_coarse, cloud_coarse, clf, im_bool, indices)
+    im_labels = get_class_labels(im_classif, int(np.ceil(min_beach_area/factor**2)))
+
+    # map the contours as on the full resolution image
+    try:
+        if sum(im_labels[buffer_coarse,0]) < 50/factor**2:
+            im_mndwi = get_nd_index(im_coarse, cloud_coarse, 'MNDWI', indices)
+            contours, t_mndwi = find_wl_contours1(im_mndwi, cloud_coarse, buffer_coarse)
+        else:
+            contours, t_mndwi = find_wl_contours2(im_coarse, im_labels, cloud_coarse, buffer_coarse,
+                                                  indices)
+    except:
+        return None, None
+    contours = [_ for _ in contours if len(_) > 0]
+    if len(contours) == 0:
+        return None, None
+
+    # rasterize the contours at full resolution (centre of the blocks) and take the pixels
+    # within band_pixels of them (the distance transform is faster than a dilation)
+    im_line = np.zeros((nrows, ncols), dtype=bool)
+    for contour in contours:
+        pixels = rasterize_line(contour*factor + (factor - 1)/2, (nrows, ncols))
+        im_line[pixels[:,0], pixels[:,1]] = True
+    if not np.any(im_line):
+        return None, None
+    im_dist = ndimage.distance_transform_edt(~im_line)
+
+    return im_dist <= band_pixels, im_dist <= band_pixels + 5
+
+###################################################################################################
+# IMAGE CLASSIFICATION FUNCTIONS
+###################################################################################################
+
+def get_nd_index(im_ms, cloud_mask, name, indices=None):
+    """
+    Returns a normalized-difference index of the image (see ND_INDICES). If a dict
+    of indices is given, the index is only computed the first time it is requested
+    and is then stored in the dict, so that it can be shared between the
+    classification and the contour mapping of the same image.
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        RGB + downsampled NIR and SWIR
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+    name: str
+        name of the index ('NDWI', 'MNDWI', 'NIR-R', 'SWIR-NIR' or 'B-R')
+    indices: dict (optional)
+        indices of the same image already computed
+
+    Returns:    
+    -----------
+    im_nd: np.array
+        Image (2D) containing the index
+
+    """
+
+    if indices is not None and name in indices:
+        return indices[name]
+    i1, i2 = ND_INDICES[name]
+    im_nd = SDS_tools.nd_index(im_ms[:,:,i1], im_ms[:,:,i2], cloud_mask)
+    if indices is not None:
+        indices[name] = im_nd
+
+    return im_nd
+
+def calculate_features(im_ms, cloud_mask, im_bool, dtype=np.float64, indices=None):
+    """
+    Calculates features on the image that are used for the supervised classification. 
+    The features include spectral normalized-difference indices and standard 
+    deviation of the image for all the bands and indices.
+
+    KV WRL 2018
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        RGB + downsampled NIR and SWIR
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+    im_bool: np.array
+        2D array of boolean indicating where on the image to calculate the features
+    dtype: data-type
+        data type of the feature matrix (e.g., np.float32 to halve its memory usage)
+    indices: dict (optional)
+        spectral indices of the image already computed (see get_nd_index), the
+        indices computed here are added to it
+
+    Returns:    
+    -----------
+    features: np.array
+        matrix containing each feature (columns) calculated for all
+        the pixels (rows) indicated in im_bool
+        
+    """
+
+    # only compute the features around the selected pixels if they are not the whole image
+    if not np.all(im_bool):
+        return calculate_features_masked(im_ms, cloud_mask, im_bool, dtype)
+
+    # normalized-difference indices: NIR-G, SWIR-G, NIR-R, SWIR-NIR, B-R
+    idx_nd = list(ND_INDICES.keys())
+    n_bands = im_ms.shape[2]
+    n_features = 2*(n_bands + len(idx_nd))
+    # allocate the feature matrix once and fill the columns in place, one band or
+    # index at a time so that only 2D temporaries are created
+    features = np.empty((np.count_nonzero(im_bool), n_features), dtype=dtype)
+    for k in range(n_bands + len(idx_nd)):
+        # multispectral band or spectral index (each index is computed once)
+        if k < n_bands:
+            im_layer = im_ms[:,:,k]
+        else:
+            im_layer = get_nd_index(im_ms, cloud_mask, idx_nd[k - n_bands], indices)
+        features[:,k] = im_layer[im_bool]
+        # standard deviation of the band or index
+        features[:,n_bands + len(idx_nd) + k] = SDS_tools.image_std(im_layer, 1)[im_bool]
+
+    return features
+
+def calculate_features_masked(im_ms, cloud_mask, im_bool, dtype=np.float64, chunk_size=100000):
+    """
+    Same as calculate_features, but the bands and spectral indices are only computed
+    on the pixels indicated in im_bool and on their direct neighbours (needed for
+    the 3x3 standard deviation), instead of on the whole image. The cost is
+    proportional to the number of pixels in im_bool.
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        RGB + downsampled NIR and SWIR
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+    im_bool: np.array
+        2D array of boolean indicating where on the image to calculate the features
+    dtype: data-type
+        data type of the feature matrix (e.g., np.float32 to halve its memory usage)
+    chunk_size: int
+        number of pixels for which the standard deviation is computed at once
+
+    Returns:    
+    -----------
+    features: np.array
+        matrix containing each feature (columns) calculated for all
+        the pixels (rows) indicated in im_bool
+        
+    """
+
+    # normalized-difference indices: NIR-G, SWIR-G, NIR-R, SWIR-NIR, B-R
+    idx_nd = list(ND_INDICES.values())
+    nrows, ncols, n_bands = im_ms.shape
+    n_stack = n_bands + len(idx_nd)
+    # pixels in im_bool and their neighbours (1-pixel halo)
+    im_halo = morphology.binary_dilation(im_bool, morphology.square(3))
+    vec_halo = np.where(im_halo.reshape(nrows*ncols))[0]
+    # position of each pixel of the halo in the stack below
+    vec_pos = -np.ones(nrows*ncols, dtype=np.int64)
+    vec_pos[vec_halo] = np.arange(len(vec_halo))
+    # stack the bands and the spectral indices of the halo pixels
+    vec_ms = im_ms.reshape(nrows*ncols, n_bands)[vec_halo,:]
+    vec_stack = np.empty((len(vec_halo), n_stack))
+    vec_stack[:,:n_bands] = vec_ms
+    for k, (i1, i2) in enumerate(idx_nd):
+        vec_stack[:,n_bands + k] = np.divide(vec_ms[:,i1] - vec_ms[:,i2], vec_ms[:,i1] + vec_ms[:,i2])
+    vec_stack[cloud_mask.reshape(nrows*ncols)[vec_halo], n_bands:] = np.nan
+
+    rows, cols = np.where(im_bool)
+    features = np.empty((len(rows), 2*n_stack), dtype=dtype)
+    features[:,:n_stack] = vec_stack[vec_pos[rows*ncols + cols],:]
+    # offsets of the 3x3 moving window
+    drows, dcols = [_.reshape(1,9) for _ in np.meshgrid([-1,0,1], [-1,0,1], indexing='ij')]
+    for i in range(0, len(rows), chunk_size):
+        # neighbours of each pixel, mirrored at the edges of the image (as in SDS_tools.image_std)
+        rows_win = np.abs(rows[i:i+chunk_size].reshape(-1,1) + drows)
+        rows_win = np.clip(np.where(rows_win > nrows-1, 2*(nrows-1) - rows_win, rows_win), 0, nrows-1)
+        cols_win = np.abs(cols[i:i+chunk_size].reshape(-1,1) + dcols)
+        cols_win = np.clip(np.where(cols_win > ncols-1, 2*(ncols-1) - cols_win, cols_win), 0, ncols-1)
+        win = vec_stack[vec_pos[rows_win*ncols + cols_win],:]
+        # standard deviation of the valid pixels of each window
+        win_nan = np.isnan(win)
+        win[win_nan] = 0
+        win_count = np.sum(~win_nan, axis=1)
+        win_mean = np.sum(win, axis=1)/win_count
+        win_sqr_mean = np.sum(win**2, axis=1)/win_count
+        win_std = np.sqrt(win_sqr_mean - win_mean**2)
+        # preserve the NaNs
+        win_std[np.isnan(features[i:i+chunk_size,:n_stack])] = np.nan
+        features[i:i+chunk_size,n_stack:] = win_std
+
+    return features
+
+def classify_image_NN(im_ms, cloud_mask, min_beach_area, clf, im_bool=None, indices=None):
+    """
+    Classifies every pixel in the image in one of 4 classes:
+        - sand                                          --> label = 1
+        - whitewater (breaking waves and swash)         --> label = 2
+        - water                                         --> label = 3
+        - other (vegetation, buildings, rocks...)       --> label = 0
+
+    The classifier is a Neural Network that is already trained.
+
+    KV WRL 2018
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        Pansharpened RGB + downsampled NIR and SWIR
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+    min_beach_area: int
+        minimum number of pixels that have to be connected to belong to the SAND class
+    clf: dict or joblib object
+        pre-trained classifier (loaded with SDS_models.load_model)
+    im_bool: np.array (optional)
+        2D array of boolean indicating which pixels to classify, the other pixels
+        are left unclassified (by default the whole image is classified)
+    indices: dict (optional)
+        spectral indices of the image, shared with the contour mapping (see get_nd_index)
+
+    Returns:    
+    -----------
+    im_classif: np.array
+        2D image containing labels
+    im_labels: np.array of booleans
+        3D image containing a boolean image for each class (im_classif == label)
+
+    """
+
+    # classify pixels
+    im_classif = predict_classes(im_ms, cloud_mask, clf, im_bool, indices)
+    # create a stack of boolean images for each label
+    im_labels = get_class_labels(im_classif, min_beach_area)
+
+    return im_classif, im_labels
+
+def classify_image_cached(fn, satname, im_ms, cloud_mask, min_beach_area, clf, settings,
+                          im_bool=None, indices=None):
+    """
+    Same as classify_image_NN but the classification is stored in an on-disk cache,
+    so that the shorelines can be mapped again with different settings (e.g.,
+    min_length_sl, dist_clouds, max_dist_ref) without classifying the image again.
+    The classes are stored as uint8 codes and the labels are bit-packed.
+    The cache is only used if settings['classif_cache'] is True, otherwise this
+    function simply calls classify_image_NN.
+
+    Arguments:
+    -----------
+    fn: str or list of str
+        filename of the .TIF file containing the image
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    im_ms, cloud_mask, min_beach_area, clf, im_bool, indices:
+        same as classify_image_NN
+    settings: dict with the following keys
+        'inputs': dict
+            input parameters (sitename, filepath, polygon, dates, sat_list, landsat_collection)
+        'cloud_mask_issue': boolean
+            True if there is an issue with the cloud mask and sand pixels
+            are erroneously being masked on the images
+        'pan_off': boolean
+            if True, disable panchromatic sharpening and ignore pan band
+        'classif_cache': boolean (optional)
+            if True, the classifications are cached
+        'cache_dir': str (optional)
+            directory of the cache, by default a folder named cache in the data folder
+        'cache_size': float (optional)
+            maximum size of the cache in MB (default 2000 MB)
+
+    Returns:
+    -----------
+    Same outputs as classify_image_NN
+
+    """
+
+    if not settings.get('classif_cache', False):
+        return classify_image_NN(im_ms, cloud_mask, min_beach_area, clf, im_bool, indices)
+
+    cache_dir, key = get_classif_cache_key(fn, satname, min_beach_area, clf, settings, im_bool)
+    result = load_classif(cache_dir, key)
+    if result is not None:
+        return result
+
+    # if not in the cache, classify the image and store it
+    im_classif, im_labels = classify_image_NN(im_ms, cloud_mask, min_beach_area, clf, im_bool, indices)
+    save_classif(cache_dir, key, im_classif, im_labels, settings.get('cache_size', 2000))
+
+    return im_classif, im_labels
+
+def get_classif_cache_key(fn, satname, min_beach_area, clf, settings, im_bool=None):
+    """
+    Returns the cache directory and the key of the classification of an image
+    (see classify_image_cached), the key depends on the image, on the classifier
+    and on the pixels that are classified.
+
+    Arguments:
+    -----------
+    fn, satname, min_beach_area, clf, settings, im_bool:
+        same as classify_image_cached
+
+    Returns:
+    -----------
+    cache_dir: str
+        directory of the cache (created if needed)
+    key: str
+        name of the cache entry
 
     """
 
-    sitename = settings['inputs']['sitename']
-    filepath_data = settings['inputs']['filepath']
-    collection = settings['inputs']['landsat_collection']
-    filepath_models = os.path.join(os.getcwd(), 'classification', 'models')
-    # initialise output structure
-    output = dict([])
-    # create a subfolder to store the .jpg images showing the detection
-    filepath_jpg = os.path.join(filepath_data, sitename, 'jpg_files', 'detection')
-    if not os.path.exists(filepath_jpg):
-            os.makedirs(filepath_jpg)
-    # close all open figures
-    plt.close('all')
+    cache_dir = settings.get('cache_dir', os.path.join(settings['inputs']['filepath'], 'cache'))
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    mask_hash = None
+    if im_bool is not None:
+        mask_hash = hashlib.md5(np.packbits(im_bool, axis=None).tobytes()).hexdigest()
+    key = SDS_cache.get_cache_key(fn, ('classif', satname, settings['cloud_mask_issue'],
+                                       settings['pan_off'], settings['inputs']['landsat_collection'],
+                                       SDS_models.get_model_hash(clf), min_beach_area, mask_hash))
 
-    print('Mapping shorelines:')
+    return cache_dir, key
 
-    default_min_length_sl = settings['min_length_sl']
-    # loop through satellite list
-    for satname in metadata.keys():
+def load_classif(cache_dir, key):
+    """
+    Reads a classification from the cache.
 
-        # get images
-        filepath = SDS_tools.get_filepath(settings['inputs'],satname)
-        filenames = metadata[satname]['filenames']
-
-        # initialise the output variables
-        output_timestamp = []  # datetime at which the image was acquired (UTC time)
-        output_shoreline = []  # vector of shoreline points
-        output_filename = []   # filename of the images from which the shorelines where derived
-        output_cloudcover = [] # cloud cover of the images
-        output_geoaccuracy = []# georeferencing accuracy of the images
-        output_idxkeep = []    # index that were kept during the analysis (cloudy images are skipped)
-        output_t_mndwi = []    # MNDWI threshold used to map the shoreline
-
-        # load classifiers (if sklearn version above 0.20, learn the new files)
-        str_new = ''
-        if not sklearn.__version__[:4] == '0.20':
-            str_new = '_new'
-        if satname in ['L5','L7','L8','L9']:
-            pixel_size = 15
-            if settings['sand_color'] == 'dark':
-                clf = joblib.load(os.path.join(filepath_models, 'NN_4classes_Landsat_dark%s.pkl'%str_new))
-            elif settings['sand_color'] == 'bright':
-                clf = joblib.load(os.path.join(filepath_models, 'NN_4classes_Landsat_bright%s.pkl'%str_new))
-            elif settings['sand_color'] == 'default':
-                clf = joblib.load(os.path.join(filepath_models, 'NN_4classes_Landsat%s.pkl'%str_new))
-            elif settings['sand_color'] == 'latest':
-                clf = joblib.load(os.path.join(filepath_models, 'NN_4classes_Landsat_latest%s.pkl'%str_new))   
-        elif satname == 'S2':
-            pixel_size = 10
-            clf = joblib.load(os.path.join(filepath_models, 'NN_4classes_S2%s.pkl'%str_new))
-
-        # convert settings['min_beach_area'] from metres to pixels
-        min_beach_area_pixels = np.ceil(settings['min_beach_area']/pixel_size**2)
-        # reduce min shoreline length for L7 because of the diagonal bands
-        if satname == 'L7': settings['min_length_sl'] = 200
-        else: settings['min_length_sl'] = default_min_length_sl
-        
-        # loop through the images
-        for i in range(len(filenames)):
-
-            print('\r%s:   %d%%' % (satname,int(((i+1)/len(filenames))*100)), end='')
-
-            # get image filename
-            fn = SDS_tools.get_filenames(filenames[i],filepath, satname)
-            # preprocess image (cloud mask + pansharpening/downsampling)
-            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = SDS_preprocess.preprocess_single(fn, satname, 
-                                                                                                     settings['cloud_mask_issue'], 
-                                                                                                     settings['pan_off'],
-                                                                                                     collection)
-            # get image spatial reference system (epsg code) from metadata dict
-            image_epsg = metadata[satname]['epsg'][i]
-            
-            # compute cloud_cover percentage (with no data pixels)
-            cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
-                                    (cloud_mask.shape[0]*cloud_mask.shape[1]))
-            if cloud_cover_combined > 0.99: # if 99% of cloudy pixels in image skip
-                continue
-            # remove no data pixels from the cloud mask 
-            # (for example L7 bands of no data should not be accounted for)
-            cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata) 
-            # compute updated cloud cover percentage (without no data pixels)
-            cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
-                                    (sum(sum((~im_nodata).astype(int)))))
-            # skip image if cloud cover is above user-defined threshold
-            if cloud_cover > settings['cloud_thresh']:
-                continue
+    Arguments:
+    -----------
+    cache_dir: str
+        directory of the cache
+    key: str
+        name of the cache entry
 
-            # calculate a buffer around the reference shoreline (if any has been digitised)
-            im_ref_buffer = create_shoreline_buffer(cloud_mask.shape, georef, image_epsg,
-                                                    pixel_size, settings)
+    Returns:
+    -----------
+    result: tuple or None
+        (im_classif, im_labels), None if the classification is not in the cache
 
-            # classify image in 4 classes (sand, whitewater, water, other) with NN classifier
-            im_classif, im_labels = classify_image_NN(im_ms, cloud_mask, min_beach_area_pixels, clf)
-            
-            # if adjust_detection is True, let the user adjust the detected shoreline
-            if settings['adjust_detection']:
-                date = filenames[i][:19]
-                skip_image, shoreline, t_mndwi = adjust_detection(im_ms, cloud_mask, im_nodata, im_labels,
-                                                                  im_ref_buffer, image_epsg, georef,
-                                                                  settings, date, satname)
-                # if the user decides to skip the image, continue and do not save the mapped shoreline
-                if skip_image:
-                    continue
-                
-            # otherwise map the contours automatically with one of the two following functions:
-            # if there are pixels in the 'sand' class --> use find_wl_contours2 (enhanced)
-            # otherwise use find_wl_contours1 (traditional)
-            else:
-                try: # use try/except structure for long runs
-                    if sum(im_labels[im_ref_buffer,0]) < 50: # minimum number of sand pixels
-                        # compute MNDWI image (SWIR-G)
-                        im_mndwi = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
-                        # find water contours on MNDWI grayscale image
-                        contours_mwi, t_mndwi = find_wl_contours1(im_mndwi, cloud_mask, im_ref_buffer)
-                    else:
-                        # use classification to refine threshold and extract the sand/water interface
-                        contours_mwi, t_mndwi = find_wl_contours2(im_ms, im_labels, cloud_mask, im_ref_buffer)
-                except:
-                    print('Could not map shoreline for this image: ' + filenames[i])
-                    continue
-    
-                # process the water contours into a shoreline
-                shoreline = process_shoreline(contours_mwi, cloud_mask_adv, im_nodata,
-                                              georef, image_epsg, settings)
-    
-                # visualise the mapped shorelines, there are two options:
-                # if settings['check_detection'] = True, shows the detection to the user for accept/reject
-                # if settings['save_figure'] = True, saves a figure for each mapped shoreline
-                if settings['check_detection'] or settings['save_figure']:
-                    date = filenames[i][:19]
-                    if not settings['check_detection']:
-                        plt.ioff() # turning interactive plotting off
-                    skip_image = show_detection(im_ms, cloud_mask, im_labels, shoreline,
-                                                image_epsg, georef, settings, date, satname)
-                    # if the user decides to skip the image, continue and do not save the mapped shoreline
-                    if skip_image:
-                        continue
+    """
 
-            # append to output variables
-            output_timestamp.append(metadata[satname]['dates'][i])
-            output_shoreline.append(shoreline)
-            output_filename.append(filenames[i])
-            output_cloudcover.append(cloud_cover)
-            output_geoaccuracy.append(metadata[satname]['acc_georef'][i])
-            output_idxkeep.append(i)
-            output_t_mndwi.append(t_mndwi)
-
-        # create dictionnary of output
-        output[satname] = {
-                'dates': output_timestamp,
-                'shorelines': output_shoreline,
-                'filename': output_filename,
-                'cloud_cover': output_cloudcover,
-                'geoaccuracy': output_geoaccuracy,
-                'idx': output_idxkeep,
-                'MNDWI_threshold': output_t_mndwi,
-                }
-        print('')
+    entry = SDS_cache.load_entry(cache_dir, key, ['im_classif', 'im_labels'])
+    if entry is None:
+        return None
+    # unclassified (and cloudy) pixels are stored with the code 255
+    codes = entry['im_classif']
+    im_classif = codes.astype(float)
+    im_classif[codes == 255] = np.nan
 
-    # close figure window if still open
-    if plt.get_fignums():
-        plt.close()
+    return im_classif, entry['im_labels']
 
-    # change the format to have one list sorted by date with all the shorelines (easier to use)
-    output = SDS_tools.merge_output(output)
+def save_classif(cache_dir, key, im_classif, im_labels, max_size):
+    """
+    Stores a classification in the cache, the classes as uint8 codes and the labels
+    bit-packed.
 
-    # save outputput structure as output.pkl
-    filepath = os.path.join(filepath_data, sitename)
-    with open(os.path.join(filepath, sitename + '_output.pkl'), 'wb') as f:
-        pickle.dump(output, f)
+    Arguments:
+    -----------
+    cache_dir: str
+        directory of the cache
+    key: str
+        name of the cache entry
+    im_classif: np.array
+        2D image containing labels (NaN for cloudy and unclassified pixels)
+    im_labels: np.array
+        3D image containing a boolean image for each class
+    max_size: float
+        maximum size of the cache in MB
 
-    return output
+    Returns:
+    -----------
+    Stores the entry in the cache
 
-###################################################################################################
-# IMAGE CLASSIFICATION FUNCTIONS
-###################################################################################################
+    """
+
+    codes = np.where(np.isnan(im_classif), 255, im_classif).astype(np.uint8)
+    SDS_cache.save_entry(cache_dir, key, {'im_classif':codes}, {'im_labels':im_labels}, max_size)
 
-def calculate_features(im_ms, cloud_mask, im_bool):
+def classify_image_windowed(image, min_beach_area, clf, im_bool=None):
     """
-    Calculates features on the image that are used for the supervised classification. 
-    The features include spectral normalized-difference indices and standard 
-    deviation of the image for all the bands and indices.
+    Same as classify_image_NN, but for an image prepared with
+    SDS_preprocess.preprocess_windowed. The image is preprocessed and classified
+    window by window (with a 1-pixel halo for the standard deviation features) and
+    the windows are stitched into the full-size images, which are identical to the
+    ones obtained with preprocess_single and classify_image_NN.
+
+    Arguments:
+    -----------
+    image: dict
+        output of SDS_preprocess.preprocess_windowed
+    min_beach_area: int
+        minimum number of pixels that have to be connected to belong to the SAND class
+    clf: dict or joblib object
+        pre-trained classifier (loaded with SDS_models.load_model)
+    im_bool: np.array (optional)
+        2D array of boolean indicating which pixels to classify, the other pixels
+        are left unclassified (by default the whole image is classified)
+
+    Returns:    
+    -----------
+    im_ms: np.array
+        Pansharpened RGB + downsampled NIR and SWIR
+    im_classif: np.array
+        2D image containing labels
+    im_labels: np.array of booleans
+        3D image containing a boolean image for each class (im_classif == label)
+
+    """
+
+    nrows, ncols = image['cloud_mask'].shape
+    im_ms = None
+    im_classif = np.empty((nrows, ncols))
+    # the features use a 3x3 moving window, hence a halo of 1 row around each window
+    for rows_read, rows_win, rows_im in SDS_preprocess.get_windows(nrows, image['window_rows'], 1):
+        im_ms_win, cloud_mask_win = SDS_preprocess.preprocess_window(image, rows_read)
+        im_classif_win = predict_classes(im_ms_win, cloud_mask_win, clf,
+                                         None if im_bool is None else im_bool[rows_read,:])
+        # stitch the window (without the halo) into the full-size images
+        if im_ms is None:
+            im_ms = np.empty((nrows, ncols, im_ms_win.shape[2]), dtype=im_ms_win.dtype)
+        im_ms[rows_im,:,:] = im_ms_win[rows_win,:,:]
+        im_classif[rows_im,:] = im_classif_win[rows_win,:]
+    # the small patches of sand and water are removed on the full-size image
+    im_labels = get_class_labels(im_classif, min_beach_area)
+
+    return im_ms, im_classif, im_labels
+
+def predict_classes(im_ms, cloud_mask, clf, im_bool=None, indices=None):
+    """
+    Classifies every pixel of the image (or only the pixels in im_bool) with the
+    pre-trained classifier.
 
     KV WRL 2018
 
     Arguments:
     -----------
     im_ms: np.array
-        RGB + downsampled NIR and SWIR
+        Pansharpened RGB + downsampled NIR and SWIR
     cloud_mask: np.array
         2D cloud mask with True where cloud pixels are
-    im_bool: np.array
-        2D array of boolean indicating where on the image to calculate the features
+    clf: dict or joblib object
+        pre-trained classifier (loaded with SDS_models.load_model)
+    im_bool: np.array (optional)
+        2D array of boolean indicating which pixels to classify (by default all)
+    indices: dict (optional)
+        spectral indices of the image, shared with the contour mapping (see get_nd_index)
 
     Returns:    
     -----------
-    features: np.array
-        matrix containing each feature (columns) calculated for all
-        the pixels (rows) indicated in im_bool
-        
+    im_classif: np.array
+        2D image containing labels (NaN for cloudy and unclassified pixels)
+
     """
 
-    # add all the multispectral bands
-    features = np.expand_dims(im_ms[im_bool,0],axis=1)
-    for k in range(1,im_ms.shape[2]):
-        feature = np.expand_dims(im_ms[im_bool,k],axis=1)
-        features = np.append(features, feature, axis=-1)
-    # NIR-G
-    im_NIRG = SDS_tools.nd_index(im_ms[:,:,3], im_ms[:,:,1], cloud_mask)
-    features = np.append(features, np.expand_dims(im_NIRG[im_bool],axis=1), axis=-1)
-    # SWIR-G
-    im_SWIRG = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
-    features = np.append(features, np.expand_dims(im_SWIRG[im_bool],axis=1), axis=-1)
-    # NIR-R
-    im_NIRR = SDS_tools.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask)
-    features = np.append(features, np.expand_dims(im_NIRR[im_bool],axis=1), axis=-1)
-    # SWIR-NIR
-    im_SWIRNIR = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,3], cloud_mask)
-    features = np.append(features, np.expand_dims(im_SWIRNIR[im_bool],axis=1), axis=-1)
-    # B-R
-    im_BR = SDS_tools.nd_index(im_ms[:,:,0], im_ms[:,:,2], cloud_mask)
-    features = np.append(features, np.expand_dims(im_BR[im_bool],axis=1), axis=-1)
-    # calculate standard deviation of individual bands
-    for k in range(im_ms.shape[2]):
-        im_std =  SDS_tools.image_std(im_ms[:,:,k], 1)
-        features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    # calculate standard deviation of the spectral indices
-    im_std = SDS_tools.image_std(im_NIRG, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_SWIRG, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_NIRR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_SWIRNIR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_BR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
+    # calculate the features of the pixels to classify
+    vec_features, vec_mask, im_bool = get_valid_features(im_ms, cloud_mask, im_bool, indices)
+    # classify pixels (if any is not cloudy) and recompose image
+    vec_labels = SDS_models.predict(clf, vec_features) if vec_features.shape[0] > 0 else []
 
-    return features
+    return recompose_classes(cloud_mask.shape, im_bool, vec_mask, vec_labels)
 
-def classify_image_NN(im_ms, cloud_mask, min_beach_area, clf):
+def predict_classes_batch(images, clf):
     """
-    Classifies every pixel in the image in one of 4 classes:
-        - sand                                          --> label = 1
-        - whitewater (breaking waves and swash)         --> label = 2
-        - water                                         --> label = 3
-        - other (vegetation, buildings, rocks...)       --> label = 0
+    Classifies the pixels of several images with a single call to the classifier:
+    the features of the valid pixels of all the images are concatenated, classified
+    and the labels are scattered back into each image. Gives the same result as
+    predict_classes on each image.
 
-    The classifier is a Neural Network that is already trained.
+    Arguments:
+    -----------
+    images: list of tuples
+        (im_ms, cloud_mask, im_bool, indices) for each image, as the arguments of
+        predict_classes
+    clf: dict or joblib object
+        pre-trained classifier (loaded with SDS_models.load_model)
 
-    KV WRL 2018
+    Returns:    
+    -----------
+    classifs: list of np.array
+        im_classif of each image (NaN for cloudy and unclassified pixels)
+
+    """
+
+    # a single image is classified directly (no copy of its features)
+    if len(images) == 1:
+        return [predict_classes(*images[0][:2], clf, *images[0][2:])]
+
+    # calculate the features of the pixels to classify in each image, only the masks
+    # are kept once the features have been concatenated
+    vec_features = []
+    masks = []
+    for image in images:
+        features_image, vec_mask, im_bool = get_valid_features(*image)
+        vec_features.append(features_image)
+        masks.append((features_image.shape[0], vec_mask, im_bool))
+    del features_image
+    vec_features = np.concatenate(vec_features, axis=0)
+    # classify all the pixels at once
+    vec_labels = []
+    if vec_features.shape[0] > 0:
+        vec_labels = SDS_models.predict(clf, vec_features)
+    del vec_features
+    # scatter the labels back into each image
+    classifs = []
+    start = 0
+    for k in range(len(images)):
+        n_pixels, vec_mask, im_bool = masks[k]
+        classifs.append(recompose_classes(images[k][1].shape, im_bool, vec_mask,
+                                          vec_labels[start:start+n_pixels]))
+        start += n_pixels
+
+    return classifs
+
+def get_valid_features(im_ms, cloud_mask, im_bool=None, indices=None):
+    """
+    Calculates the features of the pixels to classify and removes the cloudy
+    pixels and the pixels with invalid (infinite) features.
 
     Arguments:
     -----------
-    im_ms: np.array
-        Pansharpened RGB + downsampled NIR and SWIR
-    cloud_mask: np.array
-        2D cloud mask with True where cloud pixels are
-    min_beach_area: int
-        minimum number of pixels that have to be connected to belong to the SAND class
-    clf: joblib object
-        pre-trained classifier
+    im_ms, cloud_mask, im_bool, indices:
+        same as predict_classes
 
     Returns:    
     -----------
-    im_classif: np.array
-        2D image containing labels
-    im_labels: np.array of booleans
-        3D image containing a boolean image for each class (im_classif == label)
+    vec_features: np.array
+        features of the valid pixels
+    vec_mask: np.array
+        True for the pixels of im_bool that were removed
+    im_bool: np.array
+        2D array of boolean indicating which pixels were considered
 
     """
 
+    if im_bool is None:
+        im_bool = np.ones(cloud_mask.shape).astype(bool)
     # calculate features
-    vec_features = calculate_features(im_ms, cloud_mask, np.ones(cloud_mask.shape).astype(bool))
+    vec_features = calculate_features(im_ms, cloud_mask, im_bool, indices=indices)
     vec_features[np.isnan(vec_features)] = 1e-9 # NaN values are create when std is too close to 0
 
     # remove NaNs and cloudy pixels
-    vec_cloud = cloud_mask.reshape(cloud_mask.shape[0]*cloud_mask.shape[1])
+    vec_cloud = cloud_mask[im_bool]
     vec_nan = np.any(np.isnan(vec_features), axis=1)
     vec_inf = np.any(np.isinf(vec_features), axis=1)    
     vec_mask = np.logical_or(vec_cloud,np.logical_or(vec_nan,vec_inf))
     vec_features = vec_features[~vec_mask, :]
 
-    # classify pixels
-    labels = clf.predict(vec_features)
+    return vec_features, vec_mask, im_bool
+
+def recompose_classes(im_shape, im_bool, vec_mask, vec_labels):
+    """
+    Recomposes the classified image from the labels of the valid pixels.
+
+    Arguments:
+    -----------
+    im_shape: tuple
+        shape of the image
+    im_bool: np.array
+        2D array of boolean indicating which pixels were considered
+    vec_mask: np.array
+        True for the pixels of im_bool that were not classified
+    vec_labels: np.array
+        labels of the classified pixels
+
+    Returns:    
+    -----------
+    im_classif: np.array
+        2D image containing labels (NaN for cloudy and unclassified pixels)
+
+    """
 
-    # recompose image
-    vec_classif = np.nan*np.ones((cloud_mask.shape[0]*cloud_mask.shape[1]))
-    vec_classif[~vec_mask] = labels
-    im_classif = vec_classif.reshape((cloud_mask.shape[0], cloud_mask.shape[1]))
+    im_classif = np.nan*np.ones(im_shape)
+    if len(vec_labels) > 0:
+        vec_classif = np.nan*np.ones(len(vec_mask))
+        vec_classif[~vec_mask] = vec_labels
+        im_classif[im_bool] = vec_classif
+
+    return im_classif
+
+def get_class_labels(im_classif, min_beach_area):
+    """
+    Creates a stack of boolean images for the sand, whitewater and water classes
+    and removes the small patches of sand and water.
+
+    Arguments:
+    -----------
+    im_classif: np.array
+        2D image containing labels
+    min_beach_area: int
+        minimum number of pixels that have to be connected to belong to the SAND class
+
+    Returns:    
+    -----------
+    im_labels: np.array of booleans
+        3D image containing a boolean image for each class (im_classif == label)
+
+    """
 
     # create a stack of boolean images for each label
     im_sand = im_classif == 1
@@ -383,7 +1588,7 @@ def classify_image_NN(im_ms, cloud_mask, min_beach_area, clf):
 
     im_labels = np.stack((im_sand,im_swash,im_water), axis=-1)
 
-    return im_classif, im_labels
+    return im_labels
 
 ###################################################################################################
 # CONTOUR MAPPING FUNCTIONS
@@ -429,16 +1634,14 @@ def find_wl_contours1(im_ndwi, cloud_mask, im_ref_buffer):
     # apply otsu's threshold
     vec = vec[~np.isnan(vec)]
     t_otsu = filters.threshold_otsu(vec)
-    # use Marching Squares algorithm to detect contours on ndwi image
-    im_ndwi_buffer = np.copy(im_ndwi)
-    im_ndwi_buffer[~im_ref_buffer] = np.nan
-    contours = measure.find_contours(im_ndwi_buffer, t_otsu)
+    # use Marching Squares algorithm to detect contours on ndwi image (within the buffer)
+    contours = find_contours_buffer(im_ndwi, t_otsu, im_ref_buffer)
     # remove contours that contain NaNs (due to cloud pixels in the contour)
     contours = process_contours(contours)
 
     return contours, t_otsu
 
-def find_wl_contours2(im_ms, im_labels, cloud_mask, im_ref_buffer):
+def find_wl_contours2(im_ms, im_labels, cloud_mask, im_ref_buffer, indices=None, seed=0):
     """
     New robust method for extracting shorelines. Incorporates the classification
     component to refine the treshold and make it specific to the sand/water interface.
@@ -455,6 +1658,11 @@ def find_wl_contours2(im_ms, im_labels, cloud_mask, im_ref_buffer):
         2D cloud mask with True where cloud pixels are
     im_ref_buffer: np.array
         binary image containing a buffer around the reference shoreline
+    indices: dict (optional)
+        spectral indices of the image already computed (see get_nd_index)
+    seed: int (optional)
+        seed of the random generator used to sample the larger class, the same seed
+        always gives the same threshold (default 0)
 
     Returns:    
     -----------
@@ -466,57 +1674,143 @@ def find_wl_contours2(im_ms, im_labels, cloud_mask, im_ref_buffer):
 
     """
 
-    nrows = cloud_mask.shape[0]
-    ncols = cloud_mask.shape[1]
-
     # calculate Normalized Difference Modified Water Index (SWIR - G)
-    im_mwi = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
+    im_mwi = get_nd_index(im_ms, cloud_mask, 'MNDWI', indices)
     # calculate Normalized Difference Modified Water Index (NIR - G)
-    im_wi = SDS_tools.nd_index(im_ms[:,:,3], im_ms[:,:,1], cloud_mask)
-    # stack indices together
-    im_ind = np.stack((im_wi, im_mwi), axis=-1)
-    vec_ind = im_ind.reshape(nrows*ncols,2)
-
-    # reshape labels into vectors
-    vec_sand = im_labels[:,:,0].reshape(ncols*nrows)
-    vec_water = im_labels[:,:,2].reshape(ncols*nrows)
+    im_wi = get_nd_index(im_ms, cloud_mask, 'NDWI', indices)
 
     # use im_ref_buffer and dilate it by 5 pixels
     se = morphology.disk(5)
     im_ref_buffer_extra = morphology.binary_dilation(im_ref_buffer, se)
-    # create a buffer around the sandy beach
-    vec_buffer = im_ref_buffer_extra.reshape(nrows*ncols)
     
-    # select water/sand pixels that are within the buffer
-    int_water = vec_ind[np.logical_and(vec_buffer,vec_water),:]
-    int_sand = vec_ind[np.logical_and(vec_buffer,vec_sand),:]
-
-    # make sure both classes have the same number of pixels before thresholding
+    # select water/sand pixels that are within the buffer (only the NIR-G index is
+    # used for the threshold)
+    im_water = np.logical_and(im_ref_buffer_extra, im_labels[:,:,2])
+    im_sand = np.logical_and(im_ref_buffer_extra, im_labels[:,:,0])
+    int_water = im_wi[im_water]
+    int_sand = im_wi[im_sand]
+
+    # make sure both classes have the same number of pixels before thresholding, the
+    # larger class is sampled without replacement with a seeded generator (no shuffle
+    # as the order of the pixels does not change the histogram)
     if len(int_water) > 0 and len(int_sand) > 0:
-        if np.argmin([int_sand.shape[0],int_water.shape[0]]) == 1:
-            int_sand = int_sand[np.random.choice(int_sand.shape[0],int_water.shape[0], replace=False),:]
-        else:
-            int_water = int_water[np.random.choice(int_water.shape[0],int_sand.shape[0], replace=False),:]
+        rng = np.random.default_rng(seed)
+        if len(int_sand) > len(int_water):
+            int_sand = int_sand[rng.choice(len(int_sand), len(int_water), replace=False, shuffle=False)]
+        elif len(int_water) > len(int_sand):
+            int_water = int_water[rng.choice(len(int_water), len(int_sand), replace=False, shuffle=False)]
 
     # threshold the sand/water intensities
-    int_all = np.append(int_water,int_sand, axis=0)
-    t_mwi = filters.threshold_otsu(int_all[:,0])
-    t_wi = filters.threshold_otsu(int_all[:,1])
-
-    # find contour with Marching-Squares algorithm
-    im_wi_buffer = np.copy(im_wi)
-    im_wi_buffer[~im_ref_buffer] = np.nan
-    im_mwi_buffer = np.copy(im_mwi)
-    im_mwi_buffer[~im_ref_buffer] = np.nan
-    contours_wi = measure.find_contours(im_wi_buffer, t_wi)
-    contours_mwi = measure.find_contours(im_mwi_buffer, t_mwi)
+    t_mwi = threshold_otsu_classes([int_water, int_sand])
+
+    # find contour with Marching-Squares algorithm (within the buffer)
+    contours_mwi = find_contours_buffer(im_mwi, t_mwi, im_ref_buffer)
     # remove contour points that are NaNs (around clouds)
-    contours_wi = process_contours(contours_wi)
     contours_mwi = process_contours(contours_mwi)
 
     # only return MNDWI contours and threshold
     return contours_mwi, t_mwi
 
+def threshold_otsu_classes(values, nbins=256):
+    """
+    Otsu threshold of the values of several classes, computed from the sum of the
+    histograms of each class (on the same bins) instead of concatenating the values.
+    Gives the same threshold as skimage.filters.threshold_otsu on the concatenated
+    values (float values, same number of bins).
+
+    Arguments:
+    -----------
+    values: list of np.array
+        1D arrays with the values of each class
+    nbins: int
+        number of bins of the histogram
+
+    Returns:    
+    -----------
+    threshold: float
+        Otsu threshold
+
+    """
+
+    values = [_ for _ in values if len(_) > 0]
+    if len(values) == 0:
+        raise Exception('no values to threshold')
+    # range of all the values (bins of np.histogram as in threshold_otsu)
+    vmin = min([np.min(_) for _ in values])
+    vmax = max([np.max(_) for _ in values])
+    # a single value is returned as the threshold (as threshold_otsu)
+    if vmin == vmax:
+        return vmin
+    # the bins do not depend on the values of the other classes, so the sum of the
+    # histograms is the histogram of the concatenated values
+    counts = np.zeros(nbins, dtype=np.int64)
+    for vals in values:
+        counts_class, bin_edges = np.histogram(vals, bins=nbins, range=(vmin, vmax))
+        counts += counts_class
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2.
+
+    return filters.threshold_otsu(hist=(counts, bin_centers))
+
+def find_contours_buffer(im, level, im_buffer):
+    """
+    Same as skimage.measure.find_contours on the image with NaNs outside the buffer,
+    but the Marching Squares algorithm is only run on the bounding windows of the
+    connected regions of the buffer. The contours are shifted back into image
+    coordinates and returned in the same order as find_contours would.
+
+    Arguments:
+    -----------
+    im: np.array
+        2D image (e.g., spectral index) to contour
+    level: float
+        value along which to find the contours
+    im_buffer: np.array
+        binary image, True where the contours can be mapped
+
+    Returns:    
+    -----------
+    contours: list of np.arrays
+        contains the coordinates (row, column) of the contour lines
+
+    """
+
+    # if the buffer is the whole image, there is nothing to mask
+    if np.all(im_buffer):
+        return measure.find_contours(im, level)
+
+    # the contours only go through squares of 4 pixels inside the buffer, so each
+    # contour is inside one connected region of the buffer. The regions are found on
+    # blocks of 8x8 pixels (a block is in the buffer if any of its pixels is), which
+    # is much faster and can only merge regions that are close to each other
+    block = 8
+    nrows, ncols = im_buffer.shape
+    im_blocks = np.logical_or.reduceat(im_buffer, np.arange(0, nrows, block), axis=0)
+    im_blocks = np.logical_or.reduceat(im_blocks, np.arange(0, ncols, block), axis=1)
+    im_regions, n_regions = ndimage.label(im_blocks, structure=np.ones((3,3)))
+    contours = []
+    keys = []
+    for k, window_blocks in enumerate(ndimage.find_objects(im_regions)):
+        window = (slice(window_blocks[0].start*block, min(window_blocks[0].stop*block, nrows)),
+                  slice(window_blocks[1].start*block, min(window_blocks[1].stop*block, ncols)))
+        # the windows of two regions can overlap, only keep the pixels of this region
+        im_region = np.repeat(np.repeat(im_regions[window_blocks] == k + 1, block, axis=0), block, axis=1)
+        im_region = np.logical_and(im_region[:window[0].stop - window[0].start,:window[1].stop - window[1].start],
+                                   im_buffer[window])
+        im_window = np.array(im[window], dtype=float)
+        im_window[~im_region] = np.nan
+        offset = np.array([window[0].start, window[1].start])
+        for contour in measure.find_contours(im_window, level):
+            contour = contour + offset
+            contours.append(contour)
+            # find_contours sorts the contours by the first square (top->bottom,
+            # left->right) that they go through
+            rows_seg = np.floor(np.minimum(contour[:-1,0], contour[1:,0]))
+            cols_seg = np.floor(np.minimum(contour[:-1,1], contour[1:,1]))
+            keys.append(np.min(rows_seg*ncols + cols_seg))
+    contours = [contours[_] for _ in np.argsort(keys, kind='stable')]
+
+    return contours
+
 ###################################################################################################
 # SHORELINE PROCESSING FUNCTIONS
 ###################################################################################################
@@ -525,6 +1819,8 @@ def create_shoreline_buffer(im_shape, georef, image_epsg, pixel_size, settings):
     """
     Creates a buffer around the reference shoreline. The size of the buffer is 
     given by settings['max_dist_ref'].
+    The buffers are cached, so that the images on the same grid (same georef,
+    shape and epsg) reuse the same buffer, which is returned as a read-only array.
 
     KV WRL 2018
 
@@ -542,7 +1838,8 @@ def create_shoreline_buffer(im_shape, georef, image_epsg, pixel_size, settings):
         'output_epsg': int
             output spatial reference system
         'reference_shoreline': np.array
-            coordinates of the reference shoreline
+            coordinates of the reference shoreline (the different parts can be
+            separated by NaNs)
         'max_dist_ref': int
             maximum distance from the reference shoreline in metres
 
@@ -552,35 +1849,86 @@ def create_shoreline_buffer(im_shape, georef, image_epsg, pixel_size, settings):
         binary image, True where the buffer is, False otherwise
 
     """
-    # initialise the image buffer
-    im_buffer = np.ones(im_shape).astype(bool)
 
-    if 'reference_shoreline' in settings.keys():
+    if not 'reference_shoreline' in settings.keys():
+        # the buffer is the whole image
+        return np.ones(im_shape).astype(bool)
+
+    ref_sl = np.asarray(settings['reference_shoreline'], dtype=float)
+    key = (tuple(im_shape), tuple(np.asarray(georef, dtype=float)), image_epsg, pixel_size,
+           settings['output_epsg'], settings['max_dist_ref'], hashlib.md5(ref_sl.tobytes()).hexdigest())
+    if key in _buffer_cache:
+        # move the buffer to the end (most recently used)
+        im_buffer = _buffer_cache.pop(key)
+        _buffer_cache[key] = im_buffer
+        return im_buffer
+
+    # convert reference shoreline to pixel coordinates
+    ref_sl_conv = SDS_tools.convert_epsg(ref_sl, settings['output_epsg'],image_epsg)
+    ref_sl_pix = SDS_tools.convert_world2pix(ref_sl_conv, georef)
+
+    # create binary image of the reference shoreline (1 where the shoreline is 0 otherwise)
+    im_binary = np.zeros(im_shape).astype(bool)
+    im_binary[tuple(rasterize_line(ref_sl_pix[:,[1,0]], im_shape).T)] = True
+
+    # the buffer contains the pixels within max_dist_ref of the reference shoreline
+    # (same as a dilation with a disk), only computed around the reference shoreline
+    max_dist_ref_pixels = np.ceil(settings['max_dist_ref']/pixel_size)
+    im_buffer = np.zeros(im_shape).astype(bool)
+    if np.any(im_binary):
+        idx_row, idx_col = np.where(np.any(im_binary, axis=1))[0], np.where(np.any(im_binary, axis=0))[0]
+        rows = slice(max(idx_row[0] - int(max_dist_ref_pixels), 0), idx_row[-1] + int(max_dist_ref_pixels) + 1)
+        cols = slice(max(idx_col[0] - int(max_dist_ref_pixels), 0), idx_col[-1] + int(max_dist_ref_pixels) + 1)
+        im_dist = ndimage.distance_transform_edt(~im_binary[rows,cols])
+        im_buffer[rows,cols] = im_dist <= max_dist_ref_pixels
+
+    # store the buffer (read-only as it is shared) and remove the oldest ones
+    im_buffer.setflags(write=False)
+    _buffer_cache[key] = im_buffer
+    while len(_buffer_cache) > BUFFER_CACHE_SIZE:
+        _buffer_cache.pop(next(iter(_buffer_cache)))
+
+    return im_buffer
 
-        # convert reference shoreline to pixel coordinates
-        ref_sl = settings['reference_shoreline']
-        ref_sl_conv = SDS_tools.convert_epsg(ref_sl, settings['output_epsg'],image_epsg)
-        ref_sl_pix = SDS_tools.convert_world2pix(ref_sl_conv, georef)
-        ref_sl_pix_rounded = np.round(ref_sl_pix).astype(int)
+def rasterize_line(points, im_shape):
+    """
+    Returns the pixels crossed by a polyline, the segments between consecutive
+    vertices are sampled every half pixel so that there are no gaps. The segments
+    with a NaN vertex (separating the different parts of the line) are skipped.
 
-        # make sure that the pixel coordinates of the reference shoreline are inside the image
-        idx_row = np.logical_and(ref_sl_pix_rounded[:,0] > 0, ref_sl_pix_rounded[:,0] < im_shape[1])
-        idx_col = np.logical_and(ref_sl_pix_rounded[:,1] > 0, ref_sl_pix_rounded[:,1] < im_shape[0])
-        idx_inside = np.logical_and(idx_row, idx_col)
-        ref_sl_pix_rounded = ref_sl_pix_rounded[idx_inside,:]
+    Arguments:
+    -----------
+    points: np.array
+        pixel coordinates (row, column) of the vertices of the polyline
+    im_shape: tuple
+        size of the image (rows,columns)
 
-        # create binary image of the reference shoreline (1 where the shoreline is 0 otherwise)
-        im_binary = np.zeros(im_shape)
-        for j in range(len(ref_sl_pix_rounded)):
-            im_binary[ref_sl_pix_rounded[j,1], ref_sl_pix_rounded[j,0]] = 1
-        im_binary = im_binary.astype(bool)
+    Returns:    
+    -----------
+    pixels: np.array
+        (row, column) of the pixels that are on the line and inside the image
 
-        # dilate the binary image to create a buffer around the reference shoreline
-        max_dist_ref_pixels = np.ceil(settings['max_dist_ref']/pixel_size)
-        se = morphology.disk(max_dist_ref_pixels)
-        im_buffer = morphology.binary_dilation(im_binary, se)
+    """
 
-    return im_buffer
+    points = np.asarray(points, dtype=float).reshape(-1,2)
+    idx_finite = np.all(np.isfinite(points), axis=1)
+    # isolated vertices (e.g., a line made of a single point) and segments
+    pts_single = points[idx_finite,:]
+    idx_seg = np.logical_and(idx_finite[:-1], idx_finite[1:])
+    start, end = points[:-1,:][idx_seg,:], points[1:,:][idx_seg,:]
+    # number of samples on each segment (every half pixel)
+    n_samples = np.ceil(2*np.max(np.abs(end - start), axis=1)).astype(int) + 1
+    idx = np.repeat(np.arange(len(start)), n_samples)
+    # position of each sample along its segment (from 0 to 1)
+    offsets = np.repeat(np.cumsum(n_samples) - n_samples, n_samples)
+    t = (np.arange(len(idx)) - offsets)/np.repeat(np.maximum(n_samples - 1, 1), n_samples)
+    pts_seg = start[idx,:] + t.reshape(-1,1)*(end[idx,:] - start[idx,:])
+    pixels = np.round(np.append(pts_single, pts_seg, axis=0)).astype(int)
+    # only keep the pixels inside the image
+    idx_inside = np.logical_and(np.all(pixels >= 0, axis=1),
+                                np.logical_and(pixels[:,0] < im_shape[0], pixels[:,1] < im_shape[1]))
+
+    return pixels[idx_inside,:]
 
 def process_contours(contours):
     """
@@ -601,17 +1949,20 @@ def process_contours(contours):
         
     """
     
-    # initialise variable
-    contours_nonans = []
-    # loop through contours and only keep the ones without NaNs
-    for k in range(len(contours)):
-        if np.any(np.isnan(contours[k])):
-            index_nan = np.where(np.isnan(contours[k]))[0]
-            contours_temp = np.delete(contours[k], index_nan, axis=0)
-            if len(contours_temp) > 1:
-                contours_nonans.append(contours_temp)
-        else:
-            contours_nonans.append(contours[k])
+    if len(contours) == 0:
+        return []
+    # find the NaNs of all the contours at once
+    lengths = np.array([len(_) for _ in contours])
+    points = np.concatenate(contours, axis=0)
+    idx_nan = np.any(np.isnan(points), axis=1)
+    if not np.any(idx_nan):
+        return list(contours)
+    # remove the NaN points and split the remaining points back into contours
+    lengths_nonans = np.add.reduceat((~idx_nan).astype(int), np.cumsum(lengths) - lengths)
+    contours_split = np.split(points[~idx_nan,:], np.cumsum(lengths_nonans)[:-1])
+    # drop the contours that had NaNs and have less than 2 points left
+    contours_nonans = [contours_split[k] for k in range(len(contours))
+                       if lengths_nonans[k] > 1 or lengths_nonans[k] == lengths[k]]
     
     return contours_nonans
     
@@ -652,61 +2003,304 @@ def process_shoreline(contours, cloud_mask, im_nodata, georef, image_epsg, setti
 
     """
 
+    # concatenate the contours into a single array of points
+    if type(contours) is np.ndarray:
+        contours = [contours]
+    points_pix, ends = SDS_tools.concatenate_points(contours)
+    n_points = np.diff(np.concatenate([[0], ends])).astype(int)
     # convert pixel coordinates to world coordinates
-    contours_world = SDS_tools.convert_pix2world(contours, georef)
+    points_world = SDS_tools.convert_pix2world(points_pix, georef)
     # convert world coordinates to desired spatial reference system
-    contours_epsg = SDS_tools.convert_epsg(contours_world, image_epsg, settings['output_epsg'])
+    points = SDS_tools.convert_epsg(points_world, image_epsg, settings['output_epsg'])
     
     # 1. Remove contours that have a perimeter < min_length_sl (provided in settings dict)
     # this enables to remove the very small contours that do not correspond to the shoreline
-    contours_long = []
-    for l, wl in enumerate(contours_epsg):
-        coords = [(wl[k,0], wl[k,1]) for k in range(len(wl))]
-        a = LineString(coords) # shapely LineString structure
-        if a.length >= settings['min_length_sl']:
-            contours_long.append(wl)
-    # format points into np.array
-    x_points = np.array([])
-    y_points = np.array([])
-    for k in range(len(contours_long)):
-        x_points = np.append(x_points,contours_long[k][:,0])
-        y_points = np.append(y_points,contours_long[k][:,1])
-    contours_array = np.transpose(np.array([x_points,y_points]))
-    
-    shoreline = contours_array
+    # the length of each segment between consecutive points of the same contour is added
+    # to the perimeter of that contour (in order, as shapely's LineString.length)
+    idx_contour = np.repeat(np.arange(len(n_points)), n_points)
+    same_contour = idx_contour[1:] == idx_contour[:-1]
+    dx = np.diff(points[:,0])[same_contour]
+    dy = np.diff(points[:,1])[same_contour]
+    perimeters = np.bincount(idx_contour[1:][same_contour], weights=np.sqrt(dx*dx + dy*dy),
+                             minlength=len(n_points))
+    # keep the points of the long contours (and their pixel coordinates as well)
+    idx_keep = np.repeat(perimeters >= settings['min_length_sl'], n_points)
+    shoreline = points[idx_keep]
+    shoreline_pix = points_pix[idx_keep]
     
     # 2. Remove any shoreline points that are close to cloud pixels (effect of shadows)
-    if sum(sum(cloud_mask)) > 0:
-        # get the coordinates of the cloud pixels
-        idx_cloud = np.where(cloud_mask)
-        idx_cloud = np.array([(idx_cloud[0][k], idx_cloud[1][k]) for k in range(len(idx_cloud[0]))])
-        # convert to world coordinates and same epsg as the shoreline points
-        coords_cloud = SDS_tools.convert_epsg(SDS_tools.convert_pix2world(idx_cloud, georef),
-                                               image_epsg, settings['output_epsg'])
-        # only keep the shoreline points that are at least 30m from any cloud pixel
-        idx_keep = np.ones(len(shoreline)).astype(bool)
-        for k in range(len(shoreline)):
-            if np.any(np.linalg.norm(shoreline[k,:] - coords_cloud, axis=1) < settings['dist_clouds']):
-                idx_keep[k] = False     
-        shoreline = shoreline[idx_keep] 
+    if np.any(cloud_mask) and len(shoreline) > 0:
+        # only keep the shoreline points that are at least settings['dist_clouds'] from any cloud pixel
+        idx_keep = ~find_points_near_mask(shoreline, shoreline_pix, cloud_mask, settings['dist_clouds'],
+                                          georef, image_epsg, settings['output_epsg'])
+        shoreline = shoreline[idx_keep]
+        shoreline_pix = shoreline_pix[idx_keep]
         
     # 3. Remove any shoreline points that are attached to nodata pixels
-    if sum(sum(im_nodata)) > 0:
-        # get the coordinates of the cloud pixels
-        idx_cloud = np.where(im_nodata)
-        idx_cloud = np.array([(idx_cloud[0][k], idx_cloud[1][k]) for k in range(len(idx_cloud[0]))])
-        # convert to world coordinates and same epsg as the shoreline points
-        coords_cloud = SDS_tools.convert_epsg(SDS_tools.convert_pix2world(idx_cloud, georef),
-                                               image_epsg, settings['output_epsg'])
+    if np.any(im_nodata) and len(shoreline) > 0:
         # only keep the shoreline points that are at least 30m from any nodata pixel
-        idx_keep = np.ones(len(shoreline)).astype(bool)
-        for k in range(len(shoreline)):
-            if np.any(np.linalg.norm(shoreline[k,:] - coords_cloud, axis=1) < 30):
-                idx_keep[k] = False     
+        idx_keep = ~find_points_near_mask(shoreline, shoreline_pix, im_nodata, 30,
+                                          georef, image_epsg, settings['output_epsg'])
         shoreline = shoreline[idx_keep] 
 
     return shoreline
 
+def find_points_near_mask(points, points_pix, mask, dist, georef, image_epsg, output_epsg):
+    """
+    Finds the points that are closer than dist to a pixel of a mask (e.g., cloud
+    pixels), using a Euclidean distance transform of the mask instead of the
+    distances to every masked pixel.
+    The distance transform is in pixels, it is converted to the output spatial
+    reference system with the smallest and largest scale of the projection over
+    all directions, at the corners, the middle of the edges and the centre of the
+    image. The points for which the result is ambiguous (between these two scales,
+    or within one pixel of the threshold) are checked with the exact distances to
+    the masked pixels around them, so that the result is the same as comparing the
+    points to all the masked pixels.
+
+    Arguments:
+    -----------
+    points: np.array
+        X and Y coordinates of the points (in output_epsg)
+    points_pix: np.array
+        pixel coordinates (row, column) of the same points
+    mask: np.array
+        2D mask with True for the pixels to avoid
+    dist: float
+        minimum distance to the mask (in the units of output_epsg)
+    georef: np.array
+        vector of 6 elements [Xtr, Xscale, Xshear, Ytr, Yshear, Yscale]
+    image_epsg: int
+        spatial reference system of the image
+    output_epsg: int
+        spatial reference system of the points
+
+    Returns:    
+    -----------
+    idx_near: np.array
+        boolean array, True for the points closer than dist to the mask
+
+    """
+
+    nrows, ncols = mask.shape
+    # local scale of the transformation from pixels to output coordinates, from the
+    # Jacobian at the corners, the middle of the edges and the centre of the image
+    rows, cols = [_.reshape(-1) for _ in np.meshgrid([0, (nrows - 1)/2, nrows - 1],
+                                                      [0, (ncols - 1)/2, ncols - 1], indexing='ij')]
+    pix_jac = np.concatenate([np.column_stack([rows, cols]), np.column_stack([rows + 1, cols]),
+                              np.column_stack([rows, cols + 1])])
+    xy_jac = SDS_tools.convert_epsg(SDS_tools.convert_pix2world(pix_jac, georef),
+                                    image_epsg, output_epsg)[:,:2].reshape(3, len(rows), 2)
+    jacobian = np.stack([xy_jac[1] - xy_jac[0], xy_jac[2] - xy_jac[0]], axis=2)
+    scale = np.linalg.svd(jacobian, compute_uv=False)
+    # pixel distances under which the points are surely close/above which they are surely far
+    # (with 0.1% margin for the variation of the scale between the sampled positions)
+    dist_close = dist/np.max(scale)/1.001
+    dist_far = dist/np.min(scale)*1.001
+
+    # distance (in pixels) from each pixel to the closest masked pixel
+    im_dist = ndimage.distance_transform_edt(~mask)
+    # the points are at most half a pixel diagonal from the closest pixel centre
+    points_round = np.round(points_pix).astype(int)
+    points_round[:,0] = np.clip(points_round[:,0], 0, nrows - 1)
+    points_round[:,1] = np.clip(points_round[:,1], 0, ncols - 1)
+    dist_pix = im_dist[points_round[:,0], points_round[:,1]]
+    idx_near = dist_pix + np.sqrt(2)/2 < dist_close
+    idx_far = dist_pix - np.sqrt(2)/2 >= dist_far
+
+    # compute the exact distances for the ambiguous points, to the masked pixels around them
+    idx_check = np.where(~np.logical_or(idx_near, idx_far))[0]
+    if len(idx_check) > 0:
+        im_check = np.zeros(mask.shape).astype(bool)
+        im_check[points_round[idx_check,0], points_round[idx_check,1]] = True
+        radius = int(np.ceil(dist_far)) + 1
+        im_check = ndimage.maximum_filter(im_check, size=2*radius + 1)
+        pix_mask = np.transpose(np.array(np.where(np.logical_and(mask, im_check)))).astype(float)
+        if len(pix_mask) > 0:
+            coords_mask = SDS_tools.convert_epsg(SDS_tools.convert_pix2world(pix_mask, georef),
+                                                 image_epsg, output_epsg)
+            dist_mask = spatial.cKDTree(coords_mask).query(points[idx_check,:])[0]
+            idx_near[idx_check] = dist_mask < dist
+
+    return idx_near
+
+###################################################################################################
+# AUTOMATIC REFERENCE SHORELINE
+###################################################################################################
+
+def get_reference_sl_auto(metadata, settings, fn_geojson=None):
+    """
+    Non-interactive alternative to SDS_preprocess.get_reference_sl for batch runs.
+    The reference shoreline is taken from (by order of priority):
+        - the reference shoreline already saved for this site (.pkl file), if it
+        is in the coordinate system of settings['output_epsg']
+        - the shorelines mapped in a previous run (fn_geojson)
+        - the boundary between the sea and the land on the least cloudy image
+    It is then saved as a .pkl and .geojson file in the site folder, so that it
+    is only computed once per site (the .pkl file also stores the EPSG code). The
+    different parts of the reference shoreline are separated by a row of NaNs.
+
+    Arguments:
+    -----------
+    metadata: dict
+        contains all the information about the satellite images that were downloaded
+    settings: dict with the following keys
+        'inputs': dict
+            input parameters (sitename, filepath, polygon, dates, sat_list)
+        'cloud_thresh': float
+            value between 0 and 1 indicating the maximum cloud fraction in
+            the cropped image that is accepted
+        'cloud_mask_issue': boolean
+            True if there is an issue with the cloud mask and sand pixels
+            are erroneously being masked on the images
+        'output_epsg': int
+            output spatial reference system as EPSG code
+        'sand_color': str
+            default', 'dark' (for grey/black sand beaches) or 'bright' (for white sand beaches)
+        'min_beach_area': int
+            minimum area (in metres^2) for an object to be labelled as a beach
+        'min_length_sl': int
+            minimum length (in metres) of the parts of the reference shoreline
+    fn_geojson: str (optional)
+        filename of a .geojson file with the shorelines mapped in a previous run
+        (e.g., the file exported by Prepare_GeoJSON_NFLD.py)
+
+    Returns:
+    -----------
+    reference_shoreline: np.array or None
+        coordinates of the reference shoreline, None if no image could be used
+        to map it
+
+    """
+
+    sitename = settings['inputs']['sitename']
+    filepath = os.path.join(settings['inputs']['filepath'], sitename)
+    fn_pkl = os.path.join(filepath, sitename + '_reference_shoreline.pkl')
+    fn_geojson_ref = os.path.join(filepath, sitename + '_reference_shoreline.geojson')
+    # if the reference shoreline of this site already exists in the output
+    # coordinate system, load it
+    if os.path.exists(fn_pkl):
+        with open(fn_pkl, 'rb') as f:
+            reference_sl = pickle.load(f)
+        if isinstance(reference_sl, dict):
+            epsg = reference_sl['epsg']
+            reference_sl = reference_sl['shoreline']
+        else:
+            # the .pkl saved by SDS_preprocess.get_reference_sl only contains the
+            # coordinates, they are in the coordinate system of the .geojson file
+            epsg = None
+            if os.path.exists(fn_geojson_ref):
+                crs = gpd.read_file(fn_geojson_ref).crs
+                epsg = None if crs is None else crs.to_epsg()
+        if epsg == settings['output_epsg']:
+            print('Reference shoreline already exists and was loaded')
+            return reference_sl
+        print('Reference shoreline already exists in epsg:%s, it is mapped again in epsg:%d'%(epsg, settings['output_epsg']))
+
+    # otherwise use the shorelines of a previous run
+    if fn_geojson is not None and os.path.exists(fn_geojson):
+        gdf = gpd.read_file(fn_geojson).to_crs(epsg=settings['output_epsg'])
+        lines = []
+        for geom in gdf.geometry:
+            for part in getattr(geom, 'geoms', [geom]):
+                coords = np.array(part.coords)
+                if len(coords) > 1:
+                    lines.append(coords[:,:2])
+    # or map the sea/land boundary on the least cloudy image
+    else:
+        lines = map_reference_sl(metadata, settings)
+    if len(lines) == 0:
+        print('No image could be used to map the reference shoreline of ' + sitename)
+        return None
+
+    # join the different parts, separated by NaNs
+    reference_shoreline = np.concatenate([np.append(_, [[np.nan, np.nan]], axis=0) for _ in lines])[:-1,:]
+
+    # save the reference shoreline as .pkl and .geojson (to check it on a GIS)
+    if not os.path.exists(filepath):
+        os.makedirs(filepath)
+    with open(fn_pkl, 'wb') as f:
+        pickle.dump({'shoreline':reference_shoreline, 'epsg':settings['output_epsg']}, f)
+    gdf = gpd.GeoDataFrame({'name':['reference shoreline %d'%(k+1) for k in range(len(lines))]},
+                           geometry=[LineString(_) for _ in lines])
+    gdf.crs = CRS(settings['output_epsg'])
+    gdf.to_file(fn_geojson_ref, driver='GeoJSON', encoding='utf-8')
+    print('Reference shoreline has been saved in ' + filepath)
+
+    return reference_shoreline
+
+def map_reference_sl(metadata, settings):
+    """
+    Maps the boundary between the sea and the land on the least cloudy image
+    (S2, L8, L9 or L5, no L7 because of the gaps in the images). The image is
+    classified with the NN classifier and the sea is the largest connected body of
+    water (water and whitewater pixels), so that the inland lakes are ignored.
+    If no boundary is found on an image, the next least cloudy image is used.
+
+    Arguments:
+    -----------
+    metadata: dict
+        contains all the information about the satellite images that were downloaded
+    settings: dict
+        same keys as for get_reference_sl_auto
+
+    Returns:
+    -----------
+    lines: list of np.array
+        coordinates of the parts of the sea/land boundary (longer than
+        settings['min_length_sl']), empty if no image could be used
+
+    """
+
+    collection = settings['inputs']['landsat_collection']
+    # list the images that pass the cloud cover threshold (from the QA band only)
+    images = []
+    for satname in ['S2','L8','L9','L5']:
+        if not satname in metadata.keys():
+            continue
+        filepath = SDS_tools.get_filepath(settings['inputs'],satname)
+        for i in range(len(metadata[satname]['filenames'])):
+            fn = SDS_tools.get_filenames(metadata[satname]['filenames'][i], filepath, satname)
+            cloud_cover_combined, cloud_cover = SDS_preprocess.check_cloud_cover(fn, satname,
+                                                                                 settings['cloud_mask_issue'],
+                                                                                 collection)
+            if cloud_cover_combined > 0.99 or cloud_cover > settings['cloud_thresh']:
+                continue
+            images.append((cloud_cover, satname, i, fn))
+
+    # try the images from the least cloudy one
+    for cloud_cover, satname, i, fn in sorted(images, key=lambda _: _[0]):
+        im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = SDS_preprocess.preprocess_single_cached(fn, satname,
+                                                                                                        settings)
+        image_epsg = metadata[satname]['epsg'][i]
+        pixel_size = 10 if satname == 'S2' else 15
+        # classify the image
+        clf = SDS_models.get_classifier(satname, settings['sand_color'])
+        im_classif, im_labels = classify_image_NN(im_ms, cloud_mask,
+                                                  np.ceil(settings['min_beach_area']/pixel_size**2), clf)
+        # keep the largest body of water
+        im_water = np.logical_or(im_labels[:,:,1], im_labels[:,:,2])
+        im_water_labels = measure.label(im_water, connectivity=2)
+        if np.max(im_water_labels) == 0:
+            continue
+        im_sea = im_water_labels == np.argmax(np.bincount(im_water_labels[im_water]))
+        # contour the sea, find_contours does not go through the nan pixels so the
+        # contours are cut at the cloud and no data pixels
+        im_sea = im_sea.astype(float)
+        im_sea[cloud_mask] = np.nan
+        contours = [_ for _ in measure.find_contours(im_sea, 0.5) if len(_) > 1]
+        if len(contours) == 0:
+            continue
+        # convert to world coordinates and keep the long enough parts
+        contours_epsg = SDS_tools.convert_epsg(SDS_tools.convert_pix2world(contours, georef),
+                                               image_epsg, settings['output_epsg'])
+        lines = [_ for _ in contours_epsg if LineString(_).length >= settings['min_length_sl']]
+        if len(lines) > 0:
+            print('Reference shoreline mapped on ' + metadata[satname]['filenames'][i])
+            return lines
+
+    return []
+
 ###################################################################################################
 # INTERACTIVE/PLOTTING FUNCTIONS
 ###################################################################################################
@@ -1116,7 +2710,7 @@ def adjust_detection(im_ms, cloud_mask, im_nodata, im_labels, im_ref_buffer, ima
             # update the plot
             t_line.set_xdata([t_mndwi,t_mndwi])
             # map contours with new threshold
-            contours = measure.find_contours(im_mndwi_buffer, t_mndwi)
+            contours = find_contours_buffer(im_mndwi_buffer, t_mndwi, im_ref_buffer)
             # remove contours that contain NaNs (due to cloud pixels in the contour)
             contours = process_contours(contours) 
             # process the water contours into a shoreline
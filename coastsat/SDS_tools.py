@@ -15,12 +15,12 @@ import pdb
 from osgeo import gdal, osr
 import geopandas as gpd
 from shapely import geometry
-import skimage.transform as transform
-from astropy.convolution import convolve
 import pytz
 from datetime import datetime, timedelta
-from scipy import stats, interpolate
+from scipy import stats, interpolate, ndimage
 import pyproj
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
 ###################################################################################################
 # COORDINATES CONVERSION FUNCTIONS
@@ -51,21 +51,16 @@ def convert_pix2world(points, georef):
     aff_mat = np.array([[georef[1], georef[2], georef[0]],
                        [georef[4], georef[5], georef[3]],
                        [0, 0, 1]])
-    # create affine transformation
-    tform = transform.AffineTransform(aff_mat)
 
-    # if list of arrays
+    # if list of arrays, transform them all at once
     if type(points) is list:
-        points_converted = []
-        # iterate over the list
-        for i, arr in enumerate(points): 
-            tmp = arr[:,[1,0]]
-            points_converted.append(tform(tmp))
+        points_all, ends = concatenate_points(points)
+        points_converted = split_points(apply_affine(points_all[:,[1,0]], aff_mat), ends)
           
     # if single array
     elif type(points) is np.ndarray:
         tmp = points[:,[1,0]]
-        points_converted = tform(tmp)
+        points_converted = apply_affine(tmp, aff_mat)
         
     else:
         raise Exception('invalid input type')
@@ -93,27 +88,23 @@ def convert_world2pix(points, georef):
     
     """
     
-    # make affine transformation matrix
+    # make inverse affine transformation matrix
     aff_mat = np.array([[georef[1], georef[2], georef[0]],
                        [georef[4], georef[5], georef[3]],
                        [0, 0, 1]])
-    # create affine transformation
-    tform = transform.AffineTransform(aff_mat)
+    inv_mat = np.linalg.inv(aff_mat)
     
-    # if list of arrays
+    # if list of arrays, transform them all at once
     if type(points) is list:
-        points_converted = []
-        # iterate over the list
-        for i, arr in enumerate(points): 
-            points_converted.append(tform.inverse(points))
+        points_all, ends = concatenate_points(points)
+        points_converted = split_points(apply_affine(points_all, inv_mat), ends)
             
     # if single array    
     elif type(points) is np.ndarray:
-        points_converted = tform.inverse(points)
+        points_converted = apply_affine(points, inv_mat)
         
     else:
-        print('invalid input type')
-        raise
+        raise Exception('invalid input type')
         
     return points_converted
 
@@ -139,17 +130,15 @@ def convert_epsg(points, epsg_in, epsg_out):
         
     """
     
-    # define transformer
-    proj = pyproj.Transformer.from_crs(epsg_in, epsg_out, always_xy=True)
+    # get transformer (created once for each pair of epsg codes)
+    proj = get_transformer(epsg_in, epsg_out)
     
     # transform points
     if type(points) is list:
-        points_converted = []
-        # iterate over the list
-        for i, arr in enumerate(points): 
-            x,y = proj.transform(arr[:,0], arr[:,1])
-            arr_converted = np.transpose(np.array([x,y]))
-            points_converted.append(arr_converted)
+        # transform all the arrays at once and split the result
+        points_all, ends = concatenate_points(points)
+        x,y = proj.transform(points_all[:,0], points_all[:,1])
+        points_converted = split_points(np.transpose(np.array([x,y])), ends)
     elif type(points) is np.ndarray:
         x,y = proj.transform(points[:,0], points[:,1])
         points_converted = np.transpose(np.array([x,y]))
@@ -158,6 +147,102 @@ def convert_epsg(points, epsg_in, epsg_out):
 
     return points_converted
 
+@lru_cache(maxsize=32)
+def get_transformer(epsg_in, epsg_out):
+    """
+    Returns the pyproj transformer between two spatial references. The transformers
+    are cached, as creating one is much slower than transforming the points of an image.
+
+    Arguments:
+    -----------
+    epsg_in: int
+        epsg code of the spatial reference in which the input is
+    epsg_out: int
+        epsg code of the spatial reference in which the output will be
+
+    Returns:
+    -----------
+    proj: pyproj.Transformer
+        transformer from epsg_in to epsg_out (x,y order)
+
+    """
+
+    return pyproj.Transformer.from_crs(epsg_in, epsg_out, always_xy=True)
+
+def apply_affine(points, aff_mat):
+    """
+    Applies a 3x3 affine transformation matrix to 2D points, as a single float64
+    matrix product on the homogeneous coordinates (same result as skimage's
+    AffineTransform).
+
+    Arguments:
+    -----------
+    points: np.array
+        array with 2 columns (x,y)
+    aff_mat: np.array
+        3x3 affine transformation matrix
+
+    Returns:
+    -----------
+    points_converted: np.array
+        transformed coordinates
+
+    """
+
+    points = np.asarray(points, dtype=np.float64).reshape(-1,2)
+    points_h = np.column_stack([points, np.ones(len(points))])
+
+    return (points_h @ aff_mat.T)[:,:2]
+
+def concatenate_points(points):
+    """
+    Concatenates a list of arrays of points into a single array, so that they can be
+    transformed at once.
+
+    Arguments:
+    -----------
+    points: list of np.array
+        arrays with at least 2 columns
+
+    Returns:
+    -----------
+    points_all: np.array
+        array with the first 2 columns of all the arrays
+    ends: np.array
+        index of the end of each array in points_all
+
+    """
+
+    arrays = [np.asarray(arr, dtype=np.float64)[:,:2] for arr in points]
+    ends = np.cumsum([len(arr) for arr in arrays]).astype(int)
+    if len(arrays) == 0:
+        return np.zeros((0,2)), ends
+
+    return np.concatenate(arrays, axis=0), ends
+
+def split_points(points_all, ends):
+    """
+    Splits an array of points concatenated with concatenate_points back into a list
+    of arrays.
+
+    Arguments:
+    -----------
+    points_all: np.array
+        concatenated points
+    ends: np.array
+        index of the end of each array in points_all
+
+    Returns:
+    -----------
+    points: list of np.array
+        the arrays of points (views of points_all)
+
+    """
+
+    starts = np.concatenate([[0], ends[:-1]]).astype(int)
+
+    return [points_all[i:j] for i, j in zip(starts, ends)]
+
 ###################################################################################################
 # IMAGE ANALYSIS FUNCTIONS
 ###################################################################################################
@@ -203,12 +288,15 @@ def nd_index(im1, im2, cloud_mask):
 def image_std(image, radius):
     """
     Calculates the standard deviation of an image, using a moving window of 
-    specified radius. Uses astropy's convolution library'
+    specified radius. The NaN values are ignored (the standard deviation is computed
+    on the valid pixels of each window) and are preserved in the output.
+    Several images can be processed at once by stacking them along a 1st dimension.
     
     Arguments:
     -----------
     image: np.array
-        2D array containing the pixel intensities of a single-band image
+        2D array containing the pixel intensities of a single-band image, or 3D
+        array containing several images stacked along the first dimension
     radius: int
         radius defining the moving window used to calculate the standard deviation. 
         For example, radius = 1 will produce a 3x3 moving window.
@@ -216,25 +304,25 @@ def image_std(image, radius):
     Returns:    
     -----------
     win_std: np.array
-        2D array containing the standard deviation of the image
+        2D (or 3D) array containing the standard deviation of the image(s)
         
     """  
     
-    # convert to float
+    # convert to float (copy) and set the NaNs to 0 so that they do not count in the sums
     image = image.astype(float)
-    # first pad the image
-    image_padded = np.pad(image, radius, 'reflect')
-    # window size
-    win_rows, win_cols = radius*2 + 1, radius*2 + 1
-    # calculate std with uniform filters
-    win_mean = convolve(image_padded, np.ones((win_rows,win_cols)), boundary='extend',
-                        normalize_kernel=True, nan_treatment='interpolate', preserve_nan=True)
-    win_sqr_mean = convolve(image_padded**2, np.ones((win_rows,win_cols)), boundary='extend',
-                        normalize_kernel=True, nan_treatment='interpolate', preserve_nan=True)
+    im_nan = np.isnan(image)
+    image[im_nan] = 0
+    # window size (the stacked images are not mixed)
+    size = [1]*(image.ndim - 2) + [radius*2 + 1, radius*2 + 1]
+    # calculate the mean of the valid pixels and of their squares with uniform filters
+    # (the image is mirrored at the edges)
+    win_count = ndimage.uniform_filter((~im_nan).astype(float), size, mode='mirror')
+    win_mean = ndimage.uniform_filter(image, size, mode='mirror')/win_count
+    win_sqr_mean = ndimage.uniform_filter(image**2, size, mode='mirror')/win_count
     win_var = win_sqr_mean - win_mean**2
     win_std = np.sqrt(win_var)
-    # remove padding
-    win_std = win_std[radius:-radius, radius:-radius]
+    # preserve the NaNs
+    win_std[im_nan] = np.nan
 
     return win_std
 
@@ -463,35 +551,49 @@ def remove_duplicates(output):
     
     KV WRL 2020
     
+    The pairs are found with a sweep over the sorted timestamps and the lengths of the
+    shorelines are computed from their coordinates, so that long multi-satellite
+    time-series are processed in O(n log n).
+    
     Arguments:
     -----------
-        output: dict
+        output: dict or ShorelineOutput
             contains output dict with shoreline and metadata
         
     Returns:    
     -----------
-        output_no_duplicates: dict
+        output_no_duplicates: dict or ShorelineOutput
             contains the updated dict where duplicates have been removed
         
     """
-    # remove duplicates
-    dates = output['dates'].copy()
-    # find the pairs of images that are within 5 minutes of each other
-    time_delta = 5*60 # 5 minutes in seconds
-    pairs = []
-    for i,date in enumerate(dates):
-        # dummy value so it does not match it again
-        dates[i] = pytz.utc.localize(datetime(1,1,1) + timedelta(days=i+1))
-        # calculate time difference
-        time_diff = np.array([np.abs((date - _).total_seconds()) for _ in dates])
-        # find the matching times and add to pairs list
-        boolvec = time_diff <= time_delta
-        if np.sum(boolvec) == 0:
-            continue
+    # timestamps in microseconds (int64) of each shoreline
+    if isinstance(output, dict):
+        dates = output['dates']
+        if len(dates) > 0 and dates[0].tzinfo is not None:
+            epoch = pytz.utc.localize(datetime(1970,1,1))
         else:
-            idx_dup = np.where(boolvec)[0][0]
-            pairs.append([i,idx_dup])
-            
+            epoch = datetime(1970,1,1)
+        timestamps = np.array([(_ - epoch)//timedelta(microseconds=1) for _ in dates], dtype=np.int64)
+    # columnar output (SDS_output.ShorelineOutput), already stored as datetime64[us]
+    else:
+        timestamps = output['dates'].astype('datetime64[us]').astype(np.int64)
+
+    # find the pairs of images that are within 5 minutes of each other: each image is
+    # paired with the first image (in the order of the output) that comes after it and
+    # is within 5 minutes, found by searching the sorted timestamps
+    time_delta = 5*60*1000000 # 5 minutes in microseconds
+    idx_sorted = np.argsort(timestamps, kind='stable')
+    timestamps_sorted = timestamps[idx_sorted]
+    idx_lower = np.searchsorted(timestamps_sorted, timestamps - time_delta, side='left')
+    idx_upper = np.searchsorted(timestamps_sorted, timestamps + time_delta, side='right')
+    pairs = []
+    # only the images with another image in their 5-minute window are checked
+    for i in np.where(idx_upper - idx_lower > 1)[0]:
+        idx_window = idx_sorted[idx_lower[i]:idx_upper[i]]
+        idx_window = idx_window[idx_window > i]
+        if len(idx_window) > 0:
+            pairs.append([i, np.min(idx_window)])
+
     # if there are duplicates, only keep the longest shoreline
     if len(pairs) > 0:
         # initialise variables
@@ -499,8 +601,9 @@ def remove_duplicates(output):
         idx_remove = []
         # for each pair
         for pair in pairs:
+            shorelines = [get_shoreline(output, _) for _ in pair]
             # check if any of the shorelines are empty
-            empty_bool = [(len(output['shorelines'][_]) < 2) for _ in pair]
+            empty_bool = [(len(_) < 2) for _ in shorelines]
             if np.all(empty_bool): # if both empty remove both
                 idx_remove.append(pair[0])
                 idx_remove.append(pair[1])
@@ -512,22 +615,67 @@ def remove_duplicates(output):
                 if 'L9' in satnames and 'L7' in satnames: 
                     idx_remove.append(pair[np.where([_ == 'L7' for _ in satnames])[0][0]])
                 else: # keep the longest shorelines
-                    sl0 = geometry.LineString(output['shorelines'][pair[0]]) 
-                    sl1 = geometry.LineString(output['shorelines'][pair[1]])
-                    if sl0.length >= sl1.length: idx_remove.append(pair[1])
+                    length0 = polyline_length(shorelines[0])
+                    length1 = polyline_length(shorelines[1])
+                    if length0 >= length1: idx_remove.append(pair[1])
                     else: idx_remove.append(pair[0])
         # create a new output structure with all the duplicates removed
-        idx_remove = sorted(idx_remove)
-        idx_all = np.linspace(0, len(dates)-1, len(dates)).astype(int)
-        idx_keep = list(np.where(~np.isin(idx_all,idx_remove))[0])        
+        idx_keep = np.where(~np.isin(np.arange(len(timestamps)), idx_remove))[0]
+        print('%d duplicates' % len(idx_remove))
+        if not isinstance(output, dict):
+            return output.take(idx_keep)
         for key in output.keys():
             output_no_duplicates[key] = [output[key][i] for i in idx_keep]
-        print('%d duplicates' % len(idx_remove))
         return output_no_duplicates 
     else: 
         print('0 duplicates')
         return output
 
+def get_shoreline(output, i):
+    """
+    Returns the coordinates of the i-th shoreline of an output dictionnary or of a
+    columnar output (SDS_output.ShorelineOutput).
+
+    Arguments:
+    -----------
+        output: dict or ShorelineOutput
+            contains output dict with shoreline and metadata
+        i: int
+            index of the shoreline
+
+    Returns:
+    -----------
+        shoreline: np.array
+            coordinates of the shoreline
+
+    """
+    if isinstance(output, dict):
+        return output['shorelines'][i]
+    else:
+        return output.shoreline(i)
+
+def polyline_length(points):
+    """
+    Computes the length of a polyline from the differences between its coordinates,
+    the segments are summed in order as shapely (LineString.length) does.
+
+    Arguments:
+    -----------
+        points: np.array
+            2D array with the X and Y coordinates of the vertices
+
+    Returns:
+    -----------
+        length: float
+            length of the polyline
+
+    """
+    points = np.asarray(points, dtype=float)
+    dx = np.diff(points[:,0])
+    dy = np.diff(points[:,1])
+    # cumulative sum to add the segments sequentially
+    return np.cumsum(np.sqrt(dx*dx + dy*dy))[-1]
+
 def remove_inaccurate_georef(output, accuracy):
     """
     Function to remove from the output dictionnary entries containing shorelines 
@@ -537,15 +685,15 @@ def remove_inaccurate_georef(output, accuracy):
 
     Arguments:
     -----------
-        output: dict
+        output: dict or ShorelineOutput
             contains the extracted shorelines and corresponding metadata
         accuracy: int
             minimum horizontal georeferencing accuracy (metres) for a shoreline to be accepted
 
     Returns:
     -----------
-        output_filtered: dict
-            contains the updated dictionnary
+        output_filtered: dict or ShorelineOutput
+            contains the updated dictionnary (or container)
 
     """
 
@@ -553,6 +701,10 @@ def remove_inaccurate_georef(output, accuracy):
     idx = np.where(~np.logical_or(np.array(output['geoaccuracy']) == -1,
                                   np.array(output['geoaccuracy']) >= accuracy))[0]
     # idx = np.where(~(np.array(output['geoaccuracy']) >= accuracy))[0]
+    # columnar output (SDS_output.ShorelineOutput)
+    if not isinstance(output, dict):
+        print('%d bad georef' % (len(output) - len(idx)))
+        return output.take(idx)
     output_filtered = dict([])
     for key in output.keys():
         output_filtered[key] = [output[key][i] for i in idx]
@@ -601,6 +753,90 @@ def get_closest_datapoint(dates, dates_ts, values_ts):
     
     return values
 
+###################################################################################################
+# PARALLEL PROCESSING
+###################################################################################################
+
+def start_pool(n_jobs):
+    """
+    Creates the pool of processes used to process the images in parallel (e.g., in
+    SDS_shoreline.extract_shorelines and SDS_preprocess.save_jpg). Each
+    process uses cpu_count//n_jobs threads for BLAS/OpenMP, so that the processes
+    do not compete for the cores.
+
+    Arguments:
+    -----------
+    n_jobs: int
+        number of processes
+
+    Returns:
+    -----------
+    executor: concurrent.futures.ProcessPoolExecutor
+        pool of processes
+    threads_env: dict
+        previous values of the environment variables limiting the threads (to be
+        restored by stop_pool)
+
+    """
+
+    n_threads = max(1, (os.cpu_count() or 1)//n_jobs)
+    # the thread limits in the environment are inherited by the processes of the pool
+    threads_env = dict([])
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        threads_env[var] = os.environ.get(var)
+        if threads_env[var] is None:
+            os.environ[var] = str(n_threads)
+    executor = ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker,
+                                   initargs=(n_threads,))
+
+    return executor, threads_env
+
+def stop_pool(executor, threads_env):
+    """
+    Shuts down a pool of processes created with start_pool (cancelling the tasks that
+    have not started) and restores the thread limits in the environment.
+
+    Arguments:
+    -----------
+    executor: concurrent.futures.ProcessPoolExecutor
+        pool of processes
+    threads_env: dict
+        as returned by start_pool
+
+    Returns:
+    -----------
+    Shuts down the pool
+
+    """
+
+    executor.shutdown(cancel_futures=True)
+    for var in threads_env.keys():
+        if threads_env[var] is None:
+            os.environ.pop(var, None)
+
+def init_worker(n_threads):
+    """
+    Initialises a process of a pool created with start_pool, by limiting the
+    number of threads used by BLAS/OpenMP so that the processes do not compete for
+    the cores (threadpoolctl is used if it is installed).
+
+    Arguments:
+    -----------
+    n_threads: int
+        number of threads per process
+
+    Returns:
+    -----------
+    Limits the number of threads of the current process
+
+    """
+
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=n_threads)
+    except ImportError:
+        pass
+
 ###################################################################################################
 # GEODATAFRAMES AND READ/WRITE GEOJSON
 ###################################################################################################
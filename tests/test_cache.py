@@ -0,0 +1,62 @@
+"""
+Checks the on-disk cache of SDS_cache: the keys change when the image files change
+and the incomplete entries are treated as missing.
+
+Run with pytest or directly: python tests/test_cache.py
+"""
+
+# load modules
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from coastsat import SDS_cache
+
+def test_cache_key():
+    # the key changes with the content and the modification time of any image file
+    filepath = tempfile.mkdtemp()
+    try:
+        fn = [os.path.join(filepath, 'image_ms.tif'), os.path.join(filepath, 'image_mask.tif')]
+        for fname in fn:
+            with open(fname, 'wb') as f:
+                f.write(b'0'*100)
+        key = SDS_cache.get_cache_key(fn, ('preprocess', 'S2'))
+        assert key.startswith('image_ms_')
+        assert key == SDS_cache.get_cache_key(fn, ('preprocess', 'S2'))
+        assert key != SDS_cache.get_cache_key(fn, ('preprocess', 'L8'))
+        # same size, newer file
+        stat = os.stat(fn[1])
+        os.utime(fn[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        key_mtime = SDS_cache.get_cache_key(fn, ('preprocess', 'S2'))
+        assert key_mtime != key
+        # different size
+        with open(fn[0], 'ab') as f:
+            f.write(b'0')
+        assert SDS_cache.get_cache_key(fn, ('preprocess', 'S2')) not in [key, key_mtime]
+    finally:
+        shutil.rmtree(filepath)
+
+def test_incomplete_entry():
+    # an entry missing one of its arrays is a miss and is removed
+    cache_dir = tempfile.mkdtemp()
+    try:
+        im = np.arange(12, dtype=np.float32).reshape(3, 4)
+        mask = im > 5
+        SDS_cache.save_entry(cache_dir, 'entry', {'im':im}, {'mask':mask}, 100)
+        entry = SDS_cache.load_entry(cache_dir, 'entry', ['im', 'mask'])
+        assert np.array_equal(entry['im'], im) and np.array_equal(entry['mask'], mask)
+        del entry
+        os.remove(os.path.join(cache_dir, 'entry', 'masks.npz'))
+        assert SDS_cache.load_entry(cache_dir, 'entry', ['im', 'mask']) is None
+        assert not os.path.exists(os.path.join(cache_dir, 'entry'))
+        assert SDS_cache.load_entry(cache_dir, 'entry', ['im', 'mask']) is None
+    finally:
+        shutil.rmtree(cache_dir)
+
+if __name__ == '__main__':
+    for test in [test_cache_key, test_incomplete_entry]:
+        test()
+        print('%s: OK'%test.__name__)
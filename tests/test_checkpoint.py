@@ -0,0 +1,66 @@
+"""
+Checks the checkpoint log of extract_shorelines (settings['checkpoint'] and
+settings['resume']) on synthetic scenes: the output is the same as without the
+log, and the images that failed are processed again when resuming.
+
+Run with pytest or directly: python tests/test_checkpoint.py
+"""
+
+# load modules
+import os
+import sys
+import copy
+import shutil
+import tempfile
+import pytest
+
+# the synthetic scenes are written with GDAL
+pytest.importorskip('osgeo')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from coastsat import SDS_shoreline, SDS_tools
+from test_windowed import make_site, same_arrays
+
+def same_output(output, output_ref):
+    return (output['dates'] == output_ref['dates'] and output['filename'] == output_ref['filename']
+            and all([same_arrays(a, b) for a, b in zip(output['shorelines'], output_ref['shorelines'])]))
+
+def test_checkpoint_resume():
+    filepath = tempfile.mkdtemp()
+    try:
+        metadata, settings = make_site(filepath, sat_list=('S2','L8'))
+        output_ref = SDS_shoreline.extract_shorelines(metadata, copy.deepcopy(settings))
+        assert len(output_ref['shorelines']) > 0
+        fn_log = os.path.join(filepath, 'SYNTHETIC', 'SYNTHETIC_output_log.pkl')
+        fn_failed = os.path.join(filepath, 'SYNTHETIC', 'SYNTHETIC_output_failed.pkl')
+
+        # same output when it is built from the log
+        output = SDS_shoreline.extract_shorelines(metadata, dict(copy.deepcopy(settings), checkpoint=True))
+        assert same_output(output, output_ref)
+        assert len(SDS_shoreline.load_checkpoint(fn_log)[0]) == 4
+        assert len(SDS_shoreline.load_checkpoint(fn_failed)[0]) == 0
+
+        # an image that cannot be read does not stop the run, it is not in the log
+        fn = SDS_tools.get_filenames(metadata['L8']['filenames'][1],
+                                     SDS_tools.get_filepath(settings['inputs'], 'L8'), 'L8')
+        os.rename(fn[0], fn[0] + '.bak')
+        output = SDS_shoreline.extract_shorelines(metadata, dict(copy.deepcopy(settings), checkpoint=True))
+        assert not metadata['L8']['filenames'][1] in output['filename']
+        records_failed = SDS_shoreline.load_checkpoint(fn_failed)[0]
+        assert [_['filename'] for _ in records_failed] == [metadata['L8']['filenames'][1]]
+        assert records_failed[0]['error'] is not None
+        assert len(SDS_shoreline.load_checkpoint(fn_log)[0]) == 3
+
+        # it is processed again when resuming, once it can be read
+        os.rename(fn[0] + '.bak', fn[0])
+        output = SDS_shoreline.extract_shorelines(metadata, dict(copy.deepcopy(settings), resume=True))
+        assert same_output(output, output_ref)
+        assert len(SDS_shoreline.load_checkpoint(fn_log)[0]) == 4
+        assert len(SDS_shoreline.load_checkpoint(fn_failed)[0]) == 0
+    finally:
+        shutil.rmtree(filepath)
+
+if __name__ == '__main__':
+    for test in [test_checkpoint_resume]:
+        test()
+        print('%s: OK'%test.__name__)
@@ -0,0 +1,81 @@
+"""
+Checks that the classifiers stored as .npz files and run with NumPy (SDS_models)
+give the same labels as the pickled sklearn classifiers they were converted from.
+
+Run with pytest or directly: python tests/test_models.py
+"""
+
+# load modules
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import warnings
+import numpy as np
+import pytest
+
+# the pickled classifiers need sklearn
+joblib = pytest.importorskip('joblib')
+pytest.importorskip('sklearn')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from coastsat import SDS_models
+
+FILEPATH_MODELS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                               'classification', 'models')
+
+def random_features(n_pixels, n_features, seed):
+    # bands (0 to 1), normalized-difference indices (-1 to 1) and their standard deviations
+    rng = np.random.default_rng(seed)
+    features = np.column_stack([rng.random((n_pixels, 5)), rng.uniform(-1, 1, (n_pixels, 5)),
+                                0.3*rng.random((n_pixels, 10))])
+    return features[:,:n_features]
+
+def load_pickled(fn_npz):
+    # pickled classifier from which the .npz file was converted (as in SDS_models.load_model)
+    fn_base = os.path.splitext(fn_npz)[0]
+    for fn_model in [fn_base + '_new.pkl', fn_base + '.pkl']:
+        if os.path.exists(fn_model):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                return fn_model, joblib.load(fn_model)
+    raise Exception('no pickled classifier for %s'%fn_npz)
+
+def test_models_labels():
+    # all the shipped classifiers give the same labels as sklearn, for float64 and
+    # float32 features
+    fn_npzs = sorted(glob.glob(os.path.join(FILEPATH_MODELS, '*.npz')))
+    assert len(fn_npzs) == 5
+    for k, fn_npz in enumerate(fn_npzs):
+        fn_model, clf = load_pickled(fn_npz)
+        model = SDS_models.load_model(fn_npz)
+        features = random_features(50000, model['coefs'][0].shape[0], k)
+        for dtype in [np.float64, np.float32]:
+            labels = SDS_models.predict(model, features.astype(dtype))
+            assert np.array_equal(labels, clf.predict(features.astype(dtype))), (fn_model, dtype)
+        # all the classes are predicted
+        assert len(np.unique(labels)) == len(model['classes']), fn_model
+
+def test_convert_model():
+    # converting the pickled classifiers again gives the shipped .npz files
+    filepath = tempfile.mkdtemp()
+    try:
+        for fn_npz in sorted(glob.glob(os.path.join(FILEPATH_MODELS, '*.npz'))):
+            fn_model = load_pickled(fn_npz)[0]
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                model = SDS_models.convert_model(fn_model, os.path.join(filepath, 'model.npz'))
+            model_ref = SDS_models.load_model(fn_npz)
+            for key in ['coefs', 'intercepts']:
+                assert all([np.array_equal(a, b) for a, b in zip(model[key], model_ref[key])]), fn_model
+            assert np.array_equal(model['classes'], model_ref['classes'])
+            assert model['activation'] == model_ref['activation']
+            assert model['out_activation'] == model_ref['out_activation']
+            assert SDS_models.get_model_hash(model) == SDS_models.get_model_hash(model_ref)
+    finally:
+        shutil.rmtree(filepath)
+
+if __name__ == '__main__':
+    for test in [test_models_labels, test_convert_model]:
+        test()
+        print('%s: OK'%test.__name__)
@@ -0,0 +1,118 @@
+"""
+Checks the columnar container of the shorelines (SDS_output.ShorelineOutput):
+conversion from/to the output dictionnary, filtering, indexing and slicing.
+
+Run with pytest or directly: python tests/test_output.py
+"""
+
+# load modules
+import os
+import sys
+import pytz
+import numpy as np
+import pytest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from coastsat.SDS_output import ShorelineOutput
+
+def make_output(n, tz=pytz.utc, seed=0):
+    # output dictionnary as saved by extract_shorelines, with an empty shoreline
+    rng = np.random.default_rng(seed)
+    date0 = datetime(2015, 3, 1, 10, 30)
+    dates = [date0 + timedelta(days=7*i, microseconds=int(rng.integers(0, 10**6))) for i in range(n)]
+    if tz is not None:
+        dates = [tz.localize(_) for _ in dates]
+    shorelines = [rng.random((int(rng.integers(2, 30)), 2))*1000 for i in range(n)]
+    if n > 2:
+        shorelines[2] = np.zeros((0,2))
+    return {'dates':dates,
+            'satname':[['L5','L7','L8','L9','S2'][i%5] for i in range(n)],
+            'shorelines':shorelines,
+            'filename':['image_%d.tif'%i for i in range(n)],
+            'cloud_cover':[float(_) for _ in rng.random(n)],
+            'geoaccuracy':[float(_) for _ in rng.random(n)*10],
+            'idx':list(range(n)),
+            'MNDWI_threshold':[float(_) for _ in rng.uniform(-0.5, 0.5, n)]}
+
+def check_output(output, output_ref, idx):
+    # output is the output dictionnary output_ref restricted to the indices idx
+    assert sorted(output.keys()) == sorted(output_ref.keys())
+    for key in output_ref.keys():
+        assert len(output[key]) == len(idx), key
+        if key == 'shorelines':
+            for sl, i in zip(output[key], idx):
+                assert np.array_equal(sl, output_ref[key][i])
+        else:
+            assert output[key] == [output_ref[key][i] for i in idx], key
+
+def test_round_trip():
+    # tz-aware dates (in UTC or another time zone), naive dates and empty outputs
+    for tz in [pytz.utc, pytz.timezone('America/Halifax'), None]:
+        output = make_output(12, tz)
+        output_col = ShorelineOutput.from_dict(output)
+        assert len(output_col) == 12
+        assert output_col.tz_aware == (tz is not None)
+        assert output_col['dates'].dtype == np.dtype('datetime64[us]')
+        output_back = output_col.to_dict()
+        check_output(output_back, output, range(12))
+        if tz is not None:
+            assert all([_.tzinfo is not None and _.utcoffset() == timedelta(0) for _ in output_back['dates']])
+        else:
+            assert all([_.tzinfo is None for _ in output_back['dates']])
+        # the values are Python scalars, as in the output dictionnary
+        assert all([type(_) == float for _ in output_back['cloud_cover']])
+        assert all([type(_) == int for _ in output_back['idx']])
+        assert all([type(_) == str for _ in output_back['satname']])
+    # empty output
+    output = make_output(0)
+    output_col = ShorelineOutput.from_dict(output)
+    assert len(output_col) == 0 and output_col.coords.shape == (0,2)
+    output_back = output_col.to_dict()
+    assert all([output_back[key] == [] for key in output.keys()])
+    # mixed numbers and strings stay as they are
+    output = make_output(3)
+    output['geoaccuracy'] = [5.0, 'PASSED', -1]
+    assert ShorelineOutput.from_dict(output).to_dict()['geoaccuracy'] == [5.0, 'PASSED', -1]
+
+def test_filter_take_getitem():
+    output = make_output(20, pytz.timezone('Australia/Sydney'))
+    output_col = ShorelineOutput.from_dict(output)
+    # shorelines are views of the coordinates buffer
+    for i in range(20):
+        assert np.array_equal(output_col.shoreline(i), output['shorelines'][i])
+        assert np.shares_memory(output_col.shoreline(i), output_col.coords) or len(output_col.shoreline(i)) == 0
+    assert np.array_equal(output_col.lengths(), [len(_) for _ in output['shorelines']])
+    # filter with a boolean mask
+    mask = np.arange(20)%3 == 0
+    output_filt = output_col.filter(mask)
+    assert output_filt.coords is output_col.coords
+    check_output(output_filt.to_dict(), output, np.where(mask)[0])
+    with pytest.raises(Exception):
+        output_col.filter(mask[:-1])
+    # take in any order, with repeated indices
+    idx = [5, 2, 19, 0, 5]
+    output_take = output_col.take(idx)
+    assert output_take.coords is output_col.coords
+    check_output(output_take.to_dict(), output, idx)
+    # columns and slices
+    assert np.array_equal(output_col['cloud_cover'], output['cloud_cover'])
+    assert list(output_col['satname']) == output['satname']
+    for key in [slice(3, 11), slice(None, None, -2), slice(15, None), slice(4, 4)]:
+        output_slice = output_col[key]
+        assert output_slice.coords is output_col.coords
+        check_output(output_slice.to_dict(), output, list(range(20))[key])
+    with pytest.raises(Exception):
+        output_col[3]
+    with pytest.raises(KeyError):
+        output_col['unknown']
+    # compact copies only the coordinates that are used, in order
+    output_compact = output_take.compact()
+    assert not np.shares_memory(output_compact.coords, output_col.coords)
+    assert len(output_compact.coords) == np.sum(output_take.lengths())
+    check_output(output_compact.to_dict(), output, idx)
+
+if __name__ == '__main__':
+    for test in [test_round_trip, test_filter_take_getitem]:
+        test()
+        print('%s: OK'%test.__name__)
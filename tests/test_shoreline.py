@@ -0,0 +1,188 @@
+"""
+Checks the functions of SDS_shoreline that replace slower computations (distance
+to the masked pixels, contours, thresholds) against direct versions of the same
+computations, on synthetic arrays.
+
+Run with pytest or directly: python tests/test_shoreline.py
+"""
+
+# load modules
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import geopandas as gpd
+import pytest
+from scipy import spatial
+from skimage import filters, measure, morphology
+from shapely.geometry import LineString
+
+# SDS_shoreline imports GDAL
+pytest.importorskip('osgeo')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from coastsat import SDS_shoreline, SDS_tools
+
+def test_find_points_near_mask():
+    # same points as with the distances to all the masked pixels, on 200 km images
+    # projected to EPSG:3857 (whose scale varies by several % over the image)
+    rng = np.random.default_rng(0)
+    nrows = ncols = 200
+    for ytr in [9000000., 6000000., 3000000.]:
+        georef = np.array([300000., 1000., 0., ytr, 0., -1000.])
+        mask = np.zeros((nrows, ncols)).astype(bool)
+        for r, c in rng.integers(0, nrows, (5, 2)):
+            mask[max(r - 3, 0):r + 3, max(c - 3, 0):c + 3] = True
+        points_pix = rng.random((2000, 2))*(nrows - 1)
+        points = SDS_tools.convert_epsg(SDS_tools.convert_pix2world(points_pix, georef), 32620, 3857)
+        pix_mask = np.transpose(np.array(np.where(mask))).astype(float)
+        coords_mask = SDS_tools.convert_epsg(SDS_tools.convert_pix2world(pix_mask, georef), 32620, 3857)
+        dist_mask = spatial.cKDTree(coords_mask[:,:2]).query(points[:,:2])[0]
+        for dist in [20000., 60000.]:
+            idx_near = SDS_shoreline.find_points_near_mask(points, points_pix, mask, dist, georef,
+                                                           32620, 3857)
+            assert np.array_equal(idx_near, dist_mask < dist), (ytr, dist)
+
+def test_threshold_otsu_classes():
+    # same threshold as threshold_otsu on the concatenated values
+    rng = np.random.default_rng(0)
+    for k in range(200):
+        dtype = [np.float64, np.float32][k%2]
+        values = [rng.normal(-0.3, 0.2, int(rng.integers(1, 3000))).astype(dtype),
+                  rng.normal(0.3, 0.15, int(rng.integers(1, 3000))).astype(dtype)]
+        # values on a few levels (many equal values)
+        if k%5 == 0:
+            values = [np.round(_, 2) for _ in values]
+        # more than two classes, and an empty class
+        if k%7 == 0:
+            values += [rng.uniform(-1, 1, 100).astype(dtype), np.zeros(0, dtype=dtype)]
+        threshold = SDS_shoreline.threshold_otsu_classes(values)
+        assert threshold == filters.threshold_otsu(np.concatenate(values)), k
+    # a single value
+    assert SDS_shoreline.threshold_otsu_classes([np.ones(5), np.ones(3)]) == 1
+    with pytest.raises(Exception):
+        SDS_shoreline.threshold_otsu_classes([np.zeros(0)])
+
+def make_beach(seed):
+    # synthetic image with sand on the left and water on the right of a wavy line,
+    # the classification has many more sand pixels than water pixels in the buffer
+    rng = np.random.default_rng(seed)
+    nrows, ncols = 120, 150
+    rr, cc = np.mgrid[0:nrows, 0:ncols]
+    line = 100 + 8*np.sin(rr/10.0)
+    im_water = cc > line
+    reflectances = np.where(im_water[:,:,np.newaxis], [[[.08,.06,.04,.02,.01]]], [[[.2,.25,.3,.35,.4]]])
+    im_ms = np.clip(reflectances + rng.normal(0, 0.02, reflectances.shape), 0.001, None)
+    im_labels = np.zeros((nrows, ncols, 3)).astype(bool)
+    im_labels[:,:,0] = cc < line - 2
+    im_labels[:,:,2] = cc > line + 2
+    cloud_mask = np.zeros((nrows, ncols)).astype(bool)
+    im_ref_buffer = np.logical_and(cc > line - 60, cc < line + 15)
+    return im_ms, im_labels, cloud_mask, im_ref_buffer
+
+def same_contours(contours1, contours2):
+    return len(contours1) == len(contours2) and all([np.array_equal(a, b) for a, b in zip(contours1, contours2)])
+
+def test_find_wl_contours_seed():
+    im_ms, im_labels, cloud_mask, im_ref_buffer = make_beach(0)
+    # find_wl_contours1 does not sample: Otsu threshold of all the pixels of the buffer
+    im_mndwi = SDS_shoreline.get_nd_index(im_ms, cloud_mask, 'MNDWI')
+    contours1, t1 = SDS_shoreline.find_wl_contours1(im_mndwi, cloud_mask, im_ref_buffer)
+    im_buffer = morphology.binary_dilation(im_ref_buffer, morphology.disk(5))
+    assert t1 == filters.threshold_otsu(im_mndwi[im_buffer])
+    assert len(contours1) > 0
+    np.random.seed(1)
+    assert same_contours(SDS_shoreline.find_wl_contours1(im_mndwi, cloud_mask, im_ref_buffer)[0], contours1)
+
+    # find_wl_contours2 samples the sand pixels with the seed only (not the global state)
+    results = []
+    for seed in range(4):
+        np.random.seed(seed + 10)
+        contours2, t2 = SDS_shoreline.find_wl_contours2(im_ms, im_labels, cloud_mask, im_ref_buffer,
+                                                        seed=seed)
+        np.random.seed(seed + 20)
+        contours2_again, t2_again = SDS_shoreline.find_wl_contours2(im_ms, im_labels, cloud_mask,
+                                                                    im_ref_buffer, seed=seed)
+        assert t2 == t2_again and same_contours(contours2, contours2_again) and len(contours2) > 0
+        # threshold of all the water pixels and of the same number of sampled sand pixels
+        im_ndwi = SDS_shoreline.get_nd_index(im_ms, cloud_mask, 'NDWI')
+        int_water = im_ndwi[np.logical_and(im_buffer, im_labels[:,:,2])]
+        int_sand = im_ndwi[np.logical_and(im_buffer, im_labels[:,:,0])]
+        assert len(int_sand) > len(int_water)
+        idx = np.random.default_rng(seed).choice(len(int_sand), len(int_water), replace=False, shuffle=False)
+        assert t2 == filters.threshold_otsu(np.concatenate([int_water, int_sand[idx]]))
+        results.append(t2)
+    # the sample depends on the seed
+    assert len(np.unique(results)) > 1
+    # the default seed is 0
+    assert SDS_shoreline.find_wl_contours2(im_ms, im_labels, cloud_mask, im_ref_buffer)[1] == results[0]
+
+def process_contours_loop(contours):
+    # process_contours before it was vectorised
+    contours_nonans = []
+    for k in range(len(contours)):
+        if np.any(np.isnan(contours[k])):
+            index_nan = np.where(np.isnan(contours[k]))[0]
+            contours_temp = np.delete(contours[k], index_nan, axis=0)
+            if len(contours_temp) > 1:
+                contours_nonans.append(contours_temp)
+        else:
+            contours_nonans.append(contours[k])
+    return contours_nonans
+
+def test_find_contours_buffer():
+    # same contours as find_contours on the whole image with NaNs outside the buffer,
+    # with buffers and contours that cross the borders of the 8x8 blocks
+    rng = np.random.default_rng(0)
+    nrows, ncols = 157, 203
+    rows, cols = np.mgrid[:nrows, :ncols]
+    for k in range(20):
+        # wavy level lines plus noise, and a few clouds (NaNs) inside the image
+        im = (np.sin(cols/rng.uniform(5, 20) + rng.uniform(0, 6)) + np.cos(rows/rng.uniform(5, 20))
+              + 0.3*rng.standard_normal((nrows, ncols)))
+        for r, c in rng.integers(0, [nrows, ncols], (3, 2)):
+            im[max(r - 4, 0):r + 5, max(c - 4, 0):c + 5] = np.nan
+        # buffer made of disks and a thin diagonal band at odd positions
+        im_buffer = np.zeros((nrows, ncols)).astype(bool)
+        for r, c in rng.integers(0, [nrows, ncols], (4, 2)):
+            im_buffer = np.logical_or(im_buffer, (rows - r)**2 + (cols - c)**2 < rng.uniform(3, 30)**2)
+        im_buffer = np.logical_or(im_buffer, np.abs(rows - 0.7*cols - rng.uniform(-50, 50)) < 1.5)
+        level = rng.uniform(-0.5, 0.5)
+        im_nan = np.copy(im)
+        im_nan[~im_buffer] = np.nan
+        contours_full = process_contours_loop(measure.find_contours(im_nan, level))
+        contours = SDS_shoreline.process_contours(SDS_shoreline.find_contours_buffer(im, level, im_buffer))
+        # same contours in the same order, the coordinates can differ in the last bits
+        # because the offset of the window is added after the interpolation
+        assert len(contours) == len(contours_full), k
+        for contour, contour_full in zip(contours, contours_full):
+            assert contour.shape == contour_full.shape and np.allclose(contour, contour_full, rtol=0, atol=1e-9), k
+    # buffer that covers the whole image
+    assert same_contours(SDS_shoreline.find_contours_buffer(im, level, np.ones((nrows, ncols)).astype(bool)),
+                         measure.find_contours(im, level))
+
+def test_get_reference_sl_auto():
+    # the saved reference shoreline is only loaded in the same coordinate system
+    filepath = tempfile.mkdtemp()
+    try:
+        fn_geojson = os.path.join(filepath, 'previous_output_lines.geojson')
+        gdf = gpd.GeoDataFrame(geometry=[LineString([(-63.1, 46.2), (-63.0, 46.25), (-62.9, 46.3)])],
+                               crs='EPSG:4326')
+        gdf.to_file(fn_geojson, driver='GeoJSON')
+        settings = {'inputs':{'sitename':'SITE', 'filepath':filepath}, 'output_epsg':32620}
+        sl_32620 = SDS_shoreline.get_reference_sl_auto({}, settings, fn_geojson)
+        # loaded from the .pkl file even without the previous shorelines
+        assert np.array_equal(SDS_shoreline.get_reference_sl_auto({}, settings), sl_32620)
+        settings['output_epsg'] = 3857
+        sl_3857 = SDS_shoreline.get_reference_sl_auto({}, settings, fn_geojson)
+        coords = SDS_tools.convert_epsg(sl_32620, 32620, 3857)[:,:2]
+        assert np.allclose(sl_3857, coords, rtol=0, atol=1e-3)
+        assert np.array_equal(SDS_shoreline.get_reference_sl_auto({}, settings), sl_3857)
+    finally:
+        shutil.rmtree(filepath)
+
+if __name__ == '__main__':
+    for test in [test_find_points_near_mask, test_threshold_otsu_classes, test_find_wl_contours_seed,
+                 test_find_contours_buffer, test_get_reference_sl_auto]:
+        test()
+        print('%s: OK'%test.__name__)
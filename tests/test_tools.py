@@ -0,0 +1,151 @@
+"""
+Checks the image and output utilities of SDS_tools against direct (slow) versions
+of the same computations.
+
+Run with pytest or directly: python tests/test_tools.py
+"""
+
+# load modules
+import os
+import sys
+import pytz
+import numpy as np
+import pytest
+from datetime import datetime, timedelta
+from shapely import geometry
+
+# SDS_tools imports GDAL
+pytest.importorskip('osgeo')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from coastsat import SDS_tools, SDS_output
+
+def image_std_reference(image, radius):
+    # standard deviation of the valid pixels of each window, the image being mirrored
+    # at the edges (as np.pad with 'reflect'), NaN on the NaN pixels
+    image_padded = np.pad(image.astype(float), radius, 'reflect')
+    win_std = np.nan*np.ones(image.shape)
+    for i in range(image.shape[0]):
+        for j in range(image.shape[1]):
+            if np.isnan(image[i,j]):
+                continue
+            win = image_padded[i:i + 2*radius + 1, j:j + 2*radius + 1]
+            win_std[i,j] = np.std(win[~np.isnan(win)])
+    return win_std
+
+def test_image_std():
+    # 2D and 3D images with NaNs, including on the edges and corners
+    rng = np.random.default_rng(0)
+    for radius in [1, 2]:
+        image = rng.random((3, 9, 11)).astype(np.float32)
+        image[0, 0, 0] = np.nan
+        image[0, 4, 10] = np.nan
+        image[1, 3:6, 3:6] = np.nan
+        image[2, 8, :4] = np.nan
+        image[2, :, 1] = np.nan
+        reference = np.stack([image_std_reference(_, radius) for _ in image])
+        # 2D images
+        for k in range(image.shape[0]):
+            win_std = SDS_tools.image_std(image[k], radius)
+            assert win_std.shape == image[k].shape
+            assert np.array_equal(np.isnan(win_std), np.isnan(image[k]))
+            assert np.allclose(win_std, reference[k], rtol=1e-6, atol=1e-9, equal_nan=True)
+        # stacked images are not mixed
+        win_std = SDS_tools.image_std(image, radius)
+        assert np.allclose(win_std, reference, rtol=1e-6, atol=1e-9, equal_nan=True)
+        # the input is not modified
+        assert np.isnan(image[0, 0, 0])
+
+def remove_duplicates_reference(output):
+    # previous O(n^2) version of SDS_tools.remove_duplicates (tz-aware dates only)
+    dates = output['dates'].copy()
+    time_delta = 5*60
+    pairs = []
+    for i,date in enumerate(dates):
+        dates[i] = pytz.utc.localize(datetime(1,1,1) + timedelta(days=i+1))
+        time_diff = np.array([np.abs((date - _).total_seconds()) for _ in dates])
+        boolvec = time_diff <= time_delta
+        if np.sum(boolvec) == 0:
+            continue
+        pairs.append([i,np.where(boolvec)[0][0]])
+    idx_remove = []
+    for pair in pairs:
+        empty_bool = [(len(output['shorelines'][_]) < 2) for _ in pair]
+        if np.all(empty_bool):
+            idx_remove.append(pair[0])
+            idx_remove.append(pair[1])
+        elif np.any(empty_bool):
+            idx_remove.append(pair[np.where(empty_bool)[0][0]])
+        else:
+            satnames = [output['satname'][_] for _ in pair]
+            if 'L9' in satnames and 'L7' in satnames:
+                idx_remove.append(pair[np.where([_ == 'L7' for _ in satnames])[0][0]])
+            else:
+                sl0 = geometry.LineString(output['shorelines'][pair[0]])
+                sl1 = geometry.LineString(output['shorelines'][pair[1]])
+                if sl0.length >= sl1.length: idx_remove.append(pair[1])
+                else: idx_remove.append(pair[0])
+    idx_keep = list(np.where(~np.isin(np.arange(len(dates)), idx_remove))[0])
+    return dict([(key, [output[key][i] for i in idx_keep]) for key in output.keys()])
+
+def make_output(seed):
+    # output with duplicates from different satellites within 5 minutes (also exactly
+    # 5 minutes, in triplets and between L7 and L9), shorelines of the same length and
+    # empty shorelines, not sorted by date
+    rng = np.random.default_rng(seed)
+    satnames = ['L5','L7','L8','L9','S2']
+    date0 = datetime(2000, 1, 1, tzinfo=pytz.utc)
+    output = {'dates':[], 'satname':[], 'shorelines':[], 'cloud_cover':[]}
+    def add(date, satname, shoreline):
+        output['dates'].append(date)
+        output['satname'].append(satname)
+        output['shorelines'].append(shoreline)
+        output['cloud_cover'].append(float(rng.random()))
+    for i in range(150):
+        date = date0 + timedelta(days=int(rng.integers(0, 8000)), seconds=int(rng.integers(0, 86400)))
+        n_points = int(rng.choice([0, 1, 5, 20]))
+        shoreline = rng.random((n_points, 2))*1000
+        add(date, str(rng.choice(satnames)), shoreline)
+        for k in range(int(rng.choice([0, 0, 1, 2]))):
+            seconds = int(rng.choice([0, 1, 120, 299, 300, 301, -300, -60]))
+            # same shoreline (same length) or a new one
+            if rng.random() < 0.3:
+                shoreline_dup = shoreline.copy()
+            else:
+                shoreline_dup = rng.random((int(rng.choice([0, 3, 20])), 2))*1000
+            add(date + timedelta(seconds=seconds), str(rng.choice(satnames)), shoreline_dup)
+    return output
+
+def same_output(output, output_ref):
+    if not sorted(output.keys()) == sorted(output_ref.keys()):
+        return False
+    for key in output_ref.keys():
+        if not len(output[key]) == len(output_ref[key]):
+            return False
+        if key == 'shorelines':
+            if not all([np.array_equal(a, b) for a, b in zip(output[key], output_ref[key])]):
+                return False
+        elif not list(output[key]) == list(output_ref[key]):
+            return False
+    return True
+
+def test_remove_duplicates():
+    # same images removed as with the previous version, for output dicts and ShorelineOutput
+    for seed in range(5):
+        output = make_output(seed)
+        output_ref = remove_duplicates_reference(output)
+        assert len(output_ref['dates']) < len(output['dates'])
+        assert same_output(SDS_tools.remove_duplicates(output), output_ref), seed
+        output_col = SDS_tools.remove_duplicates(SDS_output.ShorelineOutput.from_dict(output))
+        assert isinstance(output_col, SDS_output.ShorelineOutput)
+        assert same_output(output_col.to_dict(), output_ref), seed
+    # no duplicates
+    output = make_output(0)
+    idx = [0, 5, 9]
+    output = dict([(key, [output[key][i] for i in idx]) for key in output.keys()])
+    output['dates'] = [datetime(2001, 1, 1, tzinfo=pytz.utc) + timedelta(days=i) for i in idx]
+    assert SDS_tools.remove_duplicates(output) is output
+
+if __name__ == '__main__':
+    for test in [test_image_std, test_remove_duplicates]:
+        test()
+        print('%s: OK'%test.__name__)
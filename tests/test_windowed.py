@@ -0,0 +1,183 @@
+"""
+Checks the windowed mode of extract_shorelines (settings['max_memory']) on synthetic
+Sentinel-2, Landsat 7 and Landsat 8 scenes:
+    - the windowed preprocessing and classification give the same images as
+    preprocess_single and classify_image_NN
+    - the mapped shorelines are identical to the ones of the monolithic mode
+    - the memory ceiling is respected, or an exception is raised if it cannot be
+
+Run with pytest or directly: python tests/test_windowed.py
+"""
+
+# load modules
+import os
+import sys
+import copy
+import shutil
+import tempfile
+import tracemalloc
+import numpy as np
+import pytz
+import pytest
+from datetime import datetime
+
+# the synthetic scenes are written with GDAL
+pytest.importorskip('osgeo')
+from osgeo import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from coastsat import SDS_preprocess, SDS_shoreline, SDS_tools, SDS_models
+
+# synthetic scenes: reflectances of each land cover in the B,G,R,NIR,SWIR1 bands
+REFLECTANCES = {'water':[.08,.06,.04,.02,.01], 'sand':[.2,.25,.3,.35,.4], 'veg':[.05,.1,.05,.4,.2]}
+SUBFOLDERS = {'S2':['ms','swir','mask'], 'L7':['ms','pan','mask'], 'L8':['ms','pan','mask']}
+
+def write_tif(fn, bands, georef, dtype):
+    # write a 3D array (bands, rows, columns) into a GeoTIFF
+    data = gdal.GetDriverByName('GTiff').Create(fn, bands.shape[2], bands.shape[1],
+                                                bands.shape[0], dtype)
+    data.SetGeoTransform(georef)
+    for k in range(bands.shape[0]):
+        data.GetRasterBand(k + 1).WriteArray(bands[k])
+    data.FlushCache()
+    data = None
+
+def make_scene(filepath, sitename, satname, date, rows, cols, seed):
+    """
+    Writes a synthetic image (sand beach along a wavy coastline, vegetation, an inland
+    lake, a cloud and a corner of no data) in the folders used by CoastSat and returns
+    its filename (as in metadata).
+    """
+    rng = np.random.default_rng(seed)
+    rr, cc = np.mgrid[0:rows, 0:cols]
+    water = cc > cols*0.5 + 30*np.sin(rr/25.0)
+    sand = np.logical_and(cc > cols*0.5 + 30*np.sin(rr/25.0) - 12, ~water)
+    ms = np.zeros((5, rows, cols))
+    for k in range(5):
+        ms[k] = np.where(water, REFLECTANCES['water'][k],
+                         np.where(sand, REFLECTANCES['sand'][k], REFLECTANCES['veg'][k]))
+    ms = np.clip(ms + rng.normal(0, 0.01, ms.shape), 0.001, None)
+    ms[:, (rr - 60)**2 + (cc - 80)**2 < 20**2] = np.array(REFLECTANCES['water']).reshape(-1,1)
+    ms[:, :15, :25] = 0
+    qa = np.zeros((1, rows, cols))
+    qa[0, (rr - rows*2//3)**2/400 + (cc - cols*3//8)**2/900 < 1] = 1024 if satname == 'S2' else 2**3
+
+    filename = '%s_%s_%s_ms.tif'%(date.strftime('%Y-%m-%d-%H-%M-%S'), satname, sitename)
+    fns = [os.path.join(filepath, sitename, satname, _, filename.replace('ms.tif', _ + '.tif'))
+           for _ in SUBFOLDERS[satname]]
+    for _ in SUBFOLDERS[satname]:
+        os.makedirs(os.path.join(filepath, sitename, satname, _), exist_ok=True)
+    if satname == 'S2':
+        georef = [500000., 10., 0., 5300000., 0., -10.]
+        write_tif(fns[0], ms[:4]*10000, georef, gdal.GDT_Float32)
+        write_tif(fns[1], ms[4:]*10000, georef, gdal.GDT_Float32)
+    else:
+        georef = [500000., 15., 0., 5300000., 0., -15.]
+        pan = ms[:3].mean(axis=0) + rng.normal(0, 0.005, (rows, cols))
+        write_tif(fns[0], ms, georef, gdal.GDT_Float32)
+        write_tif(fns[1], pan.reshape(1, rows, cols), georef, gdal.GDT_Float32)
+    write_tif(fns[2], qa, georef, gdal.GDT_UInt16)
+
+    return filename
+
+def make_site(filepath, rows=300, cols=400, n_images=2, sat_list=('S2','L7','L8')):
+    # synthetic scenes and the corresponding metadata and settings of extract_shorelines
+    sitename = 'SYNTHETIC'
+    metadata = dict([])
+    for satname in sat_list:
+        metadata[satname] = {'filenames':[], 'dates':[], 'epsg':[], 'acc_georef':[]}
+        for i in range(n_images):
+            date = datetime(2020, 9, i + 1, 15, tzinfo=pytz.utc)
+            metadata[satname]['filenames'].append(make_scene(filepath, sitename, satname,
+                                                             date, rows, cols, i))
+            metadata[satname]['dates'].append(date)
+            metadata[satname]['epsg'].append(32620)
+            metadata[satname]['acc_georef'].append(5.0)
+    settings = {'inputs':{'sitename':sitename, 'filepath':filepath, 'sat_list':list(sat_list),
+                          'landsat_collection':'C02'},
+                'cloud_thresh':0.5, 'cloud_mask_issue':False, 'pan_off':False,
+                'output_epsg':32620, 'check_detection':False, 'save_figure':False,
+                'adjust_detection':False, 'min_beach_area':200, 'min_length_sl':100,
+                'buffer_size':150, 'sand_color':'default', 'max_dist_ref':100,
+                'dist_clouds':300}
+    # reference shoreline along the synthetic coastline
+    rr = np.arange(0, rows, 2.)
+    settings['reference_shoreline'] = SDS_tools.convert_pix2world(
+        np.column_stack([rr, cols*0.5 + 30*np.sin(rr/25.0)]), [500000., 10., 0., 5300000., 0., -10.])
+
+    return metadata, settings
+
+def same_arrays(a, b):
+    return a.shape == b.shape and np.array_equal(a, b, equal_nan=True)
+
+def test_windowed_classification():
+    # small windows, same images as the monolithic preprocessing and classification
+    filepath = tempfile.mkdtemp()
+    try:
+        metadata, settings = make_site(filepath)
+        filepath_models = os.path.join(os.path.dirname(os.path.abspath(SDS_shoreline.__file__)),
+                                       os.pardir, 'classification', 'models')
+        for satname in metadata.keys():
+            clf = SDS_models.get_classifier(satname, 'default', filepath_models)
+            fn = SDS_tools.get_filenames(metadata[satname]['filenames'][0],
+                                         SDS_tools.get_filepath(settings['inputs'], satname), satname)
+            for pan_off in [False, True]:
+                settings_k = dict(settings, pan_off=pan_off, max_memory=100)
+                im_ms, georef, cloud_mask, _, _, im_nodata = SDS_preprocess.preprocess_single(
+                    fn, satname, False, pan_off, 'C02')
+                im_classif, im_labels = SDS_shoreline.classify_image_NN(im_ms, cloud_mask, 20, clf)
+                image = SDS_preprocess.preprocess_windowed(fn, satname, settings_k)
+                image['window_rows'] = 23
+                im_ms_w, im_classif_w, im_labels_w = SDS_shoreline.classify_image_windowed(image, 20, clf)
+                assert same_arrays(im_ms, im_ms_w), (satname, pan_off)
+                assert same_arrays(im_classif, im_classif_w), (satname, pan_off)
+                assert same_arrays(im_labels, im_labels_w), (satname, pan_off)
+                assert same_arrays(cloud_mask, image['cloud_mask']), (satname, pan_off)
+                assert same_arrays(im_nodata, image['im_nodata']), (satname, pan_off)
+                assert same_arrays(georef, image['georef']), (satname, pan_off)
+    finally:
+        shutil.rmtree(filepath)
+
+def test_windowed_shorelines():
+    # same shorelines with and without windows
+    filepath = tempfile.mkdtemp()
+    try:
+        metadata, settings = make_site(filepath)
+        output = SDS_shoreline.extract_shorelines(metadata, copy.deepcopy(settings))
+        # 20 MB gives windows of about 30 rows on these images
+        for max_memory in [20, 1000]:
+            settings_w = dict(copy.deepcopy(settings), max_memory=max_memory)
+            output_w = SDS_shoreline.extract_shorelines(metadata, settings_w)
+            assert output['dates'] == output_w['dates']
+            assert output['MNDWI_threshold'] == output_w['MNDWI_threshold']
+            assert len(output['shorelines']) == len(output_w['shorelines']) > 0
+            for sl, sl_w in zip(output['shorelines'], output_w['shorelines']):
+                assert same_arrays(sl, sl_w)
+    finally:
+        shutil.rmtree(filepath)
+
+def test_max_memory():
+    # the memory traced by Python stays below the ceiling, or an exception is raised
+    filepath = tempfile.mkdtemp()
+    try:
+        metadata, settings = make_site(filepath, rows=600, cols=800, n_images=1)
+        # 600 x 800 pixels need about 58 MB (74 MB to fit the pansharpening of Landsat)
+        for max_memory, too_small in [(30, True), (60, True), (80, False), (150, False)]:
+            settings_w = dict(copy.deepcopy(settings), max_memory=max_memory)
+            tracemalloc.start()
+            try:
+                SDS_shoreline.extract_shorelines(metadata, settings_w)
+                peak = tracemalloc.get_traced_memory()[1]
+            except Exception as e:
+                peak = None
+                assert 'max_memory' in str(e)
+            tracemalloc.stop()
+            assert (peak is None) == too_small, max_memory
+            assert peak is None or peak < max_memory*1e6, (max_memory, peak)
+    finally:
+        shutil.rmtree(filepath)
+
+if __name__ == '__main__':
+    for test in [test_windowed_classification, test_windowed_shorelines, test_max_memory]:
+        test()
+        print('%s: OK'%test.__name__)